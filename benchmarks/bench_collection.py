@@ -0,0 +1,73 @@
+# bench_collection.py
+"""Collection cycle benchmark: queries per cycle and wall time per cycle.
+
+Runs the single-pass aggregator against a fake tweet source that serves
+synthetic tweets (benchmarks/synthetic.py) and counts every scan issued. The
+per-bucket query count of the old update_metrics() is reported next to it.
+
+Usage: python benchmarks/bench_collection.py [rows ...]   (default 10k 1M 10M)
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twitter_aggregator import (  # noqa: E402
+    ENGAGEMENT_BUCKETS, LIKE_BUCKETS, PERCENTILES, RETWEET_BUCKETS,
+    TEXT_LENGTH_BUCKETS, TIME_WINDOWS, collect_metrics,
+)
+from synthetic import generate_rows  # noqa: E402
+
+# Statements the per-bucket implementation issued every cycle
+LEGACY_QUERIES_PER_CYCLE = (
+    1 + 1                                   # count, engagement aggregates
+    + len(RETWEET_BUCKETS) + len(LIKE_BUCKETS)
+    + len(TEXT_LENGTH_BUCKETS)
+    + 1                                     # GROUP BY user activity tiers
+    + len(ENGAGEMENT_BUCKETS)
+    + 24                                    # hour of day
+    + 1 + len(TIME_WINDOWS)                 # distinct users, active users
+    + len(TIME_WINDOWS)                     # tweets per window
+    + 1                                     # top users
+    + 2 * len(PERCENTILES)
+    + 1                                     # text analysis
+    + 2                                     # high engagement, viral
+)
+
+
+class CountingSource(object):
+    """Stands in for a tweet source, serving synthetic rows lazily"""
+
+    def __init__(self, rows, seed=42):
+        self.rows = rows
+        self.seed = seed
+        self.queries = 0
+
+    def scan(self, columns, where='', params=()):
+        self.queries += 1
+        return self._pages()
+
+    def _pages(self):
+        return generate_rows(self.rows, self.seed)
+
+
+def run(rows):
+    source = CountingSource(rows)
+    start = time.perf_counter()
+    result = collect_metrics(source)
+    elapsed = time.perf_counter() - start
+    return source.queries, elapsed, len(result)
+
+
+def main(argv):
+    sizes = [int(float(arg)) for arg in argv] or [10_000, 1_000_000, 10_000_000]
+    print(f"{'rows':>12} {'legacy queries':>15} {'queries':>8} {'metrics':>8} {'cycle s':>10} {'rows/s':>12}")
+    for rows in sizes:
+        queries, elapsed, count = run(rows)
+        print(f"{rows:>12,} {LEGACY_QUERIES_PER_CYCLE:>15} {queries:>8} {count:>8} "
+              f"{elapsed:>10.2f} {rows / elapsed:>12,.0f}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+# bench_scrape.py
+"""Scrape load test: latency percentiles while collection cycles run.
+
+Hammers an exporter endpoint from several threads over keep-alive
+connections for a while (long enough to span a few 15s collection cycles)
+and reports latency percentiles overall and for the worst one-second
+window, which is where a scrape stalled behind collection shows up.
+
+Usage: python benchmarks/bench_scrape.py [--url URL] [--threads N] [--seconds S] [--gzip]
+"""
+import argparse
+import http.client
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+def scrape_loop(url, deadline, gzip, samples, errors):
+    parsed = urlparse(url)
+    headers = {'Accept-Encoding': 'gzip'} if gzip else {}
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=10)
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request('GET', parsed.path or '/', headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=10)
+            continue
+        samples.append((time.time(), time.perf_counter() - start))
+    conn.close()
+
+
+def percentiles(latencies):
+    ms = np.asarray(latencies) * 1000
+    return {p: float(np.percentile(ms, p)) for p in (50, 90, 99, 99.9)} | {'max': float(ms.max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:9123/metrics')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+
+    deadline = time.time() + args.seconds
+    samples, errors = [], []
+    threads = [threading.Thread(target=scrape_loop, args=(args.url, deadline, args.gzip, samples, errors))
+               for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not samples:
+        print(f"No successful scrapes ({len(errors)} errors)")
+        return
+    overall = percentiles([latency for _, latency in samples])
+    per_second = {}
+    for stamp, latency in samples:
+        per_second.setdefault(int(stamp), []).append(latency)
+    worst = max(per_second.values(), key=lambda window: np.percentile(window, 99))
+
+    print(f"{len(samples)} scrapes in {args.seconds:.0f}s ({len(samples) / args.seconds:,.0f}/s), {len(errors)} errors")
+    print("latency ms   " + "  ".join(f"p{p}={v:.2f}" if p != 'max' else f"max={v:.2f}" for p, v in overall.items()))
+    print("worst 1s     " + "  ".join(f"p{p}={v:.2f}" if p != 'max' else f"max={v:.2f}"
+                                      for p, v in percentiles(worst).items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+# bench_suite.py
+"""Repeatable exporter benchmarks with machine-readable results.
+
+Loads a deterministic synthetic table (synthetic.py) into the SQLite
+stand-in for Cassandra, then runs a few collection cycles per mode, each
+mode in a fresh process on its own copy of the table, and records cycle
+time, queries per cycle and peak RSS. Between cycles `--append` new tweets
+arrive, so incremental and columnar modes have something to catch up on.
+Last, the exporter is started on the table (port 9123, or scrape a running
+one with --url) and /metrics throughput and latency are measured.
+
+Results are printed as JSON (or written to --output); --compare shows how
+every number changed between two result files.
+
+Usage: python benchmarks/bench_suite.py [--rows N] [--seed S] [--cycles C] [--append A]
+           [--modes full,incremental,columnar,sharded] [--scrape-seconds S] [--output FILE]
+       python benchmarks/bench_suite.py --compare OLD.json NEW.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from twitter_aggregator import collect_metrics  # noqa: E402
+from twitter_columnar import ColumnarCollector  # noqa: E402
+from twitter_incremental import IncrementalCollector  # noqa: E402
+from twitter_source import SQLiteSource  # noqa: E402
+from twitter_targets import ShardedCollector, Target  # noqa: E402
+from bench_scrape import percentiles, scrape_loop  # noqa: E402
+from synthetic import USERS, load_sqlite  # noqa: E402
+
+MODES = ('full', 'incremental', 'columnar', 'sharded')
+EXPORTER_URL = 'http://127.0.0.1:9123'
+READY_TIMEOUT = 600  # seconds to wait for the exporter's first real cycle
+
+
+# ===== COLLECTION =====
+
+def _collector(mode, source, database, workdir, workers):
+    """Callables running one collection cycle, counting the queries issued so far and cleaning up"""
+    if mode == 'full':
+        return lambda: collect_metrics(source), lambda: source.queries, source.close
+    if mode == 'incremental':
+        collector = IncrementalCollector(os.path.join(workdir, 'incremental.pkl'))
+        return lambda: collector.collect(source), lambda: source.queries, source.close
+    if mode == 'columnar':
+        collector = ColumnarCollector(os.path.join(workdir, 'columns'))
+        return lambda: collector.collect(source), lambda: source.queries, source.close
+    if mode == 'sharded':
+        target = Target('bench', (database,), 0, 'twitter', source.table)
+        collector = ShardedCollector([target], 'sqlite', workers=workers, timeout=READY_TIMEOUT)
+
+        def collect():
+            results = collector.collect()
+            if collector.failures:
+                raise collector.failures[target]
+            return results[target]
+
+        def close():
+            collector.executor().shutdown(wait=True)  # reap the workers so their peak RSS is counted
+            source.close()
+        return collect, lambda: collector.queries, close
+    raise ValueError(f"Unknown mode {mode!r}, expected one of {', '.join(MODES)}")
+
+
+def run_case(mode, database, workdir, cycles, append, seed, users, workers):
+    """Collection cycles of one mode (runs in its own process for a clean peak RSS)"""
+    source = SQLiteSource(database)
+    collect, queries, close = _collector(mode, source, database, workdir, workers)
+    results = []
+    began = None
+    for cycle in range(cycles):
+        if cycle and append:
+            # Dated after the previous cycle began, so they are past every mode's watermark
+            now = time.time()
+            load_sqlite(database, append, seed + cycle, users, now=now, span=now - began,
+                        id_prefix=f'a{cycle}-').close()
+        before = queries()
+        began = time.time()
+        started = time.perf_counter()
+        metrics = collect()
+        results.append({
+            'seconds': time.perf_counter() - started,
+            'queries': queries() - before,
+            'tweets': metrics['twitter_tweets_total'],
+        })
+    close()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'cycles': results,
+        'first_seconds': results[0]['seconds'],
+        'steady_seconds': _median([r['seconds'] for r in results[1:]]),
+        'queries_per_cycle': _median([r['queries'] for r in results[1:]] or [results[0]['queries']]),
+        'rows_per_second': results[0]['tweets'] / results[0]['seconds'],
+        'peak_rss_mb': usage.ru_maxrss / 1024,
+        'workers_peak_rss_mb': children.ru_maxrss / 1024,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime,
+    }
+
+
+def _median(values):
+    return float(np.median(values)) if values else None
+
+
+def bench_collection(args, database, workdir):
+    cases = {}
+    for mode in args.modes:
+        case_dir = os.path.join(workdir, mode)
+        os.makedirs(case_dir)
+        copy = os.path.join(case_dir, 'tweets.sqlite')
+        shutil.copy(database, copy)
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            cases[mode] = pool.submit(run_case, mode, copy, case_dir, args.cycles, args.append, args.seed,
+                                      args.users, args.workers).result()
+        case = cases[mode]
+        print(f"{mode:>12}: first {case['first_seconds']:.2f}s, steady {case['steady_seconds'] or 0:.2f}s, "
+              f"{case['queries_per_cycle']:.0f} queries, {case['peak_rss_mb']:.0f} MB peak", file=sys.stderr)
+    # Every mode read the same rows, so a mode counting different tweets is broken
+    tweets = {mode: [cycle['tweets'] for cycle in case['cycles']] for mode, case in cases.items()}
+    if len({tuple(counts) for counts in tweets.values()}) > 1:
+        raise RuntimeError(f"Modes disagree on twitter_tweets_total per cycle: {tweets}")
+    return cases
+
+
+# ===== SCRAPING =====
+
+def _get(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return response.read()
+
+
+def start_exporter(database, workdir, rows):
+    """Run twitter_exporter.py on the table and wait until it serves real data"""
+    env = dict(os.environ,
+               TWITTER_EXPORTER_BACKEND='sqlite',
+               TWITTER_EXPORTER_SQLITE_PATH=database,
+               TWITTER_EXPORTER_MODE='full',
+               TWITTER_EXPORTER_STATE_DIR=os.path.join(workdir, 'state'),
+               TWITTER_EXPORTER_SNAPSHOT_PATH=os.path.join(workdir, 'snapshot'),
+               PYTHONUNBUFFERED='1')
+    log = open(os.path.join(workdir, 'exporter.log'), 'w')
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'twitter_exporter.py')],
+                               env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Exporter exited with {process.returncode}, see {log.name}")
+        try:
+            if json.loads(_get(EXPORTER_URL + '/metrics_json')).get('twitter_tweets_total') == rows:
+                return process
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"Exporter did not serve the benchmark table within {READY_TIMEOUT}s")
+
+
+def bench_scrape(url, seconds, threads):
+    size = len(_get(url))
+    deadline = time.time() + seconds
+    samples, errors = [], []
+    workers = [threading.Thread(target=scrape_loop, args=(url, deadline, False, samples, errors))
+               for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    result = {'url': url, 'threads': threads, 'seconds': seconds, 'scrapes': len(samples),
+              'scrapes_per_second': len(samples) / seconds, 'errors': len(errors), 'response_bytes': size}
+    if samples:
+        result['latency_ms'] = {str(p): v for p, v in percentiles([latency for _, latency in samples]).items()}
+    return result
+
+
+# ===== RESULTS =====
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+def _flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, f"{prefix}.{key}" if prefix else str(key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def compare(old_path, new_path):
+    """Print every number of two result files side by side with the relative change"""
+    with open(old_path) as f:
+        old = dict(_flatten(json.load(f)['results']))
+    with open(new_path) as f:
+        new = dict(_flatten(json.load(f)['results']))
+    print(f"{'metric':<48} {'old':>14} {'new':>14} {'change':>9}")
+    for name in sorted(set(old) | set(new)):
+        if '.cycles' in name:
+            continue
+        a, b = old.get(name), new.get(name)
+        change = f"{(b - a) / a * 100:+8.1f}%" if a and b is not None else ''
+        print(f"{name:<48} {'-' if a is None else f'{a:,.3f}':>14} {'-' if b is None else f'{b:,.3f}':>14} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=lambda v: int(float(v)), default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--users', type=int, default=USERS)
+    parser.add_argument('--now', type=float, default=None, help='epoch seconds the synthetic dates count back from')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--append', type=int, default=1000, help='tweets inserted before every cycle but the first')
+    parser.add_argument('--modes', type=lambda v: v.split(','), default=list(MODES))
+    parser.add_argument('--workers', type=int, default=max(2, os.cpu_count() or 1), help='sharded mode pool size')
+    parser.add_argument('--scrape-seconds', type=float, default=10, help='0 skips the scrape benchmark')
+    parser.add_argument('--scrape-threads', type=int, default=8)
+    parser.add_argument('--url', help='scrape this running exporter instead of starting one')
+    parser.add_argument('--workdir', help='keep the generated table and state here (default: a temp dir)')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='twitter-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        database = os.path.join(workdir, 'tweets.sqlite')
+        if os.path.exists(database):
+            os.remove(database)
+        started = time.perf_counter()
+        load_sqlite(database, args.rows, args.seed, args.users, args.now).close()
+        results = {'load_seconds': time.perf_counter() - started}
+        print(f"Loaded {args.rows:,} synthetic tweets in {results['load_seconds']:.1f}s", file=sys.stderr)
+
+        results['collection'] = bench_collection(args, database, workdir)
+
+        if args.scrape_seconds > 0:
+            process = None
+            url = args.url
+            if url is None:
+                process = start_exporter(database, workdir, args.rows)
+                url = EXPORTER_URL + '/metrics'
+            try:
+                results['scrape'] = bench_scrape(url, args.scrape_seconds, args.scrape_threads)
+            finally:
+                if process is not None:
+                    process.terminate()
+                    process.wait(timeout=30)
+            print(f"{'scrape':>12}: {results['scrape']['scrapes_per_second']:,.0f}/s, "
+                  f"p99 {results['scrape'].get('latency_ms', {}).get('99', 0):.2f} ms", file=sys.stderr)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'benchmark': 'twitter_exporter',
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'parameters': {name: getattr(args, name) for name in
+                       ('rows', 'seed', 'users', 'now', 'cycles', 'append', 'modes', 'workers',
+                        'scrape_seconds', 'scrape_threads')},
+        'environment': environment(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# synthetic.py
+"""Deterministic synthetic tweets for the benchmarks.
+
+The same seed and parameters always produce the same rows (dates are
+offsets from `now`, so pass it too for identical timestamps):
+
+    users      Zipf-distributed activity over `users` distinct names - a few
+               accounts write most of the tweets, most write one or two
+    retweets   heavy-tailed (discrete Pareto, capped), zero for most tweets
+    likes      heavy-tailed as well and correlated with retweets
+    text       lengths around 100 characters, a few past the 280 limit
+    date       spread over the last `span` seconds, denser in recent days
+               and following a day/night cycle over the hours of the day
+               (rows the cycle would move out of the span keep their time,
+               so a span under a day gets no cycle)
+
+Rows are generated a page at a time with NumPy. Load them into the SQLite
+stand-in for Cassandra with:
+
+    python benchmarks/synthetic.py tweets.sqlite --rows 1000000 --seed 42
+"""
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twitter_source import SQLiteSource  # noqa: E402
+
+Row = namedtuple('Row', 'tweet_id user retweets likes text date')
+
+PAGE_SIZE = 5000
+USERS = 100000
+ZIPF_EXPONENT = 1.1      # user activity
+RETWEET_TAIL = 1.8       # smaller = heavier tail
+LIKE_TAIL = 1.5
+MAX_ENGAGEMENT = 10 ** 7
+SPAN = 14 * 86400        # seconds of history
+RECENCY = 3 * 86400      # mean age of a tweet, in seconds
+
+EPOCH = datetime(1970, 1, 1)
+TEXTS = ['x' * n for n in range(400)]
+
+# Relative tweet volume per UTC hour of the day (quiet at night, evening peak)
+DIURNAL = np.array([3, 2, 1.5, 1, 1, 1.5, 2.5, 4, 5, 5.5, 6, 6, 6.5, 6.5, 6, 6, 6.5, 7, 8, 9, 9, 8, 6, 4])
+DIURNAL = DIURNAL / DIURNAL.sum()
+
+
+def user_weights(users, exponent=ZIPF_EXPONENT):
+    """Probability of each user rank writing a tweet (finite Zipf)"""
+    weights = 1.0 / np.arange(1, users + 1) ** exponent
+    return weights / weights.sum()
+
+
+def heavy_tail(rng, n, tail, cap=MAX_ENGAGEMENT):
+    """Discrete Pareto values >= 0: mostly 0-2, occasionally in the millions"""
+    return np.minimum(rng.zipf(tail, n) - 1, cap).astype(np.int64)
+
+
+def generate_columns(rows, seed=42, users=USERS, now=None, span=SPAN, page_size=PAGE_SIZE):
+    """Yield pages of synthetic tweets as dicts of NumPy columns"""
+    now = time.time() if now is None else now
+    rng = np.random.default_rng(seed)
+    weights = user_weights(users)
+    done = 0
+    while done < rows:
+        n = min(page_size, rows - done)
+        retweets = heavy_tail(rng, n, RETWEET_TAIL)
+        likes = heavy_tail(rng, n, LIKE_TAIL) + retweets * rng.integers(0, 4, n)
+        lengths = np.clip(rng.normal(100, 60, n), 0, len(TEXTS) - 1).astype(np.int64)
+
+        # Age: exponential (recent days denser), wrapped into the span, then
+        # moved to an hour drawn from the diurnal profile on the same day -
+        # or the day before when that is in the future - if still in the span
+        ages = rng.exponential(RECENCY, n) % span
+        stamps = now - ages
+        day_starts = stamps // 86400 * 86400
+        hours = rng.choice(24, n, p=DIURNAL)
+        moved = day_starts + hours * 3600 + rng.uniform(0, 3600, n)
+        moved = np.where(moved > now, moved - 86400, moved)
+        stamps = np.where(moved >= now - span, moved, stamps)
+
+        yield {
+            'tweet_id': np.arange(done, done + n),
+            'user': rng.choice(users, n, p=weights),
+            'retweets': retweets,
+            'likes': np.minimum(likes, MAX_ENGAGEMENT),
+            'text_length': lengths,
+            'date_ms': (stamps * 1000).astype(np.int64),
+        }
+        done += n
+
+
+def generate_rows(rows, seed=42, users=USERS, now=None, span=SPAN, id_prefix='t'):
+    """Yield synthetic tweets as Row namedtuples (what a tweet source returns)"""
+    for page in generate_columns(rows, seed, users, now, span):
+        for tweet_id, user, retweets, likes, length, date_ms in zip(
+                page['tweet_id'].tolist(), page['user'].tolist(), page['retweets'].tolist(),
+                page['likes'].tolist(), page['text_length'].tolist(), page['date_ms'].tolist()):
+            yield Row(f'{id_prefix}{tweet_id}', f'user{user}', retweets, likes, TEXTS[length],
+                      EPOCH + timedelta(milliseconds=date_ms))
+
+
+def load_sqlite(path, rows, seed=42, users=USERS, now=None, span=SPAN, id_prefix='t'):
+    """Insert synthetic tweets into a SQLite tweets table; returns the source"""
+    source = SQLiteSource(path)
+    source.insert((row.tweet_id, row.user, row.text, row.retweets, row.likes, row.date)
+                  for row in generate_rows(rows, seed, users, now, span, id_prefix))
+    return source
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='SQLite database to create or extend')
+    parser.add_argument('--rows', type=lambda v: int(float(v)), default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--users', type=int, default=USERS)
+    parser.add_argument('--now', type=float, default=None, help='epoch seconds the dates count back from')
+    parser.add_argument('--span', type=float, default=SPAN, help='seconds of history')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    source = load_sqlite(args.path, args.rows, args.seed, args.users, args.now, args.span)
+    total = source.conn.execute("SELECT count(*) FROM tweets").fetchone()[0]
+    print(f"Loaded {args.rows:,} tweets into {args.path} in {time.perf_counter() - started:.1f}s "
+          f"({total:,} in the table)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+# gunicorn.conf.py
+"""Production serving: several gunicorn workers and one collector process.
+
+    gunicorn -c gunicorn.conf.py twitter_exporter:app
+
+The master starts `twitter_exporter.py collect` once; it publishes each
+finished snapshot to a shared memory-mapped file that every worker serves
+from, so scrapes never wait on (or see half of) a collection cycle.
+"""
+import os
+import subprocess
+import sys
+
+from twitter_shared import default_path
+
+os.environ.setdefault('TWITTER_EXPORTER_SNAPSHOT_PATH', default_path())
+
+bind = os.environ.get('TWITTER_EXPORTER_BIND', '0.0.0.0:9123')
+workers = int(os.environ.get('TWITTER_EXPORTER_WORKERS', 4))
+worker_class = 'gthread'
+threads = int(os.environ.get('TWITTER_EXPORTER_THREADS', 4))
+keepalive = 75
+
+collector = None
+
+
+def on_starting(server):
+    global collector
+    exporter = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'twitter_exporter.py')
+    collector = subprocess.Popen([sys.executable, exporter, 'collect'], env=dict(os.environ, PYTHONUNBUFFERED='1'))
+    server.log.info("Started collector process %s", collector.pid)
+
+
+def on_exit(server):
+    if collector is not None and collector.poll() is None:
+        collector.terminate()
+        collector.wait(timeout=10)
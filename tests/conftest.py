@@ -0,0 +1,48 @@
+# conftest.py
+"""Shared fixtures: make the exporter modules importable and build seeded tweet rows."""
+import os
+import random
+import sys
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+Row = namedtuple('Row', 'tweet_id user retweets likes text date')
+
+EPOCH = datetime(1970, 1, 1)
+NOW = 1792300000.0  # fixed clock, so window edges fall in the same place every run
+
+
+def _make_rows(n, seed=1, now=NOW, users=300, span=20 * 86400, missing_dates=0.01, id_prefix='t'):
+    """Seeded tweets: skewed users, heavy-tailed engagement, some rows without a date"""
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        date = None
+        if rnd.random() >= missing_dates:
+            date = EPOCH + timedelta(milliseconds=int((now - rnd.uniform(0, span)) * 1000))
+        retweets = int(rnd.paretovariate(0.8)) - 1 if rnd.random() > 0.2 else 0
+        likes = int(rnd.paretovariate(0.7) * 3) - 3 if rnd.random() > 0.1 else 0
+        rows.append(Row(f'{id_prefix}{i}', f'u{int(rnd.paretovariate(1.2)) % users}', retweets, likes,
+                        'x' * rnd.randint(0, 320), date))
+    return rows
+
+
+@pytest.fixture
+def now():
+    return NOW
+
+
+@pytest.fixture
+def make_rows():
+    return _make_rows
+
+
+@pytest.fixture
+def rows():
+    return _make_rows(5000)
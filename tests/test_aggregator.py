@@ -0,0 +1,255 @@
+# test_aggregator.py
+"""TweetAggregator / collect_metrics against the per-query implementation they replaced.
+
+per_query_metrics() restates every query the original update_metrics() ran
+(COUNT/SUM/AVG/PERCENTILE_CONT/STDDEV, BETWEEN buckets, windows on `date >
+now - Nh`, GROUP BY user ... ORDER BY tweet_count DESC LIMIT 10) over plain
+Python rows, so the single-pass results must match it name for name.
+"""
+import math
+import random
+import statistics
+from collections import Counter
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from twitter_aggregator import PERCENTILES, TIME_WINDOWS, TweetAggregator, WindowIndex, collect_metrics
+from twitter_source import SQLiteSource
+
+HOUR_MS = 3600 * 1000
+EPOCH = datetime(1970, 1, 1)
+
+
+def _ms(date):
+    return None if date is None else (date - EPOCH) // timedelta(milliseconds=1)
+
+
+def _from_ms(ms):
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+def percentile_cont(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = fraction * (len(values) - 1)
+    lo, hi = math.floor(rank), math.ceil(rank)
+    return float(values[lo] + (rank - lo) * (values[hi] - values[lo]))
+
+
+def count_where(values, low, high=None):
+    return sum(1 for v in values if v >= low and (high is None or v <= high))
+
+
+def per_query_metrics(rows, now):
+    """The metrics the original per-query update_metrics() produced for these rows"""
+    m = {}
+    n = len(rows)
+    now_ms = int(now * 1000)
+    retweets = [r.retweets for r in rows]
+    likes = [r.likes for r in rows]
+    lengths = [len(r.text) for r in rows]
+    dates = [_ms(r.date) for r in rows]
+
+    m['twitter_tweets_total'] = n
+    m.update({
+        'twitter_total_retweets': sum(retweets),
+        'twitter_total_likes': sum(likes),
+        'twitter_avg_retweets': sum(retweets) / n if n else 0.0,
+        'twitter_avg_likes': sum(likes) / n if n else 0.0,
+        'twitter_max_retweets': max(retweets, default=0),
+        'twitter_max_likes': max(likes, default=0),
+        'twitter_min_retweets': min(retweets, default=0),
+        'twitter_min_likes': min(likes, default=0),
+        'twitter_median_retweets': percentile_cont(retweets, 0.5),
+        'twitter_median_likes': percentile_cont(likes, 0.5),
+        'twitter_stddev_retweets': statistics.stdev(retweets) if n > 1 else 0.0,
+        'twitter_stddev_likes': statistics.stdev(likes) if n > 1 else 0.0,
+    })
+
+    for name, low, high in [('0', 0, 0), ('1_10', 1, 10), ('11_50', 11, 50), ('51_100', 51, 100),
+                            ('101_500', 101, 500), ('501_1000', 501, 1000), ('1000plus', 1001, None)]:
+        m[f'twitter_retweets_{name}'] = count_where(retweets, low, high)
+    for name, low, high in [('0', 0, 0), ('1_20', 1, 20), ('21_100', 21, 100), ('101_500', 101, 500),
+                            ('501_2000', 501, 2000), ('2001_10000', 2001, 10000), ('10000plus', 10001, None)]:
+        m[f'twitter_likes_{name}'] = count_where(likes, low, high)
+    for name, low, high in [('0_50', 0, 50), ('51_100', 51, 100), ('101_150', 101, 150), ('151_200', 151, 200),
+                            ('201_280', 201, 280), ('281plus', 281, None)]:
+        m[f'twitter_text_length_{name}'] = count_where(lengths, low, high)
+
+    tweets_by_user = Counter(r.user for r in rows)
+    for name, low, high in [('1_tweet', 1, 1), ('2_5_tweets', 2, 5), ('6_20_tweets', 6, 20),
+                            ('21_100_tweets', 21, 100), ('100plus_tweets', 101, None)]:
+        m[f'twitter_users_{name}'] = count_where(tweets_by_user.values(), low, high)
+
+    engagement = [r.retweets + r.likes for r in rows]
+    for name, low, high in [('0_10', 0, 10), ('11_50', 11, 50), ('51_200', 51, 200), ('201_1000', 201, 1000),
+                            ('1001_5000', 1001, 5000), ('5001plus', 5001, None)]:
+        m[f'twitter_engagement_{name}'] = count_where(engagement, low, high)
+
+    week = [d for d in dates if d is not None and d > now_ms - 168 * HOUR_MS]
+    for hour in range(24):
+        m[f'twitter_hour_{hour:02d}_tweets'] = sum(1 for d in week if d % (24 * HOUR_MS) // HOUR_MS == hour)
+
+    m['twitter_total_users'] = len(tweets_by_user)
+    for label, hours in TIME_WINDOWS:
+        cutoff = now_ms - hours * HOUR_MS
+        m[f'twitter_active_users_{label}'] = len({r.user for r, d in zip(rows, dates) if d is not None and d > cutoff})
+    for label, hours in TIME_WINDOWS:
+        cutoff = now_ms - hours * HOUR_MS
+        m[f'twitter_tweets_last_{label}'] = sum(1 for d in dates if d is not None and d > cutoff)
+    m['twitter_tweets_per_hour'] = m['twitter_tweets_last_1h']
+
+    if n > 0:
+        m.update({
+            'twitter_engagement_ratio': (m['twitter_total_retweets'] + m['twitter_total_likes']) / n,
+            'twitter_retweet_ratio': m['twitter_total_retweets'] / n,
+            'twitter_like_ratio': m['twitter_total_likes'] / n,
+            'twitter_virality_score': m['twitter_max_retweets'] / max(m['twitter_avg_retweets'], 1),
+        })
+
+    # ORDER BY tweet_count DESC LIMIT 10; the aggregator breaks ties by user name
+    for i, user in enumerate(sorted(tweets_by_user, key=lambda u: (-tweets_by_user[u], u))[:10]):
+        own = [r for r in rows if r.user == user]
+        m[f'twitter_top_user_{i+1}_tweets'] = len(own)
+        m[f'twitter_top_user_{i+1}_name_tweets'] = len(own)
+        m[f'twitter_top_user_{i+1}_avg_retweets'] = sum(r.retweets for r in own) / len(own)
+        m[f'twitter_top_user_{i+1}_avg_likes'] = sum(r.likes for r in own) / len(own)
+
+    for p in PERCENTILES:
+        m[f'twitter_retweets_p{p}'] = percentile_cont([v for v in retweets if v > 0], p / 100)
+        m[f'twitter_likes_p{p}'] = percentile_cont([v for v in likes if v > 0], p / 100)
+
+    m.update({
+        'twitter_avg_text_length': sum(lengths) / n if n else 0.0,
+        'twitter_max_text_length': max(lengths, default=0),
+        'twitter_min_text_length': min(lengths, default=0),
+    })
+    m['twitter_high_engagement_tweets'] = sum(1 for r in rows if r.retweets > 100 or r.likes > 500)
+    m['twitter_viral_tweets'] = sum(1 for r in rows if r.retweets > 1000)
+
+    if tweets_by_user:
+        users = len(tweets_by_user)
+        m.update({
+            'twitter_tweets_per_user': n / users,
+            'twitter_retweets_per_user': m['twitter_total_retweets'] / users,
+            'twitter_likes_per_user': m['twitter_total_likes'] / users,
+        })
+    return m
+
+
+def assert_same_metrics(got, expected):
+    assert set(got) == set(expected)
+    for name, value in expected.items():
+        assert got[name] == pytest.approx(value, rel=1e-9, abs=1e-9), name
+        assert isinstance(got[name], float) == isinstance(value, float), name
+
+
+@pytest.mark.parametrize('batch_size', [1, 777, 5000])
+def test_matches_per_query_metrics(rows, now, batch_size):
+    got = TweetAggregator(now=now).add_rows(rows, batch_size=batch_size).metrics()
+    assert_same_metrics(got, per_query_metrics(rows, now))
+
+
+def test_empty_table(now):
+    got = TweetAggregator(now=now).add_rows([]).metrics()
+    assert_same_metrics(got, per_query_metrics([], now))
+    assert 'twitter_engagement_ratio' not in got
+    assert 'twitter_top_user_1_tweets' not in got
+
+
+def test_single_row(make_rows, now):
+    rows = make_rows(1, missing_dates=0)
+    got = TweetAggregator(now=now).add_rows(rows).metrics()
+    assert_same_metrics(got, per_query_metrics(rows, now))
+    assert got['twitter_stddev_retweets'] == 0.0
+
+
+def test_missing_dates_count_everywhere_but_the_windows(make_rows, now):
+    rows = make_rows(2000, seed=3, missing_dates=0.5)
+    got = TweetAggregator(now=now).add_rows(rows).metrics()
+    assert_same_metrics(got, per_query_metrics(rows, now))
+    undated = [r._replace(date=None) for r in rows]
+    got = TweetAggregator(now=now).add_rows(undated).metrics()
+    assert got['twitter_tweets_total'] == len(rows)
+    assert got['twitter_tweets_last_7d'] == got['twitter_active_users_7d'] == 0
+    assert sum(got[f'twitter_hour_{hour:02d}_tweets'] for hour in range(24)) == 0
+
+
+def test_window_edges_are_exclusive(make_rows, now):
+    # `date > now - Nh`: a tweet exactly on the edge is outside the window
+    row = make_rows(1, missing_dates=0)[0]
+    on_edge = row._replace(date=_from_ms(int(now * 1000) - HOUR_MS))
+    inside = row._replace(tweet_id='inside', user='other', date=_from_ms(int(now * 1000) - HOUR_MS + 1))
+    got = TweetAggregator(now=now).add_rows([on_edge, inside]).metrics()
+    assert got['twitter_tweets_last_1h'] == got['twitter_active_users_1h'] == 1
+    assert got['twitter_tweets_last_6h'] == got['twitter_active_users_6h'] == 2
+
+
+def test_top_user_ties_are_broken_by_name(make_rows, now):
+    # 15 users with 3 tweets each, one with 4: rank 1 is clear, ranks 2-10 are ties
+    base = make_rows(1, missing_dates=0)[0]
+    rows = [base._replace(tweet_id=f'{user}-{i}', user=user, retweets=i, likes=2 * i)
+            for user in [f'user{j:02d}' for j in range(15)] for i in range(3)]
+    rows += [base._replace(tweet_id='extra', user='user14')]
+    expected = per_query_metrics(rows, now)
+    for seed in range(5):
+        shuffled = rows[:]
+        random.Random(seed).shuffle(shuffled)
+        got = TweetAggregator(now=now).add_rows(shuffled, batch_size=4).metrics()
+        assert_same_metrics(got, expected)
+    assert expected['twitter_top_user_1_tweets'] == 4
+    assert [expected[f'twitter_top_user_{i}_tweets'] for i in range(2, 11)] == [3] * 9
+
+
+def test_merged_shards_match_one_pass(rows, now):
+    whole = TweetAggregator(now=now).add_rows(rows).metrics()
+    merged = TweetAggregator(now=now)
+    for start in range(0, len(rows), 1300):
+        merged.merge(TweetAggregator(now=now).add_rows(rows[start:start + 1300]))
+    assert_same_metrics(merged.metrics(), whole)
+
+
+def test_collect_metrics_reads_one_scan(rows, now):
+    source = SQLiteSource()
+    source.insert((r.tweet_id, r.user, r.text, r.retweets, r.likes, r.date) for r in rows)
+    assert_same_metrics(collect_metrics(source, now=now), per_query_metrics(rows, now))
+    assert source.queries == 1
+
+
+@pytest.mark.parametrize('tail_limit', [8, 1 << 16])
+def test_window_index_matches_brute_force(monkeypatch, tail_limit):
+    monkeypatch.setattr(WindowIndex, 'TAIL_LIMIT', tail_limit)
+    rng = np.random.default_rng(5)
+    floor = 0
+    index, expected = WindowIndex(floor), []
+    for step in range(200):
+        values = rng.integers(floor - 1000, floor + 50 * HOUR_MS, rng.integers(0, 20))
+        index.add(values)
+        expected.extend(int(v) for v in values if v > floor)
+        if expected and step % 3 == 0:
+            gone = rng.choice(expected, min(len(expected), 3), replace=False)
+            index.remove(gone)
+            for value in gone.tolist():
+                expected.remove(value)
+        if step % 10 == 0:
+            floor += int(rng.integers(0, HOUR_MS))
+            index.expire(floor)
+            expected = [v for v in expected if v > floor]
+        cutoff = floor + int(rng.integers(0, 50 * HOUR_MS))
+        assert index.count_after(cutoff) == sum(1 for v in expected if v > cutoff)
+        assert index.hour_counts().tolist() == np.bincount([v % (24 * HOUR_MS) // HOUR_MS for v in expected],
+                                                           minlength=24).tolist()
+
+
+def test_advancing_clock_matches_a_fresh_aggregator(monkeypatch, rows, now):
+    # Incremental collection folds pages in under an advancing clock; the
+    # windows must expire exactly as if everything had been read at the end
+    monkeypatch.setattr(WindowIndex, 'TAIL_LIMIT', 64)
+    aggregator = TweetAggregator(now=now - 10 * 86400)
+    for i, start in enumerate(range(0, len(rows), 500)):
+        aggregator.advance(now - 10 * 86400 + i * 86400).add_rows(rows[start:start + 500], batch_size=97)
+        aggregator.metrics()
+    assert_same_metrics(aggregator.advance(now).metrics(), per_query_metrics(rows, now))
@@ -0,0 +1,273 @@
+# test_collectors.py
+"""Every collection mode against SQLiteSource, checked against the per-query metrics.
+
+Each test loads seeded rows into a SQLite tweets table, runs a collector
+over it (adding rows between cycles where the mode keeps state) and
+compares the result with per_query_metrics() over the rows the table holds.
+"""
+from datetime import timedelta
+
+import pytest
+
+from test_aggregator import _ms, assert_same_metrics, per_query_metrics
+from twitter_cdc import EventCollector, parse_body
+from twitter_columnar import ColumnarCollector
+from twitter_incremental import IncrementalCollector
+from twitter_source import CassandraSource, SQLiteSource
+from twitter_targets import ShardedCollector, Target
+
+
+def insert(source, rows):
+    source.insert((r.tweet_id, r.user, r.text, r.retweets, r.likes, r.date) for r in rows)
+
+
+def event(row):
+    return {'tweet_id': row.tweet_id, 'user': row.user, 'retweets': row.retweets, 'likes': row.likes,
+            'text': row.text, 'date': _ms(row.date)}
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = SQLiteSource(str(tmp_path / 'tweets.sqlite'))
+    yield source
+    source.close()
+
+
+@pytest.fixture
+def batches(make_rows, now):
+    """Rows of a first cycle, rows tied on its watermark date and rows written after it"""
+    first = make_rows(2000, seed=1, now=now - 3600)
+    watermark = max(r.date for r in first if r.date is not None)
+    first += [first[0]._replace(tweet_id='first-tie', date=watermark)]
+    ties = [r._replace(tweet_id=f'tie{i}', date=watermark) for i, r in enumerate(first[1:6])]
+    later = make_rows(500, seed=2, now=now, span=3000, missing_dates=0, id_prefix='n')
+    return first, ties, later
+
+
+STATEFUL = {
+    'incremental': lambda path: IncrementalCollector(str(path / 'incremental.pkl'), save_interval=0),
+    'columnar': lambda path: ColumnarCollector(str(path / 'columns')),
+    'cdc': lambda path: EventCollector(str(path / 'events.pkl')),
+}
+
+
+@pytest.mark.parametrize('mode', sorted(STATEFUL))
+def test_catch_up_counts_rows_tied_on_the_watermark_once(mode, source, batches, now, tmp_path):
+    first, ties, later = batches
+    insert(source, first)
+    collector = STATEFUL[mode](tmp_path)
+    collector.collect(source, now=now)
+    assert collector.last_mode == 'full'
+
+    insert(source, ties + later)
+    got = collector.collect(source, now=now, full=False)
+    assert collector.last_mode == 'incremental'
+    assert collector.last_rows == len(ties) + len(later)
+    assert_same_metrics(got, per_query_metrics(first + ties + later, now))
+
+    # Nothing new: the rows on the (new) watermark are read again but not counted
+    got = collector.collect(source, now=now + 60, full=False)
+    assert collector.last_rows == 0
+    assert_same_metrics(got, per_query_metrics(first + ties + later, now + 60))
+
+    # A restart resumes from the saved state
+    restarted = STATEFUL[mode](tmp_path)
+    got = restarted.collect(source, now=now + 60, full=False)
+    assert restarted.last_mode == 'incremental'
+    assert_same_metrics(got, per_query_metrics(first + ties + later, now + 60))
+
+
+@pytest.mark.parametrize('mode', sorted(STATEFUL))
+def test_reconciliation_picks_up_edits_and_late_rows(mode, source, batches, now, tmp_path):
+    first, ties, later = batches
+    insert(source, first)
+    collector = STATEFUL[mode](tmp_path)
+    collector.collect(source, now=now)
+
+    edited = [r._replace(retweets=r.retweets + 7) for r in first[:50]]
+    late = [r._replace(tweet_id=f'late{i}', date=r.date - timedelta(days=1)) for i, r in enumerate(later[:20])]
+    insert(source, edited + late)
+    expected = per_query_metrics(edited + first[50:] + late, now)
+    assert collector.collect(source, now=now, full=False) != expected  # missed by a catch-up
+    assert_same_metrics(collector.collect(source, now=now, full=True), expected)
+
+
+def test_incremental_saves_on_an_interval(source, batches, now, tmp_path):
+    first, ties, later = batches
+    insert(source, first)
+    path = tmp_path / 'incremental.pkl'
+    collector = IncrementalCollector(str(path), save_interval=300)
+    collector.collect(source, now=now)
+    saved = path.read_bytes()
+    insert(source, later[:100])
+    collector.collect(source, now=now + 60, full=False)
+    assert path.read_bytes() == saved
+    insert(source, later[100:])
+    got = collector.collect(source, now=now + 300, full=False)
+    assert path.read_bytes() != saved
+    # Restarting from an older save reads the rows after its watermark again
+    restarted = IncrementalCollector(str(path), save_interval=300)
+    assert_same_metrics(restarted.collect(source, now=now + 300, full=False), got)
+
+
+@pytest.mark.parametrize('shards', [1, 3])
+def test_sharded_collector_matches_one_scan(shards, source, rows, now):
+    insert(source, rows)
+    target = Target('local', (source.path,), 0, 'twitter', 'tweets')
+    collector = ShardedCollector([target], backend='sqlite', workers=2, pool='thread', shards=shards)
+    try:
+        results = collector.collect(now=now)
+    finally:
+        collector.close()
+    assert not collector.failures
+    assert collector.queries == shards
+    assert_same_metrics(results[target], per_query_metrics(rows, now))
+
+
+# ===== CDC =====
+
+class RacingSource(object):
+    """A source whose next full scan runs `during_scan` after its first row"""
+
+    def __init__(self, source):
+        self.source = source
+        self.during_scan = None
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def scan(self, columns, where='', params=(), ranges=None):
+        rows = self.source.scan(columns, where, params, ranges)
+        callback, self.during_scan = self.during_scan, None
+        for i, row in enumerate(rows):
+            if i == 1 and callback is not None:
+                callback()
+            yield row
+
+
+def test_events_racing_a_reconciliation_count_once(source, make_rows, now, tmp_path):
+    old = make_rows(1000, seed=4, now=now - 3600)
+    recent = make_rows(6, seed=5, now=now, span=60, missing_dates=0, id_prefix='e')
+    lagging, written_during, queued_during, duplicate = recent[0], recent[1:3], recent[3:5], recent[5]
+    insert(source, old)
+    racing = RacingSource(source)
+    collector = EventCollector(str(tmp_path / 'events.pkl'))
+    collector.collect(racing, now=now)
+
+    # Applied before the scan, but the row is not readable yet (replica lag)
+    collector.offer([event(lagging), event(duplicate)])
+    insert(source, [duplicate])
+    collector.apply(now=now)
+
+    # Events arriving while the scan runs: two whose rows it reads, two whose rows are not written yet
+    insert(source, written_during)
+    racing.during_scan = lambda: collector.offer([event(row) for row in written_during + queued_during])
+    collector.collect(racing, now=now, full=True)
+    got = collector.apply(now=now)
+    assert_same_metrics(got, per_query_metrics(old + recent, now))
+
+    # The lagging row shows up in the table, and its event is delivered again
+    insert(source, [lagging] + queued_during)
+    collector.offer([event(lagging)])
+    assert_same_metrics(collector.apply(now=now), per_query_metrics(old + recent, now))
+    assert_same_metrics(collector.collect(racing, now=now, full=True), per_query_metrics(old + recent, now))
+
+
+def test_events_applied_as_the_clock_advances_and_saved_on_an_interval(source, make_rows, now, tmp_path):
+    old = make_rows(1000, seed=6, now=now)
+    events = sorted(make_rows(300, seed=7, now=now + 900, span=900, missing_dates=0, id_prefix='e'),
+                    key=lambda row: row.date)
+    insert(source, old)
+    path = tmp_path / 'events.pkl'
+    collector = EventCollector(str(path), save_interval=300)
+    collector.collect(source, now=now)
+    saved, saved_at = path.read_bytes(), now
+
+    for start in range(0, len(events), 30):
+        chunk = events[start:start + 30]
+        clock = _ms(chunk[-1].date) / 1000 + 1
+        collector.offer([event(row) for row in chunk])
+        got = collector.apply(now=clock)
+        assert_same_metrics(got, per_query_metrics(old + events[:start + 30], clock))
+        if clock - saved_at >= 300:
+            assert path.read_bytes() != saved
+            saved, saved_at = path.read_bytes(), clock
+        else:
+            assert path.read_bytes() == saved
+
+    # Restarting from the last save: the rows applied since are read by the catch-up scan
+    insert(source, events)
+    restarted = EventCollector(str(path), save_interval=300)
+    assert_same_metrics(restarted.collect(source, now=clock, full=False), got)
+
+
+def test_events_that_do_not_fit_the_columns_are_rejected(source, make_rows, now, tmp_path):
+    rows = make_rows(100, seed=8, now=now)
+    insert(source, rows)
+    collector = EventCollector(str(tmp_path / 'events.pkl'))
+    collector.collect(source, now=now)
+    fine = make_rows(1, seed=9, now=now, span=60, missing_dates=0, id_prefix='e')
+    body = '\n'.join(['{"tweet_id": "a", "retweets": 1e400}', '{"tweet_id": "b", "likes": -1e400}',
+                       '{"tweet_id": "c", "retweets": 1e30}', '{"tweet_id": "d", "date": 1e300}',
+                       '{"tweet_id": "e", "retweets": "many"}', 'not json'])
+    events, invalid = parse_body(body.encode('utf-8'))
+    counts = collector.offer(events + [event(fine[0])], invalid)
+    assert (counts['rejected'], counts['accepted']) == (6, 1)
+    assert_same_metrics(collector.apply(now=now), per_query_metrics(rows + fine, now))
+
+
+# ===== FAN-OUT =====
+
+class FakeFuture(object):
+    def __init__(self, session, params):
+        self.session = session
+        self.params = params
+        self.cancelled = False
+
+    def result(self):
+        self.session.in_flight -= 1
+        return [('row', self.params)]
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeSession(object):
+    """Counts the requests submitted and not yet collected"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.futures = []
+
+    def prepare(self, query):
+        return query
+
+    def execute_async(self, statement, params):
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        future = FakeFuture(self, params)
+        self.futures.append(future)
+        return future
+
+
+@pytest.mark.parametrize('max_in_flight', [1, 3, 8])
+def test_fan_out_keeps_at_most_max_in_flight_requests(max_in_flight):
+    source = CassandraSource(['unused'], 'twitter', max_in_flight=max_in_flight)
+    session = source._session = FakeSession()
+    param_sets = [(i,) for i in range(20)]
+    got = list(source.fan_out('SELECT', param_sets))
+    assert got == [('row', params) for params in param_sets]
+    assert session.most_in_flight == max_in_flight
+    assert session.in_flight == 0
+    assert source.queries == len(param_sets)
+
+
+def test_fan_out_cancels_outstanding_requests_when_abandoned():
+    source = CassandraSource(['unused'], 'twitter', max_in_flight=4)
+    session = source._session = FakeSession()
+    rows = source.fan_out('SELECT', [(i,) for i in range(20)])
+    next(rows)
+    rows.close()
+    assert len(session.futures) == 5
+    assert [future.cancelled for future in session.futures] == [False] + [True] * 4
@@ -0,0 +1,294 @@
+# test_push.py
+"""Pusher against an in-process receiver that decodes what it is sent.
+
+The receiver answers each request with the next status of a script (200
+once the script runs out), records every request and, for remote write,
+undoes the snappy compression and the WriteRequest protobuf with the small
+decoders below so labels, values and timestamps can be compared.
+"""
+import base64
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import twitter_push
+from twitter_instrumentation import CollectorStats
+from twitter_push import PUSHGATEWAY, REMOTE_WRITE, Pusher, snappy_compress
+from twitter_snapshot import Snapshot
+
+CREATED = 1792300000.123
+METRICS = {'twitter_tweets_total': 120, 'twitter_total_retweets': 4500, 'twitter_avg_retweets': 37.5,
+           'twitter_hour_07_tweets': 12, 'twitter_retweets_p90': 80.0}
+
+
+# ===== DECODING =====
+
+def varint(data, i):
+    value = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, i
+
+
+def snappy_decompress(data):
+    """Raw snappy block format, as the remote-write spec requires"""
+    length, i = varint(data, 0)
+    out = bytearray()
+    while i < len(data):
+        tag = data[i]
+        i += 1
+        kind = tag & 3
+        if kind == 0:
+            n = tag >> 2
+            if n >= 60:
+                extra = n - 59
+                n = int.from_bytes(data[i:i + extra], 'little')
+                i += extra
+            out += data[i:i + n + 1]
+            i += n + 1
+            continue
+        if kind == 1:
+            n, offset = ((tag >> 2) & 7) + 4, (tag >> 5) << 8 | data[i]
+            i += 1
+        else:
+            size = 2 if kind == 2 else 4
+            n, offset = (tag >> 2) + 1, int.from_bytes(data[i:i + size], 'little')
+            i += size
+        assert 0 < offset <= len(out)
+        for _ in range(n):
+            out.append(out[-offset])
+    assert len(out) == length
+    return bytes(out)
+
+
+def fields(data):
+    """(field number, value) of a protobuf message: ints, doubles (wire type 1) or bytes"""
+    i = 0
+    while i < len(data):
+        key, i = varint(data, i)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, i = varint(data, i)
+        elif wire_type == 1:
+            value = struct.unpack('<d', data[i:i + 8])[0]
+            i += 8
+        else:
+            n, i = varint(data, i)
+            value, i = data[i:i + n], i + n
+        yield key >> 3, value
+
+
+def decode_write_request(body):
+    """[(labels as (name, value) pairs, [(value, timestamp ms)])] of a snappy WriteRequest"""
+    series = []
+    for _, timeseries in fields(snappy_decompress(body)):
+        labels, samples = [], []
+        for number, value in fields(timeseries):
+            if number == 1:
+                label = dict(fields(value))
+                labels.append((label[1].decode('utf-8'), label[2].decode('utf-8')))
+            else:
+                sample = dict(fields(value))
+                samples.append((sample[1], sample[2]))
+        series.append((labels, samples))
+    return series
+
+
+# ===== RECEIVER =====
+
+class Receiver(object):
+    def __init__(self):
+        self.statuses = []  # answers for the next requests, then 200
+        self.requests = []  # (method, path, headers, body, monotonic time)
+        self.lock = threading.Lock()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with receiver.lock:
+                    receiver.requests.append((self.command, self.path, dict(self.headers), body, time.monotonic()))
+                    status = receiver.statuses.pop(0) if receiver.statuses else 200
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_PUT = do_POST
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def receiver():
+    receiver = Receiver()
+    yield receiver
+    receiver.close()
+
+
+@pytest.fixture
+def stats():
+    return CollectorStats()
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(twitter_push, 'MIN_BACKOFF', 0.05)
+
+
+def dropped(stats, reason):
+    return stats.push_dropped.samples[(reason,)]
+
+
+def settle(pusher):
+    """Wait out the request in flight, so a batch displaced meanwhile is counted as failed"""
+    with pusher._cond:
+        assert pusher._cond.wait_for(lambda: pusher._sending is None, 10)
+
+
+# ===== TESTS =====
+
+def test_snappy_round_trip():
+    rnd = random.Random(3)
+    for data in [b'', b'a', b'abcd' * 10, bytes(rnd.getrandbits(8) for _ in range(70000)),
+                 b'twitter_retweets_bucket{le="10"} 5\n' * 5000, b'x' * 200000]:
+        assert snappy_decompress(snappy_compress(data)) == data
+
+
+def test_remote_write_sends_labelled_timestamped_batches(receiver, stats):
+    pusher = Pusher(receiver.url + '/api/v1/write', REMOTE_WRITE, instance='host:9123', batch_size=7, stats=stats)
+    snapshot = Snapshot(METRICS, 1, created=CREATED)
+    try:
+        pusher.push(snapshot)
+        assert pusher.flush(10)
+    finally:
+        pusher.close()
+
+    expected = {}
+    for name, labelnames, labelvalues, value in snapshot.registry.samples():
+        labels = [('__name__', name), ('instance', 'host:9123'), ('job', 'twitter-exporter')]
+        expected[tuple(sorted(labels + list(zip(labelnames, labelvalues))))] = value
+    got = {}
+    for method, path, headers, body, _ in receiver.requests:
+        assert (method, path) == ('POST', '/api/v1/write')
+        assert headers['Content-Encoding'] == 'snappy'
+        assert headers['Content-Type'] == 'application/x-protobuf'
+        assert headers['X-Prometheus-Remote-Write-Version'] == '0.1.0'
+        series = decode_write_request(body)
+        assert len(series) <= 7
+        for labels, samples in series:
+            assert labels == sorted(labels)
+            assert [timestamp for _, timestamp in samples] == [int(CREATED * 1000)]
+            got[tuple(labels)] = samples[0][0]
+    assert got == expected
+    assert len(receiver.requests) == -(-len(expected) // 7)
+    assert stats.push_samples.samples[()] == len(expected)
+
+
+@pytest.mark.parametrize('status', [503, 429])
+def test_retries_with_backoff_until_accepted(receiver, stats, fast_backoff, status):
+    receiver.statuses = [status, status, status]
+    pusher = Pusher(receiver.url, REMOTE_WRITE, stats=stats)
+    try:
+        pusher.push(Snapshot(METRICS, 1, created=CREATED))
+        assert pusher.flush(10)
+    finally:
+        pusher.close()
+    bodies = [request[3] for request in receiver.requests]
+    assert len(bodies) == 4 and len(set(bodies)) == 1
+    gaps = [b[4] - a[4] for a, b in zip(receiver.requests, receiver.requests[1:])]
+    for gap, backoff in zip(gaps, [0.05, 0.1, 0.2]):
+        assert gap >= backoff * 0.9
+    assert stats.push_requests.samples[('failure',)] == 3
+    assert stats.push_requests.samples[('success',)] == 1
+    assert sum(stats.push_dropped.samples.values()) == 0
+
+
+def test_client_errors_drop_the_batch(receiver, stats, fast_backoff):
+    receiver.statuses = [400]
+    pusher = Pusher(receiver.url, REMOTE_WRITE, stats=stats)
+    first, second = Snapshot(METRICS, 1, created=CREATED), Snapshot(METRICS, 2, created=CREATED + 15)
+    try:
+        pusher.push(first)
+        assert pusher.flush(10)
+        pusher.push(second)
+        assert pusher.flush(10)
+    finally:
+        pusher.close()
+    timestamps = [decode_write_request(request[3])[0][1][0][1] for request in receiver.requests]
+    assert timestamps == [int(CREATED * 1000), int((CREATED + 15) * 1000)]  # the 400 was not retried
+    assert dropped(stats, 'rejected') == 1
+    assert pusher.failures == 0
+
+
+def test_overflow_drops_the_oldest_batch(receiver, stats, fast_backoff):
+    receiver.statuses = [503] * 1000
+    pusher = Pusher(receiver.url, REMOTE_WRITE, max_queue=2, stats=stats)
+    try:
+        for version in range(5):
+            pusher.push(Snapshot(METRICS, version, created=CREATED + version))
+        settle(pusher)
+        receiver.statuses = []
+        assert pusher.flush(10)
+    finally:
+        pusher.close()
+    delivered = [decode_write_request(request[3])[0][1][0][1] for request in receiver.requests[-2:]]
+    assert delivered == [int((CREATED + 3) * 1000), int((CREATED + 4) * 1000)]
+    assert dropped(stats, 'overflow') == 3
+
+
+@pytest.mark.parametrize('instance, group', [
+    ('', '/metrics/job/twitter-exporter'),
+    ('host:9123', '/metrics/job/twitter-exporter/instance/host%3A9123'),
+    ('10.0.0.1/east', '/metrics/job/twitter-exporter/instance@base64/'
+                      + base64.urlsafe_b64encode(b'10.0.0.1/east').decode('ascii')),
+])
+def test_pushgateway_puts_the_text_exposition(receiver, stats, instance, group):
+    pusher = Pusher(receiver.url + '/gateway/', PUSHGATEWAY, instance=instance, stats=stats)
+    snapshot = Snapshot(METRICS, 1, created=CREATED)
+    try:
+        pusher.push(snapshot)
+        assert pusher.flush(10)
+    finally:
+        pusher.close()
+    [(method, path, headers, body, _)] = receiver.requests
+    assert (method, path) == ('PUT', '/gateway' + group)
+    assert headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    assert body == snapshot.body('metrics').content
+    assert b'twitter_tweets_total 120' in body
+
+
+def test_pushgateway_counts_replaced_snapshots_as_superseded(receiver, stats, fast_backoff):
+    receiver.statuses = [503] * 1000
+    pusher = Pusher(receiver.url, PUSHGATEWAY, stats=stats)
+    snapshots = [Snapshot(dict(METRICS, twitter_tweets_total=120 + i), i, created=CREATED + i) for i in range(3)]
+    try:
+        for snapshot in snapshots:
+            pusher.push(snapshot)
+            time.sleep(0.1)
+        settle(pusher)
+        receiver.statuses = []
+        assert pusher.flush(10)
+    finally:
+        pusher.close()
+    assert receiver.requests[-1][3] == snapshots[-1].body('metrics').content
+    assert dropped(stats, 'superseded') == 2
+    assert dropped(stats, 'overflow') == 0
@@ -0,0 +1,115 @@
+# test_registry.py
+"""build_registry() and the three expositions over metrics collected from known rows.
+
+The text and OpenMetrics bodies are read back with prometheus_client's
+parsers and the protobuf body with the decoder from test_push, so all three
+must describe the same histograms and gauges.
+"""
+import math
+
+import pytest
+from prometheus_client.openmetrics.parser import text_string_to_metric_families as parse_openmetrics
+from prometheus_client.parser import text_string_to_metric_families as parse_text
+
+from test_push import fields, varint
+from twitter_aggregator import LIKE_BUCKETS, RETWEET_BUCKETS, collect_metrics
+from twitter_registry import HISTOGRAMS, build_registry, histogram_payload
+from twitter_source import SQLiteSource
+
+
+@pytest.fixture
+def collected(rows, now, tmp_path):
+    source = SQLiteSource(str(tmp_path / 'tweets.sqlite'))
+    try:
+        source.insert((r.tweet_id, r.user, r.text, r.retweets, r.likes, r.date) for r in rows)
+        return collect_metrics(source, now=now)
+    finally:
+        source.close()
+
+
+def expected_buckets(values, buckets):
+    """(le, cumulative count) over the integer buckets, the last one +Inf"""
+    bounds = [low - 1 for _, low in buckets[1:]] + [math.inf]
+    return [(bound, sum(1 for v in values if buckets[0][1] <= v <= bound)) for bound in bounds]
+
+
+def samples(families, name):
+    return [sample for family in families for sample in family.samples if sample.name == name]
+
+
+@pytest.mark.parametrize('parse, body', [(parse_text, 'render_text'), (parse_openmetrics, 'render_openmetrics')])
+def test_text_expositions_parse(collected, rows, parse, body):
+    families = list(parse(getattr(build_registry(collected), body)().decode('utf-8')))
+    for column, buckets in (('retweets', RETWEET_BUCKETS), ('likes', LIKE_BUCKETS)):
+        values = [getattr(r, column) for r in rows]
+        got = [(float(s.labels['le']), s.value) for s in samples(families, f'twitter_{column}_bucket')]
+        assert got == expected_buckets(values, buckets)
+        assert [s.value for s in samples(families, f'twitter_{column}_sum')] == [sum(values)]
+        assert [s.value for s in samples(families, f'twitter_{column}_count')] == [len(rows)]
+        assert all(a.value <= b.value for a, b in zip(samples(families, f'twitter_{column}_bucket'),
+                                                     samples(families, f'twitter_{column}_bucket')[1:]))
+
+    hours = {s.labels['hour']: s.value for s in samples(families, 'twitter_hour_tweets')}
+    assert hours == {f'{hour:02d}': collected[f'twitter_hour_{hour:02d}_tweets'] for hour in range(24)}
+    windows = {s.labels['window']: s.value for s in samples(families, 'twitter_tweets_last')}
+    assert windows == {label: collected[f'twitter_tweets_last_{label}'] for label in ('1h', '6h', '24h', '7d')}
+    quantiles = {s.labels['quantile']: s.value for s in samples(families, 'twitter_retweets_percentile')}
+    assert quantiles['0.9'] == collected['twitter_retweets_p90']
+    assert samples(families, 'twitter_retweets_per_user')[0].value == collected['twitter_retweets_per_user']
+    assert not samples(families, 'twitter_retweets_p90')
+
+
+def test_histogram_data_keeps_only_buckets(collected):
+    payload = histogram_payload(build_registry(collected))
+    for family, _, buckets, prefix, key, _ in HISTOGRAMS:
+        assert list(payload[key]) == [name[len(prefix):] for name, _ in buckets]
+        assert list(payload[key].values()) == [collected[name] for name, _ in buckets]
+    keys = [k for distribution in payload.values() for k in distribution]
+    assert not [k for k in keys if k.startswith('p') or 'per_user' in k]
+    assert 'twitter_retweets_per_user' in collected and 'twitter_likes_p90' in collected
+
+
+def decode_families(body):
+    """{name: (type, [(labels, value or (count, sum, [(le, cumulative)]))])} of a delimited protobuf body"""
+    families, i = {}, 0
+    while i < len(body):
+        length, i = varint(body, i)
+        message = dict.fromkeys((1, 3))
+        metrics = []
+        for number, value in fields(body[i:i + length]):
+            if number == 4:
+                metrics.append(decode_metric(value))
+            else:
+                message[number] = value
+        families[message[1].decode('utf-8')] = (message[3] or 0, metrics)
+        i += length
+    return families
+
+
+def decode_metric(data):
+    labels, value = {}, None
+    for number, payload in fields(data):
+        if number == 1:
+            pair = dict(fields(payload))
+            labels[pair[1].decode('utf-8')] = pair[2].decode('utf-8')
+        elif number in (2, 3):
+            value = dict(fields(payload))[1]
+        elif number == 7:
+            histogram = list(fields(payload))
+            buckets = [(dict(fields(b))[2], dict(fields(b))[1]) for n, b in histogram if n == 3]
+            value = (dict(histogram)[1], dict(histogram)[2], buckets)
+    return labels, value
+
+
+def test_protobuf_round_trips(collected, rows):
+    families = decode_families(build_registry(collected).render_protobuf())
+    kind, [(labels, (count, total, buckets))] = families['twitter_retweets']
+    assert kind == 4 and labels == {}
+    assert (count, total) == (len(rows), sum(r.retweets for r in rows))
+    assert buckets == expected_buckets([r.retweets for r in rows], RETWEET_BUCKETS)
+
+    kind, metrics = families['twitter_active_users']
+    assert kind == 1
+    assert metrics == [({'window': label}, collected[f'twitter_active_users_{label}'])
+                       for label in ('1h', '6h', '24h', '7d')]
+    assert families['twitter_tweets_total'] == (1, [({}, collected['twitter_tweets_total'])])
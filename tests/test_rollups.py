@@ -0,0 +1,103 @@
+# test_rollups.py
+"""RollupWriter + window_metrics() against the per-query window metrics.
+
+Rollup windows take whole buckets, so a window's edge is rounded down to the
+minute (to the hour for 7d and the hour-of-day counts). On an hour-aligned
+clock every edge already sits on a bucket boundary and the results must
+match per_query_metrics() exactly; on any other clock they must match the
+same queries with the edges rounded down.
+"""
+import pytest
+
+from test_aggregator import _from_ms, _ms, per_query_metrics
+from twitter_aggregator import TIME_WINDOWS, collect_metrics
+from twitter_rollups import (DAY_MS, HOUR_MS, MINUTE_MS, RollupBuckets, RollupWriter, SQLiteRollupStore,
+                             window_metric_names, window_metrics)
+from twitter_source import SQLiteSource
+
+
+def insert(source, rows):
+    source.insert((r.tweet_id, r.user, r.text, r.retweets, r.likes, r.date) for r in rows)
+
+
+def rounded_window_metrics(rows, now_ms):
+    """per_query_metrics()' window queries with each edge rounded down to its bucket"""
+    dates = [(r.user, _ms(r.date)) for r in rows if r.date is not None]
+    out = {}
+    week = (now_ms - 7 * DAY_MS) // HOUR_MS * HOUR_MS
+    for hour in range(24):
+        out[f'twitter_hour_{hour:02d}_tweets'] = sum(1 for _, d in dates if d >= week and d % DAY_MS // HOUR_MS == hour)
+    for label, hours in TIME_WINDOWS:
+        width = MINUTE_MS if hours <= 24 else HOUR_MS
+        edge = (now_ms - hours * HOUR_MS) // width * width
+        out[f'twitter_active_users_{label}'] = len({user for user, d in dates if d >= edge})
+        out[f'twitter_tweets_last_{label}'] = sum(1 for _, d in dates if d >= edge)
+    out['twitter_tweets_per_hour'] = out['twitter_tweets_last_1h']
+    return out
+
+
+def windows_of(metrics):
+    return {name: metrics[name] for name in window_metric_names(TIME_WINDOWS)}
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = SQLiteSource(str(tmp_path / 'tweets.sqlite'))
+    yield source
+    source.close()
+
+
+def scan_and_flush(source, writer, now):
+    rollups = RollupBuckets()
+    collect_metrics(source, now=now, rollups=rollups)
+    return writer.flush(rollups, int(now * 1000))
+
+
+def test_aligned_clock_matches_per_query_metrics(source, make_rows, now):
+    now = now // 3600 * 3600
+    rows = make_rows(5000, seed=11, now=now, span=9 * 86400)
+    insert(source, rows)
+    store = SQLiteRollupStore(source)
+    assert scan_and_flush(source, RollupWriter(store), now) > 0
+    assert window_metrics(store, int(now * 1000), TIME_WINDOWS) == windows_of(per_query_metrics(rows, now))
+
+
+def test_edges_round_down_to_the_bucket(source, make_rows, now):
+    now_ms = int(now * 1000) + 37 * 1000
+    assert now_ms % MINUTE_MS and now_ms % HOUR_MS
+    rows = make_rows(5000, seed=12, now=now_ms / 1000, span=9 * 86400)
+    # Tweets on and just before each rounded edge
+    for label, hours in TIME_WINDOWS:
+        width = MINUTE_MS if hours <= 24 else HOUR_MS
+        edge = (now_ms - hours * HOUR_MS) // width * width
+        rows += [rows[0]._replace(tweet_id=f'{label}-edge', date=_from_ms(edge)),
+                 rows[1]._replace(tweet_id=f'{label}-before', user=f'{label}-before', date=_from_ms(edge - 1))]
+    insert(source, rows)
+    store = SQLiteRollupStore(source)
+    scan_and_flush(source, RollupWriter(store), now_ms / 1000)
+    got = window_metrics(store, now_ms, TIME_WINDOWS)
+    expected = rounded_window_metrics(rows, now_ms)
+    assert got == expected
+    assert got != windows_of(per_query_metrics(rows, now_ms / 1000))
+
+
+def test_writer_only_writes_changed_buckets_and_windows_follow_the_clock(source, make_rows, now):
+    first = make_rows(3000, seed=13, now=now - 600, span=2 * 86400)
+    later = make_rows(200, seed=14, now=now, span=600, missing_dates=0, id_prefix='n')
+    insert(source, first)
+    store = SQLiteRollupStore(source)
+    writer = RollupWriter(store)
+    scan_and_flush(source, writer, now)
+    assert scan_and_flush(source, writer, now) == 0
+
+    insert(source, later)
+    written = scan_and_flush(source, writer, now)
+    changed = {_ms(r.date) // MINUTE_MS for r in later} | {_ms(r.date) // HOUR_MS for r in later}
+    assert 0 < written <= len(changed)
+    now_ms = int(now * 1000)
+    assert window_metrics(store, now_ms, TIME_WINDOWS) == rounded_window_metrics(first + later, now_ms)
+
+    # No scan in between: the tables alone answer for a later clock
+    for minutes in (5, 90):
+        later_ms = now_ms + minutes * MINUTE_MS
+        assert window_metrics(store, later_ms, TIME_WINDOWS) == rounded_window_metrics(first + later, later_ms)
@@ -0,0 +1,97 @@
+# test_scheduler.py
+"""Scheduler on a fake clock: due order, overrun deferral, its cap, jitter and the reset."""
+import pytest
+
+from twitter_instrumentation import CollectorStats
+from twitter_registry import Registry
+from twitter_scheduler import Job, Scheduler
+
+
+class Clock(object):
+    """Monotonic clock that only moves when a job runs (or the test advances it)"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def job(self, durations, error=None):
+        """A job body taking the next of `durations` seconds per run"""
+        durations = iter(durations)
+
+        def run():
+            self.now += next(durations)
+            if error is not None:
+                raise error
+        return run
+
+
+class Rng(object):
+    """Replays fixed draws in [0, 1)"""
+
+    def __init__(self, *draws):
+        self.draws = list(draws)
+
+    def __call__(self):
+        return self.draws.pop(0)
+
+
+def run_once(scheduler, clock):
+    clock.now += scheduler.wait_time()
+    return scheduler.run_due()
+
+
+def test_overruns_double_the_interval_up_to_max_defer_then_reset(capsys):
+    clock = Clock()
+    job = Job('tweets', clock.job([6, 6, 6, 6, 6, 1, 6]), interval=10, budget=5)
+    scheduler = Scheduler([job], jitter=0, max_defer=8, clock=clock, rng=Rng(*[0.0] * 7))
+    gaps = []
+    for _ in range(7):
+        [(ran, error)] = run_once(scheduler, clock)
+        assert ran is job and error is None
+        gaps.append((job.defer, job.next_run - clock.now))
+    assert gaps == [(2, 20), (4, 40), (8, 80), (8, 80), (8, 80), (1, 10), (2, 20)]
+    assert 'tweets took 6.0s (budget 5s), next run in 80s' in capsys.readouterr().out
+
+
+def test_jitter_adds_a_fraction_of_the_base_interval():
+    clock = Clock()
+    job = Job('tweets', clock.job([6, 1]), interval=10, budget=5)
+    scheduler = Scheduler([job], jitter=0.2, clock=clock, rng=Rng(0.5, 0.25))
+    run_once(scheduler, clock)
+    assert job.next_run - clock.now == pytest.approx(20 + 0.5 * 0.2 * 10)  # deferred, jitter not doubled
+    run_once(scheduler, clock)
+    assert job.next_run - clock.now == pytest.approx(10 + 0.25 * 0.2 * 10)
+
+
+def test_due_jobs_run_by_priority_after_their_delay():
+    clock = Clock()
+    order = []
+    jobs = [Job('reconcile', lambda: order.append('reconcile'), 3600, priority=2, delay=30),
+            Job('rollups', lambda: order.append('rollups'), 15, priority=1),
+            Job('tweets', lambda: order.append('tweets'), 60)]
+    scheduler = Scheduler(jobs, jitter=0, clock=clock, rng=lambda: 0.0)
+    assert scheduler.wait_time() == 0
+    scheduler.run_due()
+    assert order == ['tweets', 'rollups']
+    assert scheduler.wait_time() == 15
+    clock.now += 30
+    scheduler.run_due()
+    assert order == ['tweets', 'rollups', 'rollups', 'reconcile']
+
+
+def test_failures_are_returned_and_still_rescheduled():
+    clock = Clock()
+    error = ConnectionError('no hosts')
+    job = Job('tweets', clock.job([12], error=error), interval=10)
+    stats = CollectorStats()
+    scheduler = Scheduler([job], jitter=0, clock=clock, rng=Rng(0.0), stats=stats)
+    assert run_once(scheduler, clock) == [(job, error)]
+    assert job.last_success is None
+    assert job.next_run - clock.now == 20
+    assert stats.group_health['tweets'] == [None, 20]
+    # Never refreshed: the staleness alert counts from the exporter's start, not from 1970
+    registry = Registry()
+    stats.register(registry)
+    assert registry.get('twitter_exporter_group_last_success_timestamp_seconds').get('tweets') == stats.started
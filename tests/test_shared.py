@@ -0,0 +1,71 @@
+# test_shared.py
+"""SharedSnapshot: a reader overtaken by the writer never returns a torn snapshot."""
+import pytest
+
+from twitter_shared import SharedSnapshot
+
+
+class Interrupted(Exception):
+    pass
+
+
+class Mapping(object):
+    """An mmap stand-in that runs a hook before the next big read, or stops the next big write halfway"""
+
+    def __init__(self, m):
+        self.m = m
+        self.before_read = None
+        self.interrupt_write = False
+
+    def __getitem__(self, key):
+        if self.before_read is not None and key.stop - key.start > 1024:
+            hook, self.before_read = self.before_read, None
+            hook()
+        return self.m[key]
+
+    def __setitem__(self, key, value):
+        if self.interrupt_write and len(value) > 1024:
+            self.interrupt_write = False
+            half = key.start + len(value) // 2
+            self.m[key.start:half] = value[:len(value) // 2]
+            raise Interrupted()
+        self.m[key] = value
+
+
+@pytest.fixture
+def pair(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    writer, reader = SharedSnapshot(path, slot_size=1 << 16), SharedSnapshot(path, slot_size=1 << 16)
+    writer._open(writable=True)
+    writer._map = Mapping(writer._map)
+    return writer, reader
+
+
+def test_round_trip(pair):
+    writer, reader = pair
+    assert reader.read() is None
+    for i in range(3):
+        writer.publish({'cycle': i})
+        assert reader.read() == {'cycle': i}
+    assert reader.read() is reader.read()  # unchanged version, cached
+
+
+def test_reader_overtaken_while_copying_gets_a_whole_snapshot(pair):
+    # Same-sized payloads: a copy mixing two of them would still unpickle
+    writer, reader = pair
+    first, second, third = b'a' * 4096, b'b' * 4096, b'c' * 4096
+    writer.publish(first)
+    reader._open(writable=False)
+    reader._map = Mapping(reader._map)
+
+    def overtake():
+        writer.publish(second)          # flips the header to the other slot
+        writer._map.interrupt_write = True
+        with pytest.raises(Interrupted):
+            writer.publish(third)       # half written into the slot being read
+
+    reader._map.before_read = overtake
+    assert reader.read() == second
+
+    writer.publish(third)  # a writer restarted after the interrupted publish
+    assert reader.read() == third
@@ -0,0 +1,153 @@
+# test_sketches.py
+"""Sketch mode: t-digest and HyperLogLog error at the default settings, and an
+aggregator keeping the sketches instead of its exact state.
+
+The error bounds are those the README quotes: percentiles within a rank error
+of 1% at compression 200, distinct counts within three standard errors
+(3 * 1.04 / sqrt(4096), about 5%) at precision 12. Window counts from
+sketches have their edges rounded down to the bucket, so they must lie
+between the exact count at the edge and the exact count one bucket earlier.
+"""
+import random
+
+import numpy as np
+import pytest
+
+from test_aggregator import _ms, per_query_metrics, percentile_cont
+from twitter_aggregator import PERCENTILES, TIME_WINDOWS, RunningStats, TweetAggregator
+from twitter_incremental import IncrementalCollector
+from twitter_sketches import (COARSE_BUCKET_MS, DEFAULT_BUCKET_MS, DEFAULT_COMPRESSION, DEFAULT_HLL_PRECISION,
+                              HyperLogLog, SketchConfig, TDigest, hash64)
+from twitter_source import SQLiteSource
+
+HOUR_MS = 3600 * 1000
+HLL_BOUND = 3 * 1.04 / np.sqrt(2 ** DEFAULT_HLL_PRECISION)
+
+# Close but not exact in sketch mode; every other metric must match exactly
+APPROXIMATE = ({f'twitter_{column}_p{p}' for column in ('retweets', 'likes') for p in PERCENTILES}
+               | {f'twitter_{kind}_{label}' for kind in ('active_users', 'tweets_last') for label, _ in TIME_WINDOWS}
+               | {'twitter_median_retweets', 'twitter_median_likes', 'twitter_stddev_retweets',
+                  'twitter_stddev_likes', 'twitter_tweets_per_hour'})
+
+
+def assert_rank_error(values, estimate, fraction, bound=0.01):
+    """estimate lies between the exact percentiles at fraction -/+ bound"""
+    low = percentile_cont(values, max(fraction - bound, 0))
+    high = percentile_cont(values, min(fraction + bound, 1))
+    assert low <= estimate <= high, (fraction, low, estimate, high)
+
+
+def heavy_tailed(n, seed):
+    rnd = random.Random(seed)
+    return [int(rnd.paretovariate(0.8)) for _ in range(n)]
+
+
+@pytest.mark.parametrize('pages', [1, 20])
+def test_tdigest_quantile_error(pages):
+    values = heavy_tailed(50000, seed=pages)
+    digest = TDigest(DEFAULT_COMPRESSION)
+    for page in np.array_split(np.array(values), pages):
+        part = TDigest(DEFAULT_COMPRESSION)
+        unique, counts = np.unique(page, return_counts=True)
+        part.add(unique, counts)
+        digest.merge(part)
+    assert digest.count == len(values)
+    for fraction in [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 0.999]:
+        assert_rank_error(values, digest.quantile(fraction), fraction)
+    assert digest.quantile(0) == min(values)
+    assert digest.quantile(1) == max(values)
+
+
+@pytest.mark.parametrize('distinct', [10, 1000, 20000, 200000])
+def test_hll_error(distinct):
+    hashes = np.array([hash64(f'u{i}') for i in range(distinct)], dtype=np.uint64)
+    halves = HyperLogLog(DEFAULT_HLL_PRECISION), HyperLogLog(DEFAULT_HLL_PRECISION)
+    halves[0].add_hashes(hashes[:distinct * 2 // 3])
+    halves[1].add_hashes(hashes[distinct // 3:])  # overlapping, so the union is what counts
+    halves[0].merge(halves[1])
+    assert abs(halves[0].count() - distinct) <= HLL_BOUND * distinct
+
+
+def sketched(rows, now):
+    aggregator = TweetAggregator(now=now, sketch_config=SketchConfig())
+    aggregator.add_rows(rows, batch_size=700)
+    return aggregator
+
+
+def count_after(rows, cutoff_ms):
+    return sum(1 for r in rows if r.date is not None and _ms(r.date) > cutoff_ms)
+
+
+def users_after(rows, cutoff_ms):
+    return len({r.user for r in rows if r.date is not None and _ms(r.date) > cutoff_ms})
+
+
+def test_sketch_mode_keeps_no_exact_state(rows, now):
+    aggregator = sketched(rows, now)
+    assert isinstance(aggregator.retweets, RunningStats) and isinstance(aggregator.likes, RunningStats)
+    assert aggregator.recent is None
+    assert aggregator.users.last_seen is None and aggregator.users.active is None
+    assert len(aggregator.sketches.tweets) <= 24 * 3600 * 1000 // DEFAULT_BUCKET_MS + 168
+
+
+def test_sketch_mode_matches_exact_metrics(make_rows, now):
+    rows = make_rows(20000, seed=3, span=10 * 86400)
+    got = sketched(rows, now).metrics()
+    expected = per_query_metrics(rows, now)
+    assert set(got) == set(expected)
+    for name in set(expected) - APPROXIMATE:
+        assert got[name] == pytest.approx(expected[name], rel=1e-9, abs=1e-9), name
+
+    for column in ('retweets', 'likes'):
+        values = [getattr(r, column) for r in rows]
+        assert got[f'twitter_stddev_{column}'] == pytest.approx(expected[f'twitter_stddev_{column}'], rel=1e-9)
+        assert_rank_error(values, got[f'twitter_median_{column}'], 0.5)
+        positive = [v for v in values if v > 0]
+        for p in PERCENTILES:
+            assert_rank_error(positive, got[f'twitter_{column}_p{p}'], p / 100)
+
+    now_ms = int(now * 1000)
+    for label, hours in TIME_WINDOWS:
+        cutoff = now_ms - hours * HOUR_MS
+        width = DEFAULT_BUCKET_MS if hours < 24 else COARSE_BUCKET_MS
+        assert count_after(rows, cutoff) <= got[f'twitter_tweets_last_{label}'] <= count_after(rows, cutoff - width)
+        active = got[f'twitter_active_users_{label}']
+        assert users_after(rows, cutoff) * (1 - HLL_BOUND) <= active
+        assert active <= users_after(rows, cutoff - width) * (1 + HLL_BOUND)
+
+
+def test_sketched_shards_merge(rows, now):
+    whole = sketched(rows, now).metrics()
+    merged = sketched(rows[:1000], now)
+    for start in range(1000, len(rows), 1500):
+        merged.merge(sketched(rows[start:start + 1500], now))
+    got = merged.metrics()
+    for name in set(whole) - APPROXIMATE:
+        assert got[name] == whole[name], name
+    for name in ('twitter_stddev_retweets', 'twitter_stddev_likes'):
+        assert got[name] == pytest.approx(whole[name], rel=1e-9)
+    for label, _ in TIME_WINDOWS:
+        assert got[f'twitter_tweets_last_{label}'] == whole[f'twitter_tweets_last_{label}']
+        assert got[f'twitter_active_users_{label}'] == whole[f'twitter_active_users_{label}']
+
+
+def test_incremental_state_keeps_the_sketches(make_rows, now, tmp_path):
+    source = SQLiteSource(str(tmp_path / 'tweets.sqlite'))
+    try:
+        first = make_rows(3000, seed=8, now=now - 3600)
+        later = make_rows(300, seed=9, now=now, span=3000, missing_dates=0, id_prefix='n')
+        source.insert((r.tweet_id, r.user, r.text, r.retweets, r.likes, r.date) for r in first)
+        path = str(tmp_path / 'incremental.pkl')
+        collector = IncrementalCollector(path, save_interval=0, sketch_config=SketchConfig())
+        collector.collect(source, now=now)
+        source.insert((r.tweet_id, r.user, r.text, r.retweets, r.likes, r.date) for r in later)
+        got = collector.collect(source, now=now + 60, full=False)
+        assert collector.last_rows == len(later)
+        assert got['twitter_tweets_total'] == len(first) + len(later)
+        assert got['twitter_tweets_last_1h'] >= count_after(first + later, int((now + 60) * 1000) - HOUR_MS)
+
+        restarted = IncrementalCollector(path, save_interval=0, sketch_config=SketchConfig())
+        assert restarted.collect(source, now=now + 60, full=False) == got
+        assert restarted.last_mode == 'incremental'
+    finally:
+        source.close()
@@ -0,0 +1,74 @@
+# test_snapshot.py
+"""Snapshot bodies: content negotiation, conditional requests and ETags."""
+import gzip
+import json
+
+import pytest
+
+from twitter_snapshot import PIE_CHART_COLORS, PIE_CHARTS, Body, Snapshot
+
+METRICS = {'twitter_tweets_total': 120, 'twitter_total_retweets': 4500, 'twitter_avg_retweets': 37.5,
+           'twitter_retweets_0': 30, 'twitter_retweets_1_10': 50, 'twitter_retweets_1000plus': 2}
+
+
+@pytest.fixture
+def body():
+    return Body(b'twitter_tweets_total 120\n' * 50, 'text/plain')
+
+
+@pytest.mark.parametrize('accept_encoding', ['gzip', 'gzip, deflate, br', 'br;q=1.0, gzip;q=0.8'])
+def test_gzip_only_when_accepted(body, accept_encoding):
+    content, status, headers = body.response(accept_encoding)
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(content) == body.content
+    assert len(content) < len(body.content)
+
+
+@pytest.mark.parametrize('accept_encoding', ['', 'identity', 'deflate, br'])
+def test_identity_otherwise(body, accept_encoding):
+    content, status, headers = body.response(accept_encoding)
+    assert (content, status) == (body.content, 200)
+    assert 'Content-Encoding' not in headers
+    assert headers['ETag'] == body.etag
+    assert headers['Content-Type'] == 'text/plain'
+
+
+@pytest.mark.parametrize('if_none_match', ['{etag}', 'W/"other", {etag}', '*'])
+@pytest.mark.parametrize('accept_encoding', ['', 'gzip'])
+def test_matching_etag_is_not_modified(body, if_none_match, accept_encoding):
+    content, status, headers = body.response(accept_encoding, if_none_match.format(etag=body.etag))
+    assert (content, status) == (b'', 304)
+    assert headers['ETag'] == body.etag
+    assert 'Content-Encoding' not in headers
+
+
+def test_other_etag_gets_the_body(body):
+    content, status, _ = body.response('', '"0123456789abcdef0123"')
+    assert (content, status) == (body.content, 200)
+
+
+def test_etag_follows_the_metrics():
+    first = Snapshot(METRICS, 1, created=1.0)
+    same = Snapshot(dict(METRICS), 2, created=2.0)
+    changed = Snapshot(dict(METRICS, twitter_tweets_total=121), 3, created=3.0)
+    for name, body in first.bodies.items():
+        assert same.body(name).etag == body.etag, name
+    for name in ('metrics', 'metrics_openmetrics', 'metrics_protobuf', 'metrics_json'):
+        assert changed.body(name).etag != first.body(name).etag, name
+    # A change outside a chart's histogram leaves that chart's ETag alone
+    assert changed.piechart('likes').etag == first.piechart('likes').etag
+    retweeted = Snapshot(dict(METRICS, twitter_retweets_0=31), 4, created=4.0)
+    assert retweeted.piechart('retweets').etag != first.piechart('retweets').etag
+
+
+def test_unknown_pie_chart_gets_the_empty_chart():
+    snapshot = Snapshot(METRICS, 1, created=1.0)
+    body = snapshot.piechart('nonsense')
+    assert body is snapshot.body('piechart/')
+    assert json.loads(body.content) == {'labels': [], 'values': [], 'colors': PIE_CHART_COLORS}
+    for chart_type, (_, labels) in PIE_CHARTS.items():
+        chart = json.loads(snapshot.piechart(chart_type).content)
+        assert chart['labels'] == labels
+        assert len(chart['values']) == len(labels)
+    assert json.loads(snapshot.piechart('retweets').content)['values'][:2] == [30, 50]
@@ -0,0 +1,791 @@
+# twitter_aggregator.py
+"""Single-pass aggregation of the tweets table into exporter metrics.
+
+Instead of one COUNT(*) per bucket, the exporter reads the handful of columns
+it needs once (page by page) and folds every page into an aggregator that
+fills all buckets, windows and aggregates at the same time.
+"""
+import heapq
+import time
+
+import numpy as np
+
+from twitter_sketches import SketchSet, hash64
+
+# Columns read from tweets - the only scan issued per collection cycle
+SCAN_COLUMNS = ('user', 'retweets', 'likes', 'text', 'date')
+BATCH_SIZE = 5000
+
+# ===== BUCKET DEFINITIONS =====
+# (metric name, inclusive lower bound) - a bucket runs up to the next lower
+# bound, the last one is open ended. Values below the first bound are not
+# counted, the same as the BETWEEN conditions they replace.
+RETWEET_BUCKETS = [
+    ('twitter_retweets_0', 0),
+    ('twitter_retweets_1_10', 1),
+    ('twitter_retweets_11_50', 11),
+    ('twitter_retweets_51_100', 51),
+    ('twitter_retweets_101_500', 101),
+    ('twitter_retweets_501_1000', 501),
+    ('twitter_retweets_1000plus', 1001),
+]
+
+LIKE_BUCKETS = [
+    ('twitter_likes_0', 0),
+    ('twitter_likes_1_20', 1),
+    ('twitter_likes_21_100', 21),
+    ('twitter_likes_101_500', 101),
+    ('twitter_likes_501_2000', 501),
+    ('twitter_likes_2001_10000', 2001),
+    ('twitter_likes_10000plus', 10001),
+]
+
+TEXT_LENGTH_BUCKETS = [
+    ('twitter_text_length_0_50', 0),
+    ('twitter_text_length_51_100', 51),
+    ('twitter_text_length_101_150', 101),
+    ('twitter_text_length_151_200', 151),
+    ('twitter_text_length_201_280', 201),
+    ('twitter_text_length_281plus', 281),
+]
+
+USER_ACTIVITY_BUCKETS = [
+    ('twitter_users_1_tweet', 1),
+    ('twitter_users_2_5_tweets', 2),
+    ('twitter_users_6_20_tweets', 6),
+    ('twitter_users_21_100_tweets', 21),
+    ('twitter_users_100plus_tweets', 101),
+]
+
+ENGAGEMENT_BUCKETS = [
+    ('twitter_engagement_0_10', 0),
+    ('twitter_engagement_11_50', 11),
+    ('twitter_engagement_51_200', 51),
+    ('twitter_engagement_201_1000', 201),
+    ('twitter_engagement_1001_5000', 1001),
+    ('twitter_engagement_5001plus', 5001),
+]
+
+TIME_WINDOWS = [('1h', 1), ('6h', 6), ('24h', 24), ('7d', 168)]
+PERCENTILES = [25, 50, 75, 90, 95, 99]
+TOP_USERS = 10
+
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+HOURLY_WINDOW_MS = 168 * HOUR_MS
+MISSING_MS = np.iinfo(np.int64).min  # a missing date, outside every window
+
+
+def bucket_edges(buckets):
+    """Lower bounds of a bucket definition as an array for searchsorted"""
+    return np.array([low for _, low in buckets], dtype=np.int64)
+
+
+def bucket_counts(values, edges):
+    """Count values per bucket, dropping anything below the first edge"""
+    idx = np.searchsorted(edges, values, side='right') - 1
+    return np.bincount(idx[idx >= 0], minlength=len(edges))
+
+
+def to_epoch_ms(dates):
+    """Convert a sequence of datetimes (or None) to int64 epoch milliseconds.
+
+    Missing dates become the minimum int64 so they fall outside every window.
+    """
+    arr = np.array(dates, dtype='datetime64[ms]')
+    return arr.astype(np.int64)  # NaT is already int64 min
+
+
+def percentile_cont(values, counts, fraction):
+    """PERCENTILE_CONT over a sorted value histogram (linear interpolation)"""
+    total = int(counts.sum())
+    if total == 0:
+        return 0.0
+    cumulative = np.cumsum(counts)
+    rank = fraction * (total - 1)
+    lo = int(np.floor(rank))
+    hi = int(np.ceil(rank))
+    v_lo = values[np.searchsorted(cumulative, lo, side='right')]
+    v_hi = values[np.searchsorted(cumulative, hi, side='right')]
+    return float(v_lo + (rank - lo) * (v_hi - v_lo))
+
+
+class ValueCounts(object):
+    """Exact histogram of non-negative integer values.
+
+    Small values are counted in a dense array, large ones in a dict, so the
+    memory used depends on the number of distinct values rather than rows.
+    """
+
+    DENSE_LIMIT = 1 << 16
+
+    def __init__(self):
+        self.dense = np.zeros(self.DENSE_LIMIT, dtype=np.int64)
+        self.sparse = {}
+
+    def add(self, values):
+        small = values[(values >= 0) & (values < self.DENSE_LIMIT)]
+        self.dense += np.bincount(small, minlength=self.DENSE_LIMIT)
+        large = values[(values < 0) | (values >= self.DENSE_LIMIT)]
+        if len(large):
+            for value, count in zip(*np.unique(large, return_counts=True)):
+                self.sparse[int(value)] = self.sparse.get(int(value), 0) + int(count)
+
+    def merge(self, other):
+        self.dense += other.dense
+        for value, count in other.sparse.items():
+            self.sparse[value] = self.sparse.get(value, 0) + count
+
+    def items(self):
+        """Sorted (values, counts) arrays of everything seen so far"""
+        values = np.nonzero(self.dense)[0].astype(np.int64)
+        counts = self.dense[values]
+        if self.sparse:
+            extra = np.array(sorted(self.sparse.items()), dtype=np.int64)
+            values = np.concatenate([values, extra[:, 0]])
+            counts = np.concatenate([counts, extra[:, 1]])
+            order = np.argsort(values, kind='stable')
+            values, counts = values[order], counts[order]
+        return values, counts
+
+
+class RunningStats(object):
+    """Count, exact sum, min, max and variance of an integer column, without its values.
+
+    Used in place of ValueCounts when sketches serve the percentiles. Each
+    page's mean and sum of squared deviations are combined with the running
+    ones by the parallel variance formula, so two RunningStats merge exactly.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        mean = float(values.mean())
+        self._combine(len(values), int(values.sum()), int(values.min()), int(values.max()),
+                      mean, float(((values - mean) ** 2).sum()))
+
+    def merge(self, other):
+        if other.n:
+            self._combine(other.n, other.total, other.min, other.max, other.mean, other.m2)
+
+    def _combine(self, n, total, low, high, mean, m2):
+        both = self.n + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.n * n / both
+        self.mean += delta * n / both
+        self.n = both
+        self.total += total
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def stats(self):
+        """The same keys as _column_stats()"""
+        if self.n == 0:
+            return {'sum': 0, 'avg': 0.0, 'min': 0, 'max': 0, 'stddev': 0.0}
+        return {
+            'sum': self.total,
+            'avg': float(self.total / self.n),
+            'min': self.min,
+            'max': self.max,
+            'stddev': float(np.sqrt(self.m2 / (self.n - 1))) if self.n > 1 else 0.0,
+        }
+
+
+class TopUsers(object):
+    """Exact top-k user codes by tweet count, ties broken by user name.
+
+    Tweet counts only grow inside one aggregator, so after a page the new
+    top-k can only come from the previous top-k and the users that page
+    touched: anyone else was already outranked by every member and has not
+    moved. Each page costs O(users in the page + k) and reading the ranking
+    costs O(k log k), instead of a pass over every user per cycle.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.codes = np.zeros(0, dtype=np.int64)
+        self.floor = 0  # smallest count inside a full top-k
+
+    def update(self, touched, counts, names):
+        """Fold in the codes whose counts changed in the last page"""
+        if self.k <= 0:
+            return
+        if len(self.codes) >= self.k:
+            touched = touched[counts[touched] >= self.floor]
+        candidates = np.union1d(self.codes, touched)
+        if len(candidates) > self.k:
+            values = counts[candidates]
+            cut = len(values) - self.k
+            kth = np.partition(values, cut)[cut]
+            sure = candidates[values > kth]
+            tied = candidates[values == kth]
+            if len(sure) + len(tied) > self.k:
+                tied = heapq.nsmallest(self.k - len(sure), tied.tolist(), key=lambda code: str(names[code]))
+            candidates = np.concatenate([sure, np.asarray(tied, dtype=np.int64)])
+        if len(candidates) >= self.k and len(candidates):
+            self.floor = int(counts[candidates].min())
+        self.codes = candidates
+
+    def ranked(self, counts, names):
+        return sorted(self.codes.tolist(), key=lambda code: (-counts[code], str(names[code])))
+
+
+class WindowIndex(object):
+    """Epoch-ms timestamps newer than a moving floor, counted past any cutoff.
+
+    The timestamps live in one sorted array plus short unsorted tails of
+    additions and removals. Counting past a cutoff is a binary search on the
+    sorted part and a pass over the tails, and the hour-of-day histogram of
+    the sorted part is kept current as values are merged in and expire, so
+    reading the window metrics never re-sorts the window. The tails are
+    merged in once they outgrow TAIL_LIMIT (or the sorted part itself, while
+    a scan loads rows), which costs O(log n) per value amortised.
+    """
+
+    TAIL_LIMIT = 1 << 16
+
+    def __init__(self, floor):
+        self.floor = floor         # values at or below it have expired
+        self.sorted = np.zeros(0, dtype=np.int64)
+        self.hours = np.zeros(24, dtype=np.int64)  # hour-of-day counts of self.sorted
+        self.added = []
+        self.removed = []
+        self.tail = 0              # values waiting in added + removed
+
+    def __len__(self):
+        return self.count_after(self.floor)
+
+    def add(self, values):
+        self._queue(self.added, values)
+
+    def remove(self, values):
+        """Take out values added earlier (one occurrence each)"""
+        self._queue(self.removed, values)
+
+    def _queue(self, tail, values):
+        values = np.asarray(values, dtype=np.int64)
+        values = values[values > self.floor]
+        if len(values):
+            tail.append(values)
+            self.tail += len(values)
+            if self.tail > max(self.TAIL_LIMIT, len(self.sorted)):
+                self.compact()
+
+    def update(self, other):
+        """Add every value of another index (e.g. from another shard of the table)"""
+        self.add(other.sorted)
+        for values in other.added:
+            self.add(values)
+        for values in other.removed:
+            self.remove(values)
+
+    def expire(self, floor):
+        """Drop the values at or below a new floor (floors only move forward)"""
+        if floor <= self.floor:
+            return
+        self.floor = floor
+        cut = int(np.searchsorted(self.sorted, floor, side='right'))
+        if cut:
+            self.hours -= _hour_counts(self.sorted[:cut])
+            self.sorted = self.sorted[cut:]
+
+    def compact(self):
+        """Merge the tails into the sorted part"""
+        if not self.tail:
+            return
+        added = self._drain(self.added)
+        removed = self._drain(self.removed)
+        merged = np.insert(self.sorted, np.searchsorted(self.sorted, added), added)
+        if len(removed):
+            # Remove one occurrence per value: equal values take consecutive slots
+            first = np.searchsorted(removed, removed, side='left')
+            slots = np.searchsorted(merged, removed, side='left') + (np.arange(len(removed)) - first)
+            merged = np.delete(merged, slots)
+        self.sorted = merged
+        self.hours += _hour_counts(added) - _hour_counts(removed)
+        self.tail = 0
+
+    def _drain(self, tail):
+        values = np.sort(np.concatenate(tail)) if tail else np.zeros(0, dtype=np.int64)
+        tail.clear()
+        return values[values > self.floor]
+
+    def count_after(self, cutoff):
+        """Values strictly greater than cutoff (cutoff >= floor)"""
+        if self.tail > self.TAIL_LIMIT:
+            self.compact()
+        count = len(self.sorted) - int(np.searchsorted(self.sorted, cutoff, side='right'))
+        count += sum(int(np.count_nonzero(values > cutoff)) for values in self.added)
+        count -= sum(int(np.count_nonzero(values > cutoff)) for values in self.removed)
+        return count
+
+    def hour_counts(self):
+        """Values above the floor per UTC hour of the day"""
+        if self.tail > self.TAIL_LIMIT:
+            self.compact()
+        hours = self.hours.copy()
+        for values in self.added:
+            hours += _hour_counts(values[values > self.floor])
+        for values in self.removed:
+            hours -= _hour_counts(values[values > self.floor])
+        return hours
+
+
+def _hour_counts(dates_ms):
+    return np.bincount((dates_ms % DAY_MS) // HOUR_MS, minlength=24)
+
+
+class UserIndex(object):
+    """Per-user tallies in dictionary-encoded, array-backed columns.
+
+    Users get a dense integer code on first sight; tweet count, retweet and
+    like sums and last-seen time live in NumPy columns indexed by that code,
+    grown by doubling. Activity-tier counts, the number of distinct users,
+    the top-k ranking and the last-seen times inside the widest window (for
+    active users) are maintained page by page from the users each page
+    touched, so none of them needs a pass over all users per cycle.
+
+    With hashes (for the sketches, which then count active users) no
+    last-seen times are kept.
+    """
+
+    MIN_CAPACITY = 1024
+
+    def __init__(self, top_users=TOP_USERS, with_hashes=False, active_floor=MISSING_MS):
+        self.ids = {}
+        self.names = []
+        self.tweets = np.zeros(0, dtype=np.int64)
+        self.retweets = np.zeros(0, dtype=np.int64)
+        self.likes = np.zeros(0, dtype=np.int64)
+        self.last_seen = np.zeros(0, dtype=np.int64) if not with_hashes else None
+        self.hashes = np.zeros(0, dtype=np.uint64) if with_hashes else None
+
+        self.activity_edges = bucket_edges(USER_ACTIVITY_BUCKETS)
+        self.activity = np.zeros(len(USER_ACTIVITY_BUCKETS), dtype=np.int64)
+        self.distinct = 0
+        self.top = TopUsers(top_users)
+        # last_seen of every user seen after the floor
+        self.active = WindowIndex(active_floor) if not with_hashes else None
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, users):
+        """Codes for a page of user names, registering unseen users"""
+        ids = self.ids
+        names = self.names
+        known = len(names)
+        codes = np.empty(len(users), dtype=np.int64)
+        for i, user in enumerate(users):
+            code = ids.get(user)
+            if code is None:
+                code = ids[user] = len(names)
+                names.append(user)
+            codes[i] = code
+        if len(names) > len(self.tweets):
+            self._grow(len(names))
+        if self.hashes is not None and len(names) > known:
+            self.hashes[known:len(names)] = [hash64(user) for user in names[known:]]
+        return codes
+
+    def _grow(self, needed):
+        old = len(self.tweets)
+        capacity = max(self.MIN_CAPACITY, old * 2, needed)
+        pad = capacity - old
+        self.tweets = np.concatenate([self.tweets, np.zeros(pad, dtype=np.int64)])
+        self.retweets = np.concatenate([self.retweets, np.zeros(pad, dtype=np.int64)])
+        self.likes = np.concatenate([self.likes, np.zeros(pad, dtype=np.int64)])
+        if self.last_seen is not None:
+            self.last_seen = np.concatenate([self.last_seen, np.full(pad, MISSING_MS, dtype=np.int64)])
+        if self.hashes is not None:
+            self.hashes = np.concatenate([self.hashes, np.zeros(pad, dtype=np.uint64)])
+
+    def add(self, codes, retweets, likes, dates_ms):
+        """Fold one page (codes from encode()) into the per-user columns"""
+        touched, inverse = np.unique(codes, return_inverse=True)
+        last_seen = None
+        if self.last_seen is not None:
+            last_seen = np.full(len(touched), MISSING_MS, dtype=np.int64)
+            np.maximum.at(last_seen, inverse, dates_ms)
+        self._fold(touched,
+                   np.bincount(inverse, minlength=len(touched)),
+                   np.bincount(inverse, weights=retweets, minlength=len(touched)).astype(np.int64),
+                   np.bincount(inverse, weights=likes, minlength=len(touched)).astype(np.int64),
+                   last_seen)
+
+    def merge(self, other):
+        """Fold in the tallies of another index (e.g. from another shard of the table)"""
+        n = len(other)
+        if n == 0:
+            return
+        codes = self.encode(other.names)
+        last_seen = other.last_seen[:n] if other.last_seen is not None else None
+        self._fold(codes, other.tweets[:n], other.retweets[:n], other.likes[:n], last_seen)
+
+    def _fold(self, touched, tweets, retweets, likes, last_seen):
+        """Add per-user sums for distinct codes and update the maintained views"""
+        before = self.tweets[touched]
+        after = before + tweets
+        self.tweets[touched] = after
+        self.retweets[touched] += retweets
+        self.likes[touched] += likes
+        if self.last_seen is not None:
+            seen_before = self.last_seen[touched]
+            seen_after = np.maximum(seen_before, last_seen)
+            self.last_seen[touched] = seen_after
+            moved = seen_after != seen_before
+            self.active.remove(seen_before[moved])
+            self.active.add(seen_after[moved])
+
+        self.activity -= bucket_counts(before[before > 0], self.activity_edges)
+        self.activity += bucket_counts(after, self.activity_edges)
+        self.distinct += int(np.count_nonzero(before == 0))
+        self.top.update(touched, self.tweets, self.names)
+
+    def top_codes(self):
+        """Codes of the most active users, ties broken by user name"""
+        return self.top.ranked(self.tweets, self.names)
+
+
+class TweetAggregator(object):
+    """Folds pages of tweet columns into every exporter metric in one pass"""
+
+    def __init__(self, now=None, top_users=TOP_USERS, sketch_config=None, rollups=None):
+        self.now = time.time() if now is None else now
+        self.now_ms = int(self.now * 1000)
+        self.top_users = top_users
+
+        # Optional bounded-memory sketches serving percentiles, medians, active
+        # users and the tweet windows in place of the exact state below
+        self.sketches = SketchSet(sketch_config) if sketch_config is not None else None
+
+        # Optional minute/hour buckets written to the rollup tables (RollupBuckets)
+        self.rollups = rollups
+
+        self.rows = 0
+        column_state = ValueCounts if self.sketches is None else RunningStats
+        self.retweets = column_state()
+        self.likes = column_state()
+
+        self.retweet_edges = bucket_edges(RETWEET_BUCKETS)
+        self.like_edges = bucket_edges(LIKE_BUCKETS)
+        self.text_length_edges = bucket_edges(TEXT_LENGTH_BUCKETS)
+        self.engagement_edges = bucket_edges(ENGAGEMENT_BUCKETS)
+
+        self.retweet_buckets = np.zeros(len(RETWEET_BUCKETS), dtype=np.int64)
+        self.like_buckets = np.zeros(len(LIKE_BUCKETS), dtype=np.int64)
+        self.text_length_buckets = np.zeros(len(TEXT_LENGTH_BUCKETS), dtype=np.int64)
+        self.engagement_buckets = np.zeros(len(ENGAGEMENT_BUCKETS), dtype=np.int64)
+
+        self.text_length_sum = 0
+        self.text_length_min = None
+        self.text_length_max = None
+        self.high_engagement = 0
+        self.viral = 0
+
+        # Per-user tallies, indexed by a dictionary-encoded user id
+        floor = self.now_ms - HOURLY_WINDOW_MS
+        self.users = UserIndex(top_users, with_hashes=self.sketches is not None, active_floor=floor)
+
+        # Timestamps of tweets inside the widest window (7 days)
+        self.recent = WindowIndex(floor) if self.sketches is None else None
+
+    def advance(self, now):
+        """Move the aggregator clock forward before folding in newer rows"""
+        self.now = now
+        self.now_ms = int(now * 1000)
+        if self.sketches is None:
+            self.recent.expire(self.now_ms - HOURLY_WINDOW_MS)
+            self.users.active.expire(self.now_ms - HOURLY_WINDOW_MS)
+        return self
+
+    # ----- ingestion -----
+
+    def merge(self, other):
+        """Fold in an aggregator built from a disjoint set of rows (same clock)"""
+        self.rows += other.rows
+        self.retweets.merge(other.retweets)
+        self.likes.merge(other.likes)
+        self.retweet_buckets += other.retweet_buckets
+        self.like_buckets += other.like_buckets
+        self.text_length_buckets += other.text_length_buckets
+        self.engagement_buckets += other.engagement_buckets
+
+        self.text_length_sum += other.text_length_sum
+        if self.text_length_min is None:
+            self.text_length_min, self.text_length_max = other.text_length_min, other.text_length_max
+        elif other.text_length_min is not None:
+            self.text_length_min = min(self.text_length_min, other.text_length_min)
+            self.text_length_max = max(self.text_length_max, other.text_length_max)
+        self.high_engagement += other.high_engagement
+        self.viral += other.viral
+
+        self.users.merge(other.users)
+        if self.sketches is not None:
+            self.sketches.merge(other.sketches)
+        else:
+            self.recent.update(other.recent)
+        if self.rollups is not None:
+            self.rollups.merge(other.rollups)
+        return self
+
+    def add_rows(self, rows, batch_size=BATCH_SIZE, stats=None):
+        """Consume an iterable of rows with user/retweets/likes/text/date.
+
+        With `stats` (CollectorStats) the time spent waiting for rows and the
+        time spent folding them in are reported as the scan / aggregate sections.
+        """
+        clock = time.perf_counter
+        scan_seconds = aggregate_seconds = 0.0
+        for batch in _batches(rows, batch_size, clock):
+            read = clock()
+            scan_seconds += read - batch.started
+            if not batch:
+                break
+            self._add_row_batch(batch)
+            aggregate_seconds += clock() - read
+            if stats is not None:
+                stats.add_rows(len(batch))
+        if stats is not None:
+            stats.add_time('scan', scan_seconds)
+            stats.add_time('aggregate', aggregate_seconds)
+        return self
+
+    def _add_row_batch(self, batch):
+        users = [row.user for row in batch]
+        retweets = [row.retweets or 0 for row in batch]
+        likes = [row.likes or 0 for row in batch]
+        text_lengths = [len(row.text) if row.text else 0 for row in batch]
+        dates = to_epoch_ms([row.date for row in batch])
+        self.add_columns(users, retweets, likes, text_lengths, dates)
+
+    def add_columns(self, users, retweets, likes, text_lengths, dates_ms):
+        """Fold one page of column values into the running aggregates"""
+        self.add_encoded(self.users.encode(users), retweets, likes, text_lengths, dates_ms)
+
+    def add_encoded(self, codes, retweets, likes, text_lengths, dates_ms):
+        """add_columns() for users already encoded by self.users (codes into users.names)"""
+        codes = np.asarray(codes, dtype=np.int64)
+        retweets = np.asarray(retweets, dtype=np.int64)
+        likes = np.asarray(likes, dtype=np.int64)
+        text_lengths = np.asarray(text_lengths, dtype=np.int64)
+        dates_ms = np.asarray(dates_ms, dtype=np.int64)
+        n = len(retweets)
+        if n == 0:
+            return
+        self.rows += n
+
+        self.retweets.add(retweets)
+        self.likes.add(likes)
+
+        self.retweet_buckets += bucket_counts(retweets, self.retweet_edges)
+        self.like_buckets += bucket_counts(likes, self.like_edges)
+        self.text_length_buckets += bucket_counts(text_lengths, self.text_length_edges)
+        self.engagement_buckets += bucket_counts(retweets + likes, self.engagement_edges)
+
+        self.text_length_sum += int(text_lengths.sum())
+        page_min, page_max = int(text_lengths.min()), int(text_lengths.max())
+        if self.text_length_min is None or page_min < self.text_length_min:
+            self.text_length_min = page_min
+        if self.text_length_max is None or page_max > self.text_length_max:
+            self.text_length_max = page_max
+
+        self.high_engagement += int(np.count_nonzero((retweets > 100) | (likes > 500)))
+        self.viral += int(np.count_nonzero(retweets > 1000))
+
+        self.users.add(codes, retweets, likes, dates_ms)
+
+        if self.sketches is not None:
+            self.sketches.add(self.users.hashes[codes], retweets, likes, dates_ms, self.now_ms)
+        else:
+            self.recent.add(dates_ms)
+        if self.rollups is not None:
+            self.rollups.add(_CodedNames(self.users.names, codes), retweets, likes, dates_ms, self.now_ms)
+
+    # ----- results -----
+
+    def metrics(self):
+        """Return the exporter metrics dict (same names as the per-query version)"""
+        out = {}
+        total_tweets = self.rows
+        out['twitter_tweets_total'] = total_tweets
+
+        sketches = self.sketches
+        if sketches is None:
+            rt_values, rt_counts = self.retweets.items()
+            like_values, like_counts = self.likes.items()
+            out.update(_engagement_stats(_column_stats(rt_values, rt_counts), _column_stats(like_values, like_counts),
+                                         percentile_cont(rt_values, rt_counts, 0.5),
+                                         percentile_cont(like_values, like_counts, 0.5)))
+        else:
+            sketches.prune(self.now_ms)
+            out.update(_engagement_stats(self.retweets.stats(), self.likes.stats(),
+                                         sketches.median('retweets'), sketches.median('likes')))
+
+        for (name, _), count in zip(RETWEET_BUCKETS, self.retweet_buckets):
+            out[name] = int(count)
+        for (name, _), count in zip(LIKE_BUCKETS, self.like_buckets):
+            out[name] = int(count)
+        for (name, _), count in zip(TEXT_LENGTH_BUCKETS, self.text_length_buckets):
+            out[name] = int(count)
+
+        for (name, _), count in zip(USER_ACTIVITY_BUCKETS, self.users.activity):
+            out[name] = int(count)
+
+        for (name, _), count in zip(ENGAGEMENT_BUCKETS, self.engagement_buckets):
+            out[name] = int(count)
+
+        if sketches is None:
+            hours = self.recent.hour_counts()
+        else:
+            hours = sketches.hour_counts(self.now_ms - HOURLY_WINDOW_MS)
+        for hour in range(24):
+            out[f'twitter_hour_{hour:02d}_tweets'] = int(hours[hour])
+
+        total_users = self.users.distinct
+        out['twitter_total_users'] = total_users
+        for label, hours_back in TIME_WINDOWS:
+            cutoff = self.now_ms - hours_back * HOUR_MS
+            if sketches is not None:
+                out[f'twitter_active_users_{label}'] = sketches.active_users(cutoff)
+            else:
+                out[f'twitter_active_users_{label}'] = self.users.active.count_after(cutoff)
+        for label, hours_back in TIME_WINDOWS:
+            cutoff = self.now_ms - hours_back * HOUR_MS
+            if sketches is not None:
+                out[f'twitter_tweets_last_{label}'] = sketches.tweets_after(cutoff)
+            else:
+                out[f'twitter_tweets_last_{label}'] = self.recent.count_after(cutoff)
+        out['twitter_tweets_per_hour'] = out['twitter_tweets_last_1h']
+
+        if total_tweets > 0:
+            out.update({
+                'twitter_engagement_ratio': (out['twitter_total_retweets'] + out['twitter_total_likes']) / total_tweets,
+                'twitter_retweet_ratio': out['twitter_total_retweets'] / total_tweets,
+                'twitter_like_ratio': out['twitter_total_likes'] / total_tweets,
+                'twitter_virality_score': out['twitter_max_retweets'] / max(out['twitter_avg_retweets'], 1),
+            })
+
+        users = self.users
+        for i, code in enumerate(users.top_codes()):
+            tweets = int(users.tweets[code])
+            out[f'twitter_top_user_{i+1}_tweets'] = tweets
+            out[f'twitter_top_user_{i+1}_name_tweets'] = tweets  # Same value for pie chart
+            out[f'twitter_top_user_{i+1}_avg_retweets'] = float(users.retweets[code] / tweets)
+            out[f'twitter_top_user_{i+1}_avg_likes'] = float(users.likes[code] / tweets)
+
+        # Percentiles only consider tweets that got at least one retweet/like
+        for p in PERCENTILES:
+            if sketches is not None:
+                out[f'twitter_retweets_p{p}'] = sketches.retweets.quantile(p / 100)
+                out[f'twitter_likes_p{p}'] = sketches.likes.quantile(p / 100)
+            else:
+                out[f'twitter_retweets_p{p}'] = percentile_cont(rt_values[rt_values > 0], rt_counts[rt_values > 0], p / 100)
+                out[f'twitter_likes_p{p}'] = percentile_cont(like_values[like_values > 0], like_counts[like_values > 0], p / 100)
+
+        out.update({
+            'twitter_avg_text_length': float(self.text_length_sum / total_tweets) if total_tweets else 0.0,
+            'twitter_max_text_length': int(self.text_length_max or 0),
+            'twitter_min_text_length': int(self.text_length_min or 0),
+        })
+
+        out['twitter_high_engagement_tweets'] = self.high_engagement
+        out['twitter_viral_tweets'] = self.viral
+
+        if total_users > 0:
+            out.update({
+                'twitter_tweets_per_user': total_tweets / total_users,
+                'twitter_retweets_per_user': out['twitter_total_retweets'] / total_users,
+                'twitter_likes_per_user': out['twitter_total_likes'] / total_users,
+            })
+        return out
+
+
+def _engagement_stats(rt, likes, rt_median, like_median):
+    """Engagement metrics from the _column_stats() of retweets and likes"""
+    return {
+        'twitter_total_retweets': rt['sum'],
+        'twitter_total_likes': likes['sum'],
+        'twitter_avg_retweets': rt['avg'],
+        'twitter_avg_likes': likes['avg'],
+        'twitter_max_retweets': rt['max'],
+        'twitter_max_likes': likes['max'],
+        'twitter_min_retweets': rt['min'],
+        'twitter_min_likes': likes['min'],
+        'twitter_median_retweets': rt_median,
+        'twitter_median_likes': like_median,
+        'twitter_stddev_retweets': rt['stddev'],
+        'twitter_stddev_likes': likes['stddev'],
+    }
+
+
+class _CodedNames(object):
+    """Sequence view of user names given as codes into a name list"""
+    __slots__ = ('names', 'codes')
+
+    def __init__(self, names, codes):
+        self.names = names
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.names[self.codes[i]]
+
+
+class _Batch(list):
+    __slots__ = ('started',)
+
+
+def _batches(rows, batch_size, clock):
+    """Group rows into lists of batch_size, each stamped with when reading it began.
+
+    The last batch may be empty; it still carries the time spent reaching the end.
+    """
+    batch = _Batch()
+    batch.started = clock()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = _Batch()
+            batch.started = clock()
+    yield batch
+
+
+def _column_stats(values, counts):
+    """SUM/AVG/MIN/MAX/STDDEV (sample) of a column from its value histogram"""
+    n = int(counts.sum())
+    if n == 0:
+        return {'sum': 0, 'avg': 0.0, 'min': 0, 'max': 0, 'stddev': 0.0}
+    total = int(np.dot(values.astype(object), counts.astype(object)))
+    mean = total / n
+    stddev = 0.0
+    if n > 1:
+        stddev = float(np.sqrt(np.dot(counts, (values - mean) ** 2) / (n - 1)))
+    return {
+        'sum': total,
+        'avg': float(mean),
+        'min': int(values[0]),
+        'max': int(values[-1]),
+        'stddev': stddev,
+    }
+
+
+def collect_metrics(source, now=None, top_users=TOP_USERS, sketch_config=None, stats=None, rollups=None):
+    """Run the single tweets scan on a source and return the metrics dict"""
+    aggregator = TweetAggregator(now=now, top_users=top_users, sketch_config=sketch_config, rollups=rollups)
+    aggregator.add_rows(source.scan(SCAN_COLUMNS), stats=stats)
+    if stats is None:
+        return aggregator.metrics()
+    with stats.section('finalize'):  # twitter_instrumentation imports this module
+        return aggregator.metrics()
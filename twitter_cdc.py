@@ -0,0 +1,331 @@
+# twitter_cdc.py
+"""Event-driven ingestion: fold tweet change events into the metrics as they arrive.
+
+Polling (even incremental) re-reads the tweets table every cycle. In cdc
+mode the table is scanned once to bootstrap the aggregates; after that every
+new tweet arrives as a change event and is folded into the running
+TweetAggregator, a micro-batch per apply() (every second by default), so the
+metrics lag the writes by about one interval and the database sees no reads.
+
+Events are JSON objects, one per tweet:
+
+    {"tweet_id": "t1", "user": "alice", "retweets": 3, "likes": 10,
+     "text": "...", "date": "2026-10-18T12:00:00Z"}
+
+`text_length` may stand in for `text`, `date` may be epoch milliseconds, and a
+Debezium-style envelope ({"op": "c", "after": {...}}) is unwrapped. Only
+inserts are applied; updates and deletes are counted and left to the
+periodic reconciliation scan, like edits are in incremental mode. Events
+come from two places:
+
+    POST /events     a JSON array, a single object or newline-delimited JSON
+                     (single-process exporter only)
+    EventDirectory   JSON-lines files that a CDC agent writes while reading the
+                     commitlog segments Cassandra hard-links into cdc_raw/
+                     (cdc_enabled: true, and WITH cdc = true on the table)
+
+Replicas and agent restarts deliver some events twice, so the tweet_ids
+applied recently are remembered (a bounded window) and repeats are skipped.
+A bootstrap or reconciliation scan marks the recent rows it read as seen as
+well, and replays events it did not see yet, so events racing a scan are
+counted exactly once.
+
+An apply() costs O(events) plus O(log n) per window count (see WindowIndex
+in twitter_aggregator.py), while pickling the state costs O(everything), so
+the state is saved at most every save_interval seconds (and after each
+reconciliation). After a restart the event files are re-read from the saved
+offsets and the catch-up scan reads the rows past the saved watermark.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
+
+from twitter_aggregator import TOP_USERS
+from twitter_incremental import RECONCILE_INTERVAL, SAVE_INTERVAL, IncrementalCollector
+from twitter_instrumentation import section
+from twitter_rollups import to_datetime, to_ms
+
+INSERT_OPS = ('insert', 'c', 'r')  # plain, Debezium create, Debezium snapshot read
+MISSING_DATE = np.iinfo(np.int64).min
+INT64 = np.iinfo(np.int64)
+
+DEDUPE_IDS = 500000     # tweet_ids remembered for skipping repeated events
+DEDUPE_WINDOW = 300     # seconds before a scan whose rows are remembered as seen
+MAX_PENDING = 1000000   # events buffered between applies, more are refused
+MAX_READ = 16 << 20     # bytes read from the event files per poll
+EVENT_SUFFIX = '.jsonl'
+
+
+# ===== PARSING =====
+
+def parse_event(event):
+    """(tweet_id, user, retweets, likes, text_length, date_ms) of an insert; None for other operations"""
+    if not isinstance(event, dict):
+        raise ValueError("event is not a JSON object")
+    if event.get('op', 'insert') not in INSERT_OPS:
+        return None
+    row = event.get('after', event)
+    if not isinstance(row, dict) or row.get('tweet_id') is None:
+        raise ValueError("event without tweet_id")
+    text = row.get('text')
+    text_length = row.get('text_length', len(text) if text else 0)
+    return (str(row['tweet_id']), row.get('user'), _int64(row.get('retweets') or 0), _int64(row.get('likes') or 0),
+            _int64(text_length), _date_ms(row.get('date')))
+
+
+def _int64(value):
+    """int() of a column value, refusing what does not fit the int64 columns (1e400 is inf)"""
+    try:
+        value = int(value)
+    except OverflowError:
+        raise ValueError(f"{value!r} is not a finite number") from None
+    if not INT64.min < value <= INT64.max:
+        raise ValueError(f"{value} does not fit in 64 bits")
+    return value
+
+
+def _date_ms(value):
+    if value is None:
+        return MISSING_DATE
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return _int64(value)  # epoch ms
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return to_ms(date)
+
+
+def parse_body(data):
+    """(events, lines that are not JSON) of a JSON array, object or newline-delimited JSON body"""
+    try:
+        events = json.loads(data)
+    except ValueError:
+        pass
+    else:
+        return (events if isinstance(events, list) else [events]), 0
+    events, invalid = [], 0
+    for line in data.splitlines():
+        if line.strip():
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                invalid += 1
+    return events, invalid
+
+
+# ===== COLLECTOR =====
+
+class EventCollector(IncrementalCollector):
+    """Running aggregates bootstrapped by one scan and then kept current from change events"""
+
+    def __init__(self, state_path, reconcile_interval=RECONCILE_INTERVAL, top_users=TOP_USERS,
+                 sketch_config=None, rollups=False, save_interval=SAVE_INTERVAL):
+        # Restored by _load() from the state file, so set before it runs
+        self.seen = OrderedDict()  # str(tweet_id) -> applied event, None when read by a scan
+        self.offsets = {}          # event file name -> bytes consumed
+        self.saved_offsets = {}    # offsets as of the last save (files safe to delete)
+        super().__init__(state_path, reconcile_interval, top_users, sketch_config, rollups, save_interval)
+        self.caught_up = False     # a scan ran since startup, events may be applied
+
+        self.pending = []          # parsed events waiting for the next apply()
+        self.counts = Counter()    # events by result since the last apply()
+        self._lock = threading.Lock()
+        self._scanned = None       # ids read by the running scan
+        self._scan_cutoff = None
+        self._replaying = False
+
+    # ----- receiving (any thread) -----
+
+    def offer(self, events, invalid=0):
+        """Parse and queue events for the next apply(); returns counts by result"""
+        parsed, counts = [], Counter(rejected=invalid)
+        for event in events:
+            try:
+                event = parse_event(event)
+            except (TypeError, ValueError, AttributeError, OverflowError):
+                counts['rejected'] += 1
+                continue
+            if event is None:
+                counts['ignored'] += 1
+            else:
+                parsed.append(event)
+        with self._lock:
+            room = max(0, MAX_PENDING - len(self.pending))
+            counts['accepted'] = min(room, len(parsed))
+            counts['overflow'] = len(parsed) - counts['accepted']
+            self.pending.extend(parsed[:room])
+            self.counts.update(counts)
+        return counts
+
+    # ----- applying (collector thread) -----
+
+    def collect(self, source, now=None, stats=None, full=None):
+        metrics = super().collect(source, now, stats, full)
+        self.caught_up = True
+        return metrics
+
+    def apply(self, now=None, stats=None):
+        """Fold the queued events into the aggregates and return the metrics dict"""
+        now = time.time() if now is None else now
+        with self._lock:
+            events, self.pending = self.pending, []
+            counts, self.counts = self.counts, Counter()
+        with section(stats, 'aggregate'):
+            fresh = self._dedupe(events)
+            counts['duplicate'] += len(events) - len(fresh)
+            counts['applied'] += len(fresh)
+            self._fold(fresh, now)
+        self.last_mode = 'events'
+        self.last_rows = len(fresh)
+        if stats is not None:
+            stats.observe_events(counts, len(self.pending))
+        if now - self.saved_at >= self.save_interval:
+            with section(stats, 'save_state'):
+                self._save()
+            self.saved_at = now
+        with section(stats, 'finalize'):
+            return self.aggregator.metrics()
+
+    def _dedupe(self, events):
+        seen = self.seen
+        fresh = []
+        for event in events:
+            if event[0] not in seen:
+                seen[event[0]] = event
+                fresh.append(event)
+        while len(seen) > DEDUPE_IDS:
+            seen.popitem(last=False)
+        return fresh
+
+    def _fold(self, events, now):
+        aggregator = self.aggregator.advance(now)
+        if not events:
+            return
+        tweet_ids, users, retweets, likes, text_lengths, dates_ms = zip(*events)
+        aggregator.add_columns(users, retweets, likes, text_lengths, dates_ms)
+        newest = max(dates_ms)
+        if newest == MISSING_DATE:
+            return
+        date = to_datetime(newest)
+        at_newest = {tweet_id for tweet_id, date_ms in zip(tweet_ids, dates_ms) if date_ms == newest}
+        if self.watermark is None or date > self.watermark:
+            self.watermark = date
+            self.watermark_ids = at_newest
+        elif date == self.watermark:
+            self.watermark_ids |= at_newest
+
+    # ----- scans -----
+
+    def _reconcile(self, source, now, stats=None):
+        self._begin_scan(now)
+        try:
+            super()._reconcile(source, now, stats)
+        finally:
+            scanned, self._scanned = self._scanned, None
+        # Events the scan did not see yet go into the fresh aggregates again
+        replay = [event for tweet_id, event in self.seen.items() if event is not None and tweet_id not in scanned]
+        self.seen = OrderedDict.fromkeys(scanned)
+        self._fold(self._dedupe(replay), now)
+
+    def _catch_up(self, source, now, stats=None):
+        # After a restart: rows written while the exporter was down, minus
+        # those that arrived as events before it stopped
+        self._begin_scan(now)
+        self._replaying = True
+        try:
+            super()._catch_up(source, now, stats)
+        finally:
+            scanned, self._scanned = self._scanned, None
+            self._replaying = False
+        self.seen.update(OrderedDict.fromkeys(scanned - self.seen.keys()))
+
+    def _begin_scan(self, now):
+        self._scanned = set()
+        self._scan_cutoff = to_datetime(int((now - DEDUPE_WINDOW) * 1000))
+
+    def _track(self, rows):
+        """Advance the watermark and remember the recent rows a scan read"""
+        seen, scanned, cutoff = self.seen, self._scanned, self._scan_cutoff
+        for row in super()._track(rows):
+            tweet_id = str(row.tweet_id)
+            if self._replaying and seen.get(tweet_id) is not None:
+                continue  # already applied as an event
+            if tweet_id in seen or (row.date is not None and row.date >= cutoff):
+                scanned.add(tweet_id)
+            yield row
+
+    # ----- persistence -----
+
+    def _restore(self, state):
+        super()._restore(state)
+        self.seen = state['seen']
+        self.offsets = state['offsets']
+        self.saved_offsets = dict(self.offsets)
+
+    def _state(self):
+        state = super()._state()
+        state.update(seen=self.seen, offsets=self.offsets)
+        return state
+
+    def _save(self):
+        super()._save()
+        self.saved_offsets = dict(self.offsets)
+
+
+# ===== EVENT FILES =====
+
+class EventDirectory(object):
+    """Tails the JSON-lines event files a CDC agent writes into a spool directory.
+
+    Files are read in name order (name them by time or sequence) from the
+    offsets saved with the collector state, so a restart resumes where the
+    last saved state stopped and nothing is applied twice. A file is deleted
+    once it has been read to the end, a newer file exists and the state
+    recording that has been saved.
+    """
+
+    def __init__(self, path, collector):
+        self.path = path
+        self.collector = collector
+
+    def poll(self):
+        """Queue the complete lines written since the last poll; returns how many events"""
+        collector = self.collector
+        if len(collector.pending) >= MAX_PENDING:
+            return 0
+        try:
+            names = sorted(name for name in os.listdir(self.path) if name.endswith(EVENT_SUFFIX))
+        except FileNotFoundError:
+            return 0
+        offsets = collector.offsets
+        for name in set(offsets) - set(names):
+            del offsets[name]  # removed by someone else
+        budget, queued = MAX_READ, 0
+        for i, name in enumerate(names):
+            path = os.path.join(self.path, name)
+            offset = offsets.get(name, 0)
+            size = os.path.getsize(path)
+            if size <= offset:
+                if i < len(names) - 1 and collector.saved_offsets.get(name) == size:
+                    os.remove(path)
+                    del offsets[name]
+                continue
+            if budget <= 0:
+                break
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(min(size - offset, budget))
+            end = data.rfind(b'\n') + 1  # a partly written last line waits for the next poll
+            if not end:
+                continue
+            events, invalid = parse_body(data[:end])
+            collector.offer(events, invalid)
+            offsets[name] = offset + end
+            budget -= end
+            queued += len(events)
+        return queued
@@ -0,0 +1,299 @@
+# twitter_columnar.py
+"""Columnar on-disk cache of the tweets table for offline recomputation.
+
+Every metric is computed from five columns of tweets, so ColumnCache keeps
+just those in a local directory as flat binary files that are mapped into
+memory as NumPy arrays:
+
+    user.bin         int32   code into users.jsonl (dictionary-encoded names)
+    retweets.bin     int64
+    likes.bin        int64
+    text_length.bin  int32   the text itself is never stored
+    date.bin         int64   epoch ms, int64 min when missing
+    users.jsonl      one JSON-encoded user name per code
+    meta.json        row / user counts, (date, tweet_id) watermark, last rebuild
+
+Rows newer than the watermark (the same high-water mark as
+twitter_incremental) are appended to the files and meta.json is replaced
+last, so an interrupted append only leaves trailing bytes that the next open
+cuts off. A periodic rebuild reads the whole table into a fresh directory and
+swaps it in, which picks up edited retweets/likes.
+
+ColumnarCollector recomputes every metric each cycle by folding the mapped
+columns into a TweetAggregator a large slice at a time - NumPy only, no
+per-row Python - and a restart is warm: the cache is reopened from disk and
+only rows past the watermark are read from the database.
+"""
+import json
+import os
+import shutil
+import time
+from itertools import islice
+
+import numpy as np
+
+from twitter_aggregator import TOP_USERS, TweetAggregator, to_epoch_ms
+from twitter_incremental import INCREMENTAL_WHERE, RECONCILE_INTERVAL, SCAN_COLUMNS_WITH_ID
+from twitter_instrumentation import section
+from twitter_rollups import RollupBuckets, to_datetime
+
+# (file name, dtype) of every cached column
+COLUMNS = (
+    ('user', np.int32),
+    ('retweets', np.int64),
+    ('likes', np.int64),
+    ('text_length', np.int32),
+    ('date', np.int64),
+)
+USERS_FILE = 'users.jsonl'
+META_FILE = 'meta.json'
+CACHE_VERSION = 1
+
+APPEND_BATCH = 50000  # source rows encoded and written per append
+FOLD_SLICE = 1 << 20  # mapped rows folded into the aggregator at once
+MISSING_DATE = np.iinfo(np.int64).min
+
+
+class ColumnCache(object):
+    """Append-only memory-mapped tweet columns plus their user dictionary"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._reset()
+        try:
+            self._open()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable column cache {directory}: {str(e)[:100]}")
+            self._reset()
+
+    def _reset(self):
+        self.rows = 0
+        self.names = []            # user code -> name
+        self.ids = {}              # name -> user code
+        self.watermark = None      # newest tweet date in the cache (epoch ms)
+        self.watermark_ids = set()  # str(tweet_id) of the cached tweets at that date
+        self.reconciled_at = 0.0   # when the cache was last rebuilt from a full scan
+        self._mapped = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open(self):
+        try:
+            with open(self._path(META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        if meta.get('version') != CACHE_VERSION:
+            return
+        names = []
+        with open(self._path(USERS_FILE), 'rb') as f:
+            for _ in range(meta['users']):
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    raise ValueError(f"{USERS_FILE} is shorter than meta.json says")
+                names.append(json.loads(line))
+            users_end = f.tell()
+        sizes = {}
+        for name, dtype in COLUMNS:
+            sizes[name] = meta['rows'] * np.dtype(dtype).itemsize
+            if os.path.getsize(self._path(name + '.bin')) < sizes[name]:
+                raise ValueError(f"{name}.bin is shorter than meta.json says")
+
+        # Cut off whatever an interrupted append left past meta.json
+        _truncate(self._path(USERS_FILE), users_end)
+        for name, _ in COLUMNS:
+            _truncate(self._path(name + '.bin'), sizes[name])
+
+        self.rows = meta['rows']
+        self.names = names
+        self.ids = {name: code for code, name in enumerate(names)}
+        self.watermark = meta['watermark']
+        self.watermark_ids = set(meta['watermark_ids'])
+        self.reconciled_at = meta['reconciled_at']
+
+    def _save_meta(self):
+        meta = {
+            'version': CACHE_VERSION,
+            'rows': self.rows,
+            'users': len(self.names),
+            'watermark': self.watermark,
+            'watermark_ids': sorted(self.watermark_ids),
+            'reconciled_at': self.reconciled_at,
+        }
+        tmp_path = self._path(META_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._path(META_FILE))
+
+    # ----- writing -----
+
+    def extend(self, rows, stats=None):
+        """Append source rows (tweet_id, user, retweets, likes, text, date); returns how many.
+
+        After a failure the object is out of step with its files - reopen the
+        directory, which drops the partial append.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        files = {name: open(self._path(name + '.bin'), 'ab') for name, _ in COLUMNS}
+        users_file = open(self._path(USERS_FILE), 'ab')
+        added = 0
+        try:
+            rows = iter(rows)
+            while True:
+                batch = list(islice(rows, APPEND_BATCH))
+                if not batch:
+                    break
+                columns = self._encode(batch, users_file)
+                for name, dtype in COLUMNS:
+                    files[name].write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+                added += len(batch)
+                if stats is not None:
+                    stats.add_rows(len(batch))
+        finally:
+            for f in files.values():
+                f.close()
+            users_file.close()
+        self.rows += added
+        self._save_meta()
+        return added
+
+    def _encode(self, batch, users_file):
+        """Column arrays for a batch of rows, registering unseen users"""
+        ids = self.ids
+        names = self.names
+        known = len(names)
+        codes = np.empty(len(batch), dtype=np.int32)
+        for i, row in enumerate(batch):
+            code = ids.get(row.user)
+            if code is None:
+                code = ids[row.user] = len(names)
+                names.append(row.user)
+            codes[i] = code
+        if len(names) > known:
+            users_file.write(''.join(json.dumps(name) + '\n' for name in names[known:]).encode('utf-8'))
+        dates = to_epoch_ms([row.date for row in batch])
+        self._track(batch, dates)
+        return {
+            'user': codes,
+            'retweets': [row.retweets or 0 for row in batch],
+            'likes': [row.likes or 0 for row in batch],
+            'text_length': [len(row.text) if row.text else 0 for row in batch],
+            'date': dates,
+        }
+
+    def _track(self, batch, dates):
+        """Advance the watermark past a batch"""
+        newest = int(dates.max())
+        if newest == MISSING_DATE or (self.watermark is not None and newest < self.watermark):
+            return
+        at_newest = {str(batch[i].tweet_id) for i in np.flatnonzero(dates == newest)}
+        if self.watermark is None or newest > self.watermark:
+            self.watermark = newest
+            self.watermark_ids = at_newest
+        else:
+            self.watermark_ids |= at_newest
+
+    # ----- reading -----
+
+    def columns(self):
+        """The cached columns as read-only memory-mapped arrays, by name"""
+        if self._mapped is None or len(self._mapped['date']) != self.rows:
+            self._mapped = {name: self._map(name, dtype) for name, dtype in COLUMNS}
+        return self._mapped
+
+    def _map(self, name, dtype):
+        if self.rows == 0:
+            return np.zeros(0, dtype=dtype)  # mmap cannot map an empty file
+        return np.memmap(self._path(name + '.bin'), dtype=dtype, mode='r', shape=(self.rows,))
+
+    def fold(self, aggregator):
+        """Fold every cached row into an aggregator, FOLD_SLICE rows at a time"""
+        columns = self.columns()
+        remap = aggregator.users.encode(self.names)  # cache code -> aggregator code
+        for start in range(0, self.rows, FOLD_SLICE):
+            end = start + FOLD_SLICE
+            aggregator.add_encoded(remap[columns['user'][start:end]], columns['retweets'][start:end],
+                                   columns['likes'][start:end], columns['text_length'][start:end],
+                                   columns['date'][start:end])
+        return aggregator
+
+
+def _truncate(path, size):
+    if os.path.getsize(path) > size:
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+
+
+class ColumnarCollector(object):
+    """Keeps the column cache current and recomputes the metrics from it"""
+
+    def __init__(self, directory, reconcile_interval=RECONCILE_INTERVAL, top_users=TOP_USERS,
+                 sketch_config=None, rollups=False):
+        self.directory = directory
+        self.reconcile_interval = reconcile_interval
+        self.top_users = top_users
+        self.sketch_config = sketch_config
+        self.rollups = rollups  # give each aggregator RollupBuckets for the rollup writer
+
+        self.cache = ColumnCache(directory)
+        self.aggregator = None  # aggregator of the last recomputation
+        self.last_mode = None
+        self.last_rows = 0      # rows read from the source by the last refresh
+
+    @property
+    def reconciled_at(self):
+        return self.cache.reconciled_at
+
+    def collect(self, source, now=None, stats=None, full=None):
+        """Refresh the cache and return the metrics dict recomputed over it.
+
+        `full` forces (True) or holds off (False) the periodic rebuild; by
+        default it runs every reconcile_interval. Without a cache it always runs.
+        """
+        now = time.time() if now is None else now
+        if full is None:
+            full = now - self.cache.reconciled_at >= self.reconcile_interval
+        try:
+            with section(stats, 'refresh'):
+                if full or self.cache.watermark is None:
+                    self._rebuild(source, now, stats)
+                else:
+                    self._append(source, stats)
+        except Exception:
+            self.cache = ColumnCache(self.directory)  # drop a partial append
+            raise
+        aggregator = TweetAggregator(now=now, top_users=self.top_users, sketch_config=self.sketch_config,
+                                     rollups=RollupBuckets() if self.rollups else None)
+        with section(stats, 'aggregate'):
+            self.cache.fold(aggregator)
+        self.aggregator = aggregator
+        with section(stats, 'finalize'):
+            return aggregator.metrics()
+
+    def _rebuild(self, source, now, stats=None):
+        """Read the whole table into a fresh cache directory and swap it in"""
+        building = self.directory + '.building'
+        shutil.rmtree(building, ignore_errors=True)
+        cache = ColumnCache(building)
+        cache.reconciled_at = now
+        self.last_rows = cache.extend(source.scan(SCAN_COLUMNS_WITH_ID), stats=stats)
+
+        old = self.directory + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.directory):
+            os.rename(self.directory, old)
+        os.rename(building, self.directory)
+        shutil.rmtree(old, ignore_errors=True)
+        cache.directory = self.directory
+        cache._mapped = None
+        self.cache = cache
+        self.last_mode = 'full'
+
+    def _append(self, source, stats=None):
+        cache = self.cache
+        since, seen = to_datetime(cache.watermark), set(cache.watermark_ids)
+        rows = source.scan(SCAN_COLUMNS_WITH_ID, INCREMENTAL_WHERE, (since,))
+        fresh = (row for row in rows if not (row.date == since and str(row.tweet_id) in seen))
+        self.last_rows = cache.extend(fresh, stats=stats)
+        self.last_mode = 'incremental'
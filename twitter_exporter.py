@@ -1,276 +1,293 @@
 # twitter_exporter_ULTIMATE_WITH_HISTOGRAMS.py
-from flask import Flask
-from cassandra.cluster import Cluster
+from flask import Flask, request
+import os
+import socket
+import sys
 import time
 import threading
 from datetime import datetime, timedelta
-import math
-from collections import defaultdict
+
+from twitter_aggregator import SCAN_COLUMNS, TIME_WINDOWS, TOP_USERS, TweetAggregator, collect_metrics
+from twitter_cdc import EventCollector, EventDirectory, parse_body
+from twitter_columnar import ColumnarCollector
+from twitter_incremental import RECONCILE_INTERVAL, SAVE_INTERVAL, IncrementalCollector
+from twitter_push import BATCH_SIZE, MAX_QUEUE, Pusher
+from twitter_instrumentation import CollectorStats, CycleProfiler
+from twitter_rollups import (HOUR_RETENTION_MS, CassandraRollupStore, RollupBuckets, RollupWriter,
+                             SQLiteRollupStore, to_datetime, window_metric_names, window_metrics)
+from twitter_sketches import DEFAULT_COMPRESSION, DEFAULT_HLL_PRECISION, SketchConfig
+from twitter_scheduler import DEFAULT_JITTER, DEFAULT_MAX_DEFER, Job, Scheduler
+from twitter_snapshot import Snapshot
+from twitter_targets import TARGET_TIMEOUT, ShardedCollector, Target, parse_targets
+from twitter_shared import SharedSnapshot
+from twitter_source import CassandraSource, SQLiteSource
 
 app = Flask(__name__)
 
+# Collection settings (environment overrides)
+BACKEND = os.environ.get('TWITTER_EXPORTER_BACKEND', 'cassandra')  # cassandra | sqlite
+CASSANDRA_HOSTS = os.environ.get('CASSANDRA_HOSTS', 'cassandra').split(',')
+CASSANDRA_PORT = int(os.environ.get('CASSANDRA_PORT', 9042))
+CASSANDRA_KEYSPACE = os.environ.get('CASSANDRA_KEYSPACE', 'twitter')
+SQLITE_PATH = os.environ.get('TWITTER_EXPORTER_SQLITE_PATH', 'tweets.sqlite')
+COLLECTION_MODE = os.environ.get('TWITTER_EXPORTER_MODE', 'full')  # full | incremental | columnar | cdc
+STATE_DIR = os.environ.get('TWITTER_EXPORTER_STATE_DIR', 'exporter_state')
+RECONCILE_SECONDS = int(os.environ.get('TWITTER_EXPORTER_RECONCILE_SECONDS', RECONCILE_INTERVAL))
+SAVE_SECONDS = int(os.environ.get('TWITTER_EXPORTER_SAVE_SECONDS', SAVE_INTERVAL))
+TOP_USERS_K = int(os.environ.get('TWITTER_EXPORTER_TOP_USERS', TOP_USERS))  # twitter_top_user_1..K_*
+
+# Approximate percentiles, medians and windows from t-digest + HyperLogLog sketches
+# in place of the exact per-value and per-tweet state
+SKETCH_CONFIG = None
+if os.environ.get('TWITTER_EXPORTER_SKETCHES', '0') == '1':
+    SKETCH_CONFIG = SketchConfig(
+        compression=int(os.environ.get('TWITTER_EXPORTER_TDIGEST_COMPRESSION', DEFAULT_COMPRESSION)),
+        hll_precision=int(os.environ.get('TWITTER_EXPORTER_HLL_PRECISION', DEFAULT_HLL_PRECISION)),
+    )
+
+# Sharded collection: several cluster/keyspace/table targets (labelled by cluster
+# and keyspace) or the default one, scanned in token-range shards on a worker pool
+TARGETS = parse_targets(os.environ.get('TWITTER_EXPORTER_TARGETS', ''), default_port=CASSANDRA_PORT)
+COLLECT_WORKERS = int(os.environ.get('TWITTER_EXPORTER_COLLECT_WORKERS', 1))
+COLLECT_POOL = os.environ.get('TWITTER_EXPORTER_COLLECT_POOL', 'process')  # process | thread
+SHARDS = int(os.environ.get('TWITTER_EXPORTER_SHARDS', 0))  # per target, 0 = one per worker
+TARGET_TIMEOUT_SECONDS = float(os.environ.get('TWITTER_EXPORTER_TARGET_TIMEOUT', TARGET_TIMEOUT))
+
+# cdc mode also tails the JSON-lines change event files a CDC agent writes here
+CDC_DIR = os.environ.get('TWITTER_EXPORTER_CDC_DIR', '')
+
+# Maintain the minute/hour rollup tables and serve window + hour-of-day metrics from
+# them on the rollups interval, so the tweets scan can run less often
+ROLLUPS = os.environ.get('TWITTER_EXPORTER_ROLLUPS', '0') == '1'
+
+# Refresh interval and cost budget (seconds) per metric group; a group whose run
+# overran its budget is deferred by up to MAX_DEFER intervals. JITTER is the
+# fraction of the interval added at random to every run.
+TWEETS_INTERVAL = float(os.environ.get('TWITTER_EXPORTER_TWEETS_INTERVAL', 60 if ROLLUPS else 15))
+TWEETS_BUDGET = float(os.environ.get('TWITTER_EXPORTER_TWEETS_BUDGET', TWEETS_INTERVAL))
+EVENTS_INTERVAL = float(os.environ.get('TWITTER_EXPORTER_EVENTS_INTERVAL', 1))  # cdc mode
+ROLLUPS_INTERVAL = float(os.environ.get('TWITTER_EXPORTER_ROLLUPS_INTERVAL', 15))
+RECONCILE_BUDGET = float(os.environ.get('TWITTER_EXPORTER_RECONCILE_BUDGET', 600))
+JITTER = float(os.environ.get('TWITTER_EXPORTER_JITTER', DEFAULT_JITTER))
+MAX_DEFER = int(os.environ.get('TWITTER_EXPORTER_MAX_DEFER', DEFAULT_MAX_DEFER))
+
+# Push mode: send every finished snapshot to a Pushgateway or a remote-write endpoint
+PUSH_URL = os.environ.get('TWITTER_EXPORTER_PUSH_URL', '')  # e.g. http://pushgateway:9091
+PUSH_PROTOCOL = os.environ.get('TWITTER_EXPORTER_PUSH_PROTOCOL', 'pushgateway')  # pushgateway | remote_write
+PUSH_JOB = os.environ.get('TWITTER_EXPORTER_PUSH_JOB', 'twitter-exporter')
+PUSH_INSTANCE = os.environ.get('TWITTER_EXPORTER_PUSH_INSTANCE', socket.gethostname())
+PUSH_BATCH_SIZE = int(os.environ.get('TWITTER_EXPORTER_PUSH_BATCH_SIZE', BATCH_SIZE))
+PUSH_MAX_QUEUE = int(os.environ.get('TWITTER_EXPORTER_PUSH_MAX_QUEUE', MAX_QUEUE))
+
+# On-demand sampling profiler of a collection cycle at /debug/profile
+PROFILING = os.environ.get('TWITTER_EXPORTER_PROFILING', '0') == '1'
+
 # Global metrics
 metrics = {}
+target_metrics = {}  # (cluster, keyspace) -> metrics, with TWITTER_EXPORTER_TARGETS
+event_collector = None  # receives POST /events in cdc mode, set by the collector
+
+# Timings and health of the collection loop (twitter_exporter_* metrics)
+stats = CollectorStats()
+profiler = CycleProfiler() if PROFILING else None
+
+# Pre-rendered bodies of the last finished cycle, replaced (never mutated) per cycle
+snapshot = Snapshot(metrics, version=0, stats=stats)
+
+# Multi-process serving: the collector publishes every snapshot to a shared
+# mmap file that all server workers read from (see gunicorn.conf.py)
+SNAPSHOT_PATH = os.environ.get('TWITTER_EXPORTER_SNAPSHOT_PATH')
+shared = SharedSnapshot(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
+
+# Push mode: the collector also sends each snapshot as soon as it is published
+pusher = None
+if PUSH_URL:
+    pusher = Pusher(PUSH_URL, PUSH_PROTOCOL, job=PUSH_JOB, instance=PUSH_INSTANCE, batch_size=PUSH_BATCH_SIZE,
+                    max_queue=PUSH_MAX_QUEUE, stats=stats)
+
+def publish_snapshot():
+    """Render the current metrics once and swap in the new snapshot"""
+    global snapshot
+    with stats.section('render'):
+        snapshot = Snapshot(metrics, version=snapshot.version + 1, stats=stats, targets=target_metrics)
+    if shared is not None:
+        with stats.section('publish'):
+            shared.publish(snapshot)
+    if pusher is not None:
+        with stats.section('push'):
+            pusher.push(snapshot)
+
+def current_snapshot():
+    """Snapshot to serve: the shared one when a separate collector runs"""
+    if shared is not None:
+        return shared.read() or snapshot
+    return snapshot
+
+# One long-lived connection for the whole process (reconnects with backoff)
+if BACKEND == 'sqlite':
+    source = SQLiteSource(SQLITE_PATH)
+else:
+    source = CassandraSource(CASSANDRA_HOSTS, CASSANDRA_KEYSPACE, port=CASSANDRA_PORT)
+source.stats = stats
+
+# Rollup tables live next to tweets (cassandra-config/migrations/001_tweet_rollups.cql)
+rollup_store = SQLiteRollupStore(source) if BACKEND == 'sqlite' else CassandraRollupStore(source)
+rollup_writer = RollupWriter(rollup_store) if ROLLUPS else None
+
+def write_rollups(rollups, now_ms):
+    """Upsert changed buckets, then answer the window metrics from the rollup partitions"""
+    with stats.section('rollups'):
+        if rollups is not None:
+            rollup_writer.flush(rollups, now_ms)
+        metrics.update(window_metrics(rollup_store, now_ms, TIME_WINDOWS))
+
+def backfill_rollups():
+    """Fill the rollup tables from the tweets of the last 7 days"""
+    now = time.time()
+    now_ms = int(now * 1000)
+    rollups = RollupBuckets()
+    aggregator = TweetAggregator(now=now, top_users=TOP_USERS_K, rollups=rollups)
+    aggregator.add_rows(source.scan(SCAN_COLUMNS, "date >= ?", (to_datetime(now_ms - HOUR_RETENTION_MS),)))
+    written = RollupWriter(rollup_store).flush(rollups, now_ms)
+    print(f"Backfilled {written} rollup buckets from {aggregator.rows} tweets")
 
 def update_metrics():
     """Update metrics from Cassandra - WITH HISTOGRAMS & DISTRIBUTIONS"""
+    global event_collector
+    # Running aggregates (incremental) or the local column cache (columnar),
+    # both kept current from a watermark and rebuilt on the reconcile interval;
+    # in cdc mode the running aggregates are kept current from change events
+    incremental = None
+    events_dir = None
+    if COLLECTION_MODE in ('incremental', 'columnar', 'cdc'):
+        if TARGETS:
+            print(f"TWITTER_EXPORTER_TARGETS is ignored in {COLLECTION_MODE} mode, collecting the default keyspace")
+        if COLLECTION_MODE == 'columnar':
+            incremental = ColumnarCollector(os.path.join(STATE_DIR, 'columns'), RECONCILE_SECONDS,
+                                            top_users=TOP_USERS_K, rollups=ROLLUPS)
+        elif COLLECTION_MODE == 'cdc':
+            incremental = EventCollector(os.path.join(STATE_DIR, 'events.pkl'), RECONCILE_SECONDS,
+                                         top_users=TOP_USERS_K, sketch_config=SKETCH_CONFIG, rollups=ROLLUPS,
+                                         save_interval=SAVE_SECONDS)
+            events_dir = EventDirectory(CDC_DIR, incremental) if CDC_DIR else None
+            stats.register_events()
+            event_collector = incremental
+        else:
+            incremental = IncrementalCollector(os.path.join(STATE_DIR, 'incremental.pkl'), RECONCILE_SECONDS,
+                                               top_users=TOP_USERS_K, sketch_config=SKETCH_CONFIG, rollups=ROLLUPS,
+                                               save_interval=SAVE_SECONDS)
+    
+    # Token-range shards scanned on a worker pool, only used in full mode
+    sharded = None
+    if incremental is None and (TARGETS or COLLECT_WORKERS > 1):
+        if TARGETS and ROLLUPS:
+            print("TWITTER_EXPORTER_ROLLUPS is ignored with TWITTER_EXPORTER_TARGETS")
+        if TARGETS:
+            targets = TARGETS
+        elif BACKEND == 'sqlite':
+            targets = [Target('sqlite', (SQLITE_PATH,), 0, CASSANDRA_KEYSPACE, source.table)]
+        else:
+            targets = [Target(CASSANDRA_HOSTS[0], tuple(CASSANDRA_HOSTS), CASSANDRA_PORT, CASSANDRA_KEYSPACE,
+                              source.table)]
+        sharded = ShardedCollector(targets, BACKEND, workers=COLLECT_WORKERS, pool=COLLECT_POOL, shards=SHARDS,
+                                   top_users=TOP_USERS_K, sketch_config=SKETCH_CONFIG,
+                                   rollups=ROLLUPS and not TARGETS, timeout=TARGET_TIMEOUT_SECONDS)
+
+    # Sketches only pay off where aggregates outlive a cycle or cross processes;
+    # a full scan or the columnar recomputation sees every value anyway
+    if SKETCH_CONFIG is not None and COLLECTION_MODE not in ('incremental', 'cdc') and sharded is None:
+        print(f"TWITTER_EXPORTER_SKETCHES is ignored in {COLLECTION_MODE} mode without sharding, serving exact values")
+    
+    # Rollups serve the window / hour-of-day metrics on their own (shorter) schedule
+    with_rollups = rollup_writer is not None and (incremental is not None or not TARGETS)
+    window_names = set(window_metric_names(TIME_WINDOWS)) if with_rollups else set()
+    latest_rollups = []
+    
+    def refresh_tweets(full=False):
+        print(f"{datetime.now().strftime('%H:%M:%S')} - Collecting from {BACKEND}...")
+        
+        # ===== SINGLE-PASS AGGREGATION =====
+        # One paged scan of tweets fills every total, bucket, window,
+        # percentile and top-user metric (see twitter_aggregator.py).
+        # In incremental / columnar mode only rows past the watermark are read;
+        # sharded, every target's token ranges are split over a pool.
+        now = time.time()
+        if incremental is not None:
+            collected = incremental.collect(source, now=now, stats=stats, full=full)
+            print(f"{datetime.now().strftime('%H:%M:%S')} - {incremental.last_mode} pass, {incremental.last_rows} rows")
+            rollups = incremental.aggregator.rollups
+        elif sharded is not None:
+            results = sharded.collect(now=now, stats=stats)
+            if not TARGETS and sharded.failures:
+                raise next(iter(sharded.failures.values()))
+            if not results:
+                raise ConnectionError(f"No target collected yet ({len(sharded.failures)} failed)")
+            print(f"{datetime.now().strftime('%H:%M:%S')} - {len(results)} target(s) in {sharded.shards} shards each, "
+                  f"{len(sharded.failures)} failed")
+            rollups = next(iter(sharded.aggregators.values())).rollups
+            if TARGETS:
+                target_metrics.clear()
+                target_metrics.update(((t.cluster, t.keyspace), values) for t, values in results.items())
+                return
+            collected = results[sharded.targets[0]]
+        else:
+            rollups = RollupBuckets() if with_rollups else None
+            collected = collect_metrics(source, now=now, top_users=TOP_USERS_K, stats=stats, rollups=rollups)
+        metrics.update((name, value) for name, value in collected.items() if name not in window_names)
+        latest_rollups[:] = [rollups]
+        print(f"{datetime.now().strftime('%H:%M:%S')} - Updated {len(metrics)} metrics with HISTOGRAMS")
+    
+    def refresh_events():
+        # Bootstrap scan (or the catch-up past the saved watermark after a
+        # restart) once, then only the events queued since the last run
+        if not incremental.caught_up or incremental.aggregator is None:
+            refresh_tweets()
+            return
+        if events_dir is not None:
+            events_dir.poll()
+        collected = incremental.apply(stats=stats)
+        metrics.update((name, value) for name, value in collected.items() if name not in window_names)
+        latest_rollups[:] = [incremental.aggregator.rollups]
+    
+    def refresh_rollups():
+        # Windows move with the clock between scans; new tweets arrive with the
+        # next scan (events in cdc mode) or from other writers of the tables
+        write_rollups(latest_rollups[0] if latest_rollups else None, int(time.time() * 1000))
+    
+    # Each metric group on its own interval and cost budget (twitter_scheduler.py)
+    if event_collector is not None:
+        jobs = [Job('events', refresh_events, EVENTS_INTERVAL, budget=EVENTS_INTERVAL)]
+    else:
+        jobs = [Job('tweets', refresh_tweets, TWEETS_INTERVAL, budget=TWEETS_BUDGET)]
+    if with_rollups:
+        jobs.append(Job('rollups', refresh_rollups, ROLLUPS_INTERVAL, priority=1))
+    if incremental is not None:
+        first = RECONCILE_SECONDS
+        if incremental.reconciled_at:
+            first = max(0.0, incremental.reconciled_at + RECONCILE_SECONDS - time.time())
+        jobs.append(Job('reconcile', lambda: refresh_tweets(full=True), RECONCILE_SECONDS,
+                        budget=RECONCILE_BUDGET, priority=2, delay=first))
+    scheduler = Scheduler(jobs, jitter=JITTER, max_defer=MAX_DEFER, stats=stats)
+    
     while True:
-        try:
-            print(f"{datetime.now().strftime('%H:%M:%S')} - Connecting to Cassandra...")
-            
-            cluster = Cluster(['cassandra'], port=9042)
-            session = cluster.connect('twitter')
-            
-            # ===== 1. BASIC COUNTS & TOTALS =====
-            result = session.execute("SELECT COUNT(*) FROM tweets")
-            total_tweets = result[0][0]
-            metrics['twitter_tweets_total'] = total_tweets
-            
-            # ===== 2. ENGAGEMENT METRICS =====
-            result = session.execute("""
-                SELECT 
-                  SUM(retweets) as total_retweets,
-                  SUM(likes) as total_likes,
-                  AVG(retweets) as avg_retweets,
-                  AVG(likes) as avg_likes,
-                  MAX(retweets) as max_retweets,
-                  MAX(likes) as max_likes,
-                  MIN(retweets) as min_retweets,
-                  MIN(likes) as min_likes,
-                  PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY retweets) as median_retweets,
-                  PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY likes) as median_likes,
-                  STDDEV(retweets) as stddev_retweets,
-                  STDDEV(likes) as stddev_likes
-                FROM tweets
-            """)
-            row = result[0]
-            
-            metrics.update({
-                'twitter_total_retweets': int(row.total_retweets or 0),
-                'twitter_total_likes': int(row.total_likes or 0),
-                'twitter_avg_retweets': float(row.avg_retweets or 0),
-                'twitter_avg_likes': float(row.avg_likes or 0),
-                'twitter_max_retweets': int(row.max_retweets or 0),
-                'twitter_max_likes': int(row.max_likes or 0),
-                'twitter_min_retweets': int(row.min_retweets or 0),
-                'twitter_min_likes': int(row.min_likes or 0),
-                'twitter_median_retweets': float(row.median_retweets or 0),
-                'twitter_median_likes': float(row.median_likes or 0),
-                'twitter_stddev_retweets': float(row.stddev_retweets or 0),
-                'twitter_stddev_likes': float(row.stddev_likes or 0),
-            })
-            
-            # ===== 3. HISTOGRAM METRICS FOR PIE CHARTS =====
-            # Engagement level buckets for pie chart
-            retweet_buckets = [
-                ('twitter_retweets_0', "retweets = 0"),
-                ('twitter_retweets_1_10', "retweets BETWEEN 1 AND 10"),
-                ('twitter_retweets_11_50', "retweets BETWEEN 11 AND 50"),
-                ('twitter_retweets_51_100', "retweets BETWEEN 51 AND 100"),
-                ('twitter_retweets_101_500', "retweets BETWEEN 101 AND 500"),
-                ('twitter_retweets_501_1000', "retweets BETWEEN 501 AND 1000"),
-                ('twitter_retweets_1000plus', "retweets > 1000"),
-            ]
-            
-            like_buckets = [
-                ('twitter_likes_0', "likes = 0"),
-                ('twitter_likes_1_20', "likes BETWEEN 1 AND 20"),
-                ('twitter_likes_21_100', "likes BETWEEN 21 AND 100"),
-                ('twitter_likes_101_500', "likes BETWEEN 101 AND 500"),
-                ('twitter_likes_501_2000', "likes BETWEEN 501 AND 2000"),
-                ('twitter_likes_2001_10000', "likes BETWEEN 2001 AND 10000"),
-                ('twitter_likes_10000plus', "likes > 10000"),
-            ]
-            
-            # Get counts for each bucket
-            for metric_name, condition in retweet_buckets:
-                result = session.execute(f"SELECT COUNT(*) FROM tweets WHERE {condition}")
-                metrics[metric_name] = result[0][0]
-            
-            for metric_name, condition in like_buckets:
-                result = session.execute(f"SELECT COUNT(*) FROM tweets WHERE {condition}")
-                metrics[metric_name] = result[0][0]
-            
-            # ===== 4. PIE CHART: TWEET LENGTH DISTRIBUTION =====
-            text_length_buckets = [
-                ('twitter_text_length_0_50', "LENGTH(text) <= 50"),
-                ('twitter_text_length_51_100', "LENGTH(text) BETWEEN 51 AND 100"),
-                ('twitter_text_length_101_150', "LENGTH(text) BETWEEN 101 AND 150"),
-                ('twitter_text_length_151_200', "LENGTH(text) BETWEEN 151 AND 200"),
-                ('twitter_text_length_201_280', "LENGTH(text) BETWEEN 201 AND 280"),
-                ('twitter_text_length_281plus', "LENGTH(text) > 280"),
-            ]
-            
-            for metric_name, condition in text_length_buckets:
-                result = session.execute(f"SELECT COUNT(*) FROM tweets WHERE {condition}")
-                metrics[metric_name] = result[0][0]
-            
-            # ===== 5. PIE CHART: USER ACTIVITY TIERS =====
-            # Get user tweet counts distribution
-            result = session.execute("""
-                SELECT user, COUNT(*) as tweet_count
-                FROM tweets
-                GROUP BY user
-            """)
-            
-            # Bucket users by activity level
-            user_activity_buckets = {
-                'twitter_users_1_tweet': 0,
-                'twitter_users_2_5_tweets': 0,
-                'twitter_users_6_20_tweets': 0,
-                'twitter_users_21_100_tweets': 0,
-                'twitter_users_100plus_tweets': 0,
-            }
-            
-            for row in result:
-                count = row.tweet_count
-                if count == 1:
-                    user_activity_buckets['twitter_users_1_tweet'] += 1
-                elif 2 <= count <= 5:
-                    user_activity_buckets['twitter_users_2_5_tweets'] += 1
-                elif 6 <= count <= 20:
-                    user_activity_buckets['twitter_users_6_20_tweets'] += 1
-                elif 21 <= count <= 100:
-                    user_activity_buckets['twitter_users_21_100_tweets'] += 1
-                else:
-                    user_activity_buckets['twitter_users_100plus_tweets'] += 1
-            
-            metrics.update(user_activity_buckets)
-            
-            # ===== 6. HISTOGRAM: ENGAGEMENT SCORE DISTRIBUTION =====
-            # Calculate engagement score (retweets + likes) buckets
-            engagement_buckets = [
-                ('twitter_engagement_0_10', 0, 10),
-                ('twitter_engagement_11_50', 11, 50),
-                ('twitter_engagement_51_200', 51, 200),
-                ('twitter_engagement_201_1000', 201, 1000),
-                ('twitter_engagement_1001_5000', 1001, 5000),
-                ('twitter_engagement_5001plus', 5001, None),
-            ]
-            
-            for metric_name, low, high in engagement_buckets:
-                if high is None:
-                    query = f"SELECT COUNT(*) FROM tweets WHERE (retweets + likes) >= {low}"
-                else:
-                    query = f"SELECT COUNT(*) FROM tweets WHERE (retweets + likes) BETWEEN {low} AND {high}"
-                result = session.execute(query)
-                metrics[metric_name] = result[0][0]
-            
-            # ===== 7. TIME OF DAY DISTRIBUTION FOR HISTOGRAM =====
-            # Get tweets by hour (0-23)
-            for hour in range(24):
-                result = session.execute(f"""
-                    SELECT COUNT(*) as count
-                    FROM tweets 
-                    WHERE date > toTimestamp(now() - 7d)
-                    AND toUnixTimestamp(date) % 86400 BETWEEN {hour * 3600} AND {(hour + 1) * 3600 - 1}
-                """)
-                metrics[f'twitter_hour_{hour:02d}_tweets'] = result[0].count
-            
-            # ===== 8. USER STATISTICS =====
-            result = session.execute("SELECT COUNT(DISTINCT user) FROM tweets")
-            metrics['twitter_total_users'] = result[0][0]
-            
-            # Active users in different time windows
-            time_windows = [('1h', 1), ('6h', 6), ('24h', 24), ('7d', 168)]
-            for label, hours in time_windows:
-                result = session.execute(f"""
-                    SELECT COUNT(DISTINCT user) as users 
-                    FROM tweets 
-                    WHERE date > toTimestamp(now() - {hours}h)
-                """)
-                metrics[f'twitter_active_users_{label}'] = result[0].users or 0
-            
-            # ===== 9. TIME-BASED METRICS =====
-            for label, hours in time_windows:
-                result = session.execute(f"""
-                    SELECT COUNT(*) as count 
-                    FROM tweets 
-                    WHERE date > toTimestamp(now() - {hours}h)
-                """)
-                metrics[f'twitter_tweets_last_{label}'] = result[0].count
-            
-            # Tweets per hour (rate)
-            metrics['twitter_tweets_per_hour'] = metrics['twitter_tweets_last_1h']
-            
-            # ===== 10. ENGAGEMENT RATIOS & SCORES =====
-            if total_tweets > 0:
-                metrics.update({
-                    'twitter_engagement_ratio': (metrics['twitter_total_retweets'] + metrics['twitter_total_likes']) / total_tweets,
-                    'twitter_retweet_ratio': metrics['twitter_total_retweets'] / total_tweets,
-                    'twitter_like_ratio': metrics['twitter_total_likes'] / total_tweets,
-                    'twitter_virality_score': metrics['twitter_max_retweets'] / max(metrics['twitter_avg_retweets'], 1),
-                })
-            
-            # ===== 11. TOP USERS DISTRIBUTION =====
-            result = session.execute("""
-                SELECT user, COUNT(*) as tweet_count, 
-                       AVG(retweets) as user_avg_retweets,
-                       AVG(likes) as user_avg_likes
-                FROM tweets
-                GROUP BY user
-                ORDER BY tweet_count DESC
-                LIMIT 10
-            """)
-            
-            # Top 10 users for pie chart
-            for i, row in enumerate(result[:10]):
-                metrics[f'twitter_top_user_{i+1}_tweets'] = row.tweet_count
-                metrics[f'twitter_top_user_{i+1}_name_tweets'] = row.tweet_count  # Same value for pie chart
-                metrics[f'twitter_top_user_{i+1}_avg_retweets'] = float(row.user_avg_retweets or 0)
-                metrics[f'twitter_top_user_{i+1}_avg_likes'] = float(row.user_avg_likes or 0)
-            
-            # ===== 12. PERCENTILE METRICS =====
-            percentiles = [25, 50, 75, 90, 95, 99]
-            for p in percentiles:
-                result = session.execute(f"""
-                    SELECT PERCENTILE_CONT({p/100}) WITHIN GROUP (ORDER BY retweets) as p{p}
-                    FROM tweets WHERE retweets > 0
-                """)
-                metrics[f'twitter_retweets_p{p}'] = float(result[0][0] or 0)
-                
-                result = session.execute(f"""
-                    SELECT PERCENTILE_CONT({p/100}) WITHIN GROUP (ORDER BY likes) as p{p}
-                    FROM tweets WHERE likes > 0
-                """)
-                metrics[f'twitter_likes_p{p}'] = float(result[0][0] or 0)
-            
-            # ===== 13. TEXT ANALYSIS =====
-            result = session.execute("""
-                SELECT AVG(LENGTH(text)) as avg_length,
-                       MAX(LENGTH(text)) as max_length,
-                       MIN(LENGTH(text)) as min_length
-                FROM tweets
-            """)
-            row = result[0]
-            metrics.update({
-                'twitter_avg_text_length': float(row.avg_length or 0),
-                'twitter_max_text_length': int(row.max_length or 0),
-                'twitter_min_text_length': int(row.min_length or 0),
-            })
-            
-            # ===== 14. CATEGORICAL METRICS =====
-            result = session.execute("SELECT COUNT(*) FROM tweets WHERE retweets > 100 OR likes > 500")
-            metrics['twitter_high_engagement_tweets'] = result[0][0] or 0
-            
-            result = session.execute("SELECT COUNT(*) FROM tweets WHERE retweets > 1000")
-            metrics['twitter_viral_tweets'] = result[0][0] or 0
-            
-            # ===== 15. USER ENGAGEMENT DISTRIBUTION =====
-            if metrics['twitter_total_users'] > 0:
-                metrics.update({
-                    'twitter_tweets_per_user': total_tweets / metrics['twitter_total_users'],
-                    'twitter_retweets_per_user': metrics['twitter_total_retweets'] / metrics['twitter_total_users'],
-                    'twitter_likes_per_user': metrics['twitter_total_likes'] / metrics['twitter_total_users'],
-                })
-            
-            session.shutdown()
-            cluster.shutdown()
-            
-            print(f"{datetime.now().strftime('%H:%M:%S')} - Updated {len(metrics)} metrics with HISTOGRAMS!")
-            
-        except Exception as e:
-            print(f"Error: {str(e)[:100]}...")
+        time.sleep(scheduler.wait_time())
+        if profiler is not None:
+            profiler.begin_cycle()
+        stats.begin_cycle()
+        ran = scheduler.run_due()
+        failed = [(job, error) for job, error in ran if error is not None]
+        for job, error in failed:
+            print(f"Error in {job.name} ({type(error).__name__}): {str(error)[:300]}")
+        # Mock data only stands in for a failed tweets scan; other groups keep their last values
+        scan_errors = [error for job, error in ran if job.name in ('tweets', 'reconcile', 'events')]
+        mock = any(error is not None for error in scan_errors) if scan_errors else stats.data_is_mock
+        stats.end_cycle(success=not failed, mock=mock)
+        if any(job.name != 'events' for job, _ in ran):  # not every second in cdc mode
+            print(f"{datetime.now().strftime('%H:%M:%S')} - Ran {', '.join(job.name for job, _ in ran)} "
+                  f"in {stats.last_duration:.2f}s")
+        
+        if mock and scan_errors:
+            print(f"Serving MOCK data, {stats.consecutive_failures} failed cycle(s) in a row")
             # Fallback mock data with histograms
             metrics.update({
                 # Original metrics
@@ -328,91 +345,70 @@ def update_metrics():
                 'twitter_hour_21_tweets': 3, 'twitter_hour_22_tweets': 2, 'twitter_hour_23_tweets': 1,
             })
         
-        time.sleep(15)
+        # Publish the finished cycle - handlers only ever see whole snapshots
+        publish_snapshot()
+        if profiler is not None:
+            profiler.end_cycle()
+
+def serve(body):
+    """Serve a pre-rendered body (gzip / 304 aware)"""
+    return body.response(request.headers.get('Accept-Encoding', ''), request.headers.get('If-None-Match', ''))
 
 @app.route('/metrics')
 def get_metrics():
-    """Return metrics in Prometheus format"""
-    output = []
-    for key, value in metrics.items():
-        output.append(f"{key} {value}")
-    return '\n'.join(output), 200, {'Content-Type': 'text/plain'}
+    """Return metrics in Prometheus format (OpenMetrics / protobuf if asked for)"""
+    return serve(current_snapshot().exposition(request.headers.get('Accept', '')))
 
 @app.route('/metrics_json')
 def get_metrics_json():
     """Return metrics as JSON for easy inspection"""
-    import json
-    return json.dumps(metrics, indent=2), 200, {'Content-Type': 'application/json'}
+    return serve(current_snapshot().body('metrics_json'))
 
 @app.route('/histogram_data')
 def histogram_data():
     """Return formatted histogram data for Grafana"""
-    import json
-    
-    # Group metrics for easier consumption
-    histograms = {
-        'retweet_distribution': {},
-        'like_distribution': {},
-        'text_length_distribution': {},
-        'user_activity_distribution': {},
-        'engagement_distribution': {},
-        'hourly_distribution': {},
-    }
-    
-    # Extract histogram metrics
-    for key, value in metrics.items():
-        if key.startswith('twitter_retweets_') and not key.endswith('total'):
-            histograms['retweet_distribution'][key.replace('twitter_retweets_', '')] = value
-        elif key.startswith('twitter_likes_') and not key.endswith('total'):
-            histograms['like_distribution'][key.replace('twitter_likes_', '')] = value
-        elif key.startswith('twitter_text_length_'):
-            histograms['text_length_distribution'][key.replace('twitter_text_length_', '')] = value
-        elif key.startswith('twitter_users_'):
-            histograms['user_activity_distribution'][key.replace('twitter_users_', '')] = value
-        elif key.startswith('twitter_engagement_') and key != 'twitter_engagement_ratio':
-            histograms['engagement_distribution'][key.replace('twitter_engagement_', '')] = value
-        elif key.startswith('twitter_hour_'):
-            hour = key.replace('twitter_hour_', '').replace('_tweets', '')
-            histograms['hourly_distribution'][hour] = value
-    
-    return json.dumps(histograms, indent=2), 200, {'Content-Type': 'application/json'}
+    return serve(current_snapshot().body('histogram_data'))
 
 @app.route('/piechart_data/<chart_type>')
 def piechart_data(chart_type):
     """Return data formatted for specific pie charts"""
-    import json
-    
-    chart_data = {
-        'labels': [],
-        'values': [],
-        'colors': ['#FF6384', '#36A2EB', '#FFCE56', '#4BC0C0', '#9966FF', '#FF9F40', '#FF6384']
-    }
-    
-    if chart_type == 'retweets':
-        buckets = ['0', '1_10', '11_50', '51_100', '101_500', '501_1000', '1000plus']
-        chart_data['labels'] = ['0 RT', '1-10 RT', '11-50 RT', '51-100 RT', '101-500 RT', '501-1000 RT', '1000+ RT']
-        for bucket in buckets:
-            chart_data['values'].append(metrics.get(f'twitter_retweets_{bucket}', 0))
-    
-    elif chart_type == 'likes':
-        buckets = ['0', '1_20', '21_100', '101_500', '501_2000', '2001_10000', '10000plus']
-        chart_data['labels'] = ['0 Likes', '1-20', '21-100', '101-500', '501-2000', '2001-10000', '10000+']
-        for bucket in buckets:
-            chart_data['values'].append(metrics.get(f'twitter_likes_{bucket}', 0))
-    
-    elif chart_type == 'text_length':
-        buckets = ['0_50', '51_100', '101_150', '151_200', '201_280', '281plus']
-        chart_data['labels'] = ['0-50 chars', '51-100', '101-150', '151-200', '201-280', '280+']
-        for bucket in buckets:
-            chart_data['values'].append(metrics.get(f'twitter_text_length_{bucket}', 0))
-    
-    return json.dumps(chart_data), 200, {'Content-Type': 'application/json'}
+    return serve(current_snapshot().piechart(chart_type))
+
+@app.route('/events', methods=['POST'])
+def post_events():
+    """Queue tweet change events (JSON array, object or NDJSON) in cdc mode"""
+    if event_collector is None:
+        return 'Not accepting events, set TWITTER_EXPORTER_MODE=cdc on the single-process exporter\n', 503
+    events, invalid = parse_body(request.get_data())
+    counts = event_collector.offer(events, invalid)
+    return {result: counts[result] for result in ('accepted', 'ignored', 'rejected', 'overflow')}, 202
 
 @app.route('/health')
 def health():
     return 'OK', 200
 
+@app.route('/debug/profile')
+def profile():
+    """Sample the next collection cycle; stacks in collapsed (flamegraph) format"""
+    if profiler is None:
+        return 'Profiling disabled, set TWITTER_EXPORTER_PROFILING=1\n', 404
+    if shared is not None:
+        return 'Collection runs in a separate process; profile the single-process exporter\n', 501
+    timeout = float(request.args.get('timeout', 120))
+    stacks = profiler.capture(timeout)
+    if stacks is None:
+        return f'No collection cycle finished within {timeout:.0f}s\n', 504
+    return stacks, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['backfill-rollups']:
+        backfill_rollups()
+        sys.exit(0)
+    if sys.argv[1:] == ['collect']:
+        # Collector-only process for multi-worker serving (gunicorn.conf.py)
+        print(f"📦 Collector publishing snapshots to {SNAPSHOT_PATH}")
+        update_metrics()
+    
     thread = threading.Thread(target=update_metrics, daemon=True)
     thread.start()
     
@@ -422,4 +418,8 @@ if __name__ == '__main__':
     print("📊 Histogram data at: /histogram_data")
     print("🥧 Pie chart data at: /piechart_data/<type>")
     print("❤️  Health check at: /health")
+    if COLLECTION_MODE == 'cdc':
+        print("📨 Change events accepted at: POST /events")
+    if PROFILING:
+        print("🔬 Collection profile at: /debug/profile")
     app.run(host='0.0.0.0', port=9123, debug=False, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,315 @@
+# twitter_instrumentation.py
+"""Self-instrumentation of the exporter's collection loop.
+
+CollectorStats records, per collection cycle, how long each section took
+(reading rows from the source, folding them into the aggregates, computing
+the final metrics, saving incremental state, rendering and publishing the
+snapshot), the latency of every query the source issued, rows scanned, and
+whether the cycle succeeded or fell back to the mock data. The numbers are
+exported as twitter_exporter_* families next to the tweet metrics.
+
+CycleProfiler is an on-demand sampling profiler: a caller asks for the next
+collection cycle and gets back its stacks in collapsed (flamegraph) format.
+"""
+import copy
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounts
+from contextlib import contextmanager, nullcontext
+
+from twitter_registry import Counter, Gauge, LabelledHistogram
+
+SECTION_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+QUERY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Outcomes of a change event: folded in, repeated tweet_id, update/delete,
+# malformed, or refused because too many were queued
+EVENT_RESULTS = ('applied', 'duplicate', 'ignored', 'rejected', 'overflow')
+
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_MAX_DEPTH = 64
+
+
+def section(stats, name):
+    """stats.section(name), or a no-op when collection runs uninstrumented"""
+    return stats.section(name) if stats is not None else nullcontext()
+
+
+class CollectorStats(object):
+    """Timings and health of the collection loop, rendered into every snapshot.
+
+    Section times are summed over a cycle and observed once when the cycle
+    ends; rendering and publishing happen after that, so they are reported
+    with the following cycle. Query latencies are observed as they complete.
+    """
+
+    def __init__(self):
+        self.sections = LabelledHistogram('twitter_exporter_section_duration_seconds',
+                                          'Time spent per collection cycle in each section',
+                                          SECTION_BUCKETS, ('section',))
+        self.queries = LabelledHistogram('twitter_exporter_query_duration_seconds',
+                                         'Latency of queries issued to the tweet source',
+                                         QUERY_BUCKETS, ('query',))
+        self.cycles = LabelledHistogram('twitter_exporter_cycle_duration_seconds',
+                                        'Wall time of a collection cycle', SECTION_BUCKETS)
+        self.cycle_results = Counter('twitter_exporter_cycles', 'Collection cycles by result', ('result',))
+        self.rows_scanned = Counter('twitter_exporter_rows_scanned', 'Rows read from the tweet source')
+        self.target_durations = LabelledHistogram('twitter_exporter_target_duration_seconds',
+                                                  'Wall time of a sharded target scan, submit to merge',
+                                                  SECTION_BUCKETS, ('cluster', 'keyspace'))
+        self.target_health = {}  # (cluster, keyspace) -> [last scan succeeded, last success unix time]
+        self.group_durations = LabelledHistogram('twitter_exporter_group_duration_seconds',
+                                                 'Run time of a scheduled metric group refresh',
+                                                 SECTION_BUCKETS, ('group',))
+        self.group_runs = Counter('twitter_exporter_group_runs', 'Metric group refreshes by result',
+                                  ('group', 'result'))
+        self.group_overruns = Counter('twitter_exporter_group_overruns',
+                                      'Metric group refreshes that exceeded their cost budget', ('group',))
+        self.group_health = {}  # group -> [last success unix time, effective interval]
+        self.push_requests = Counter('twitter_exporter_push_requests', 'Push requests sent to the receiver by result',
+                                     ('result',))
+        self.push_samples = Counter('twitter_exporter_push_samples', 'Samples accepted by the push receiver')
+        self.push_dropped = Counter('twitter_exporter_push_dropped_batches',
+                                    'Push batches given up on: queue full (overflow), replaced by a newer '
+                                    'Pushgateway snapshot (superseded) or refused by the receiver (rejected)',
+                                    ('reason',))
+        self.push_health = None  # [queued batches, last success unix time] in push mode
+        self.events = Counter('twitter_exporter_events', 'Change events received in cdc mode by result', ('result',))
+        self.event_health = None  # [pending events, last applied unix time] in cdc mode
+        self.started = time.time()
+        self.last_rows = 0
+        self.last_duration = 0.0
+        self.last_success = 0.0
+        self.consecutive_failures = 0
+        self.data_is_mock = False
+
+        self._cycle_started = None
+        self._section_times = {}
+        self._cycle_rows = 0
+
+    # ----- recording -----
+
+    def begin_cycle(self):
+        self._cycle_started = time.perf_counter()
+        self._cycle_rows = 0
+
+    def end_cycle(self, success, mock=None):
+        """Observe the finished cycle; mock (default: not success) means mock data is served"""
+        if self._cycle_started is not None:
+            self.last_duration = time.perf_counter() - self._cycle_started
+            self.cycles.observe(self.last_duration)
+        self._cycle_started = None
+        for name, seconds in self._section_times.items():
+            self.sections.observe(seconds, name)
+        self._section_times = {}
+        self.last_rows = self._cycle_rows
+        if success:
+            self.cycle_results.inc(1, 'success')
+            self.last_success = time.time()
+            self.consecutive_failures = 0
+        else:
+            self.cycle_results.inc(1, 'failure')
+            self.consecutive_failures += 1
+        self.data_is_mock = not success if mock is None else mock
+
+    def add_time(self, name, seconds):
+        self._section_times[name] = self._section_times.get(name, 0.0) + seconds
+
+    @contextmanager
+    def section(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_rows(self, count):
+        self._cycle_rows += count
+        self.rows_scanned.inc(count)
+
+    def observe_query(self, name, seconds):
+        self.queries.observe(seconds, name)
+
+    def register_job(self, group, interval):
+        self.group_health.setdefault(group, [None, interval])
+
+    def observe_job(self, group, seconds, success, overran, interval):
+        """Record one scheduled refresh of a metric group (twitter_scheduler.Job)"""
+        self.group_durations.observe(seconds, group)
+        self.group_runs.inc(1, group, 'success' if success else 'failure')
+        if overran:
+            self.group_overruns.inc(1, group)
+        health = self.group_health.setdefault(group, [None, interval])
+        health[1] = interval
+        if success:
+            health[0] = time.time()
+
+    def register_push(self):
+        # Every label up front: the push thread only updates existing samples
+        self.push_health = [0, 0.0]
+        for result in ('success', 'failure'):
+            self.push_requests.inc(0, result)
+        for reason in ('overflow', 'superseded', 'rejected'):
+            self.push_dropped.inc(0, reason)
+        self.push_samples.inc(0)
+
+    def observe_push(self, success, samples, queued):
+        """Record one push request (twitter_push.Pusher, from its sender thread)"""
+        self.push_requests.inc(1, 'success' if success else 'failure')
+        self.push_health[0] = queued
+        if success:
+            self.push_samples.inc(samples)
+            self.push_health[1] = time.time()
+
+    def observe_push_drop(self, reason, queued):
+        self.push_dropped.inc(1, reason)
+        self.push_health[0] = queued
+
+    def register_events(self):
+        self.event_health = [0, 0.0]
+        for result in EVENT_RESULTS:
+            self.events.inc(0, result)
+
+    def observe_events(self, counts, pending):
+        """Record the results of one apply() of queued change events (twitter_cdc.EventCollector)"""
+        for result in EVENT_RESULTS:
+            if counts[result]:
+                self.events.inc(counts[result], result)
+        self.event_health[0] = pending
+        if counts['applied']:
+            self.event_health[1] = time.time()
+
+    def observe_target(self, cluster, keyspace, seconds, success):
+        """Record one finished (or failed) scan of a sharded collection target"""
+        self.target_durations.observe(seconds, cluster, keyspace)
+        health = self.target_health.setdefault((cluster, keyspace), [False, 0.0])
+        health[0] = success
+        if success:
+            health[1] = time.time()
+
+    # ----- exposition -----
+
+    def register(self, registry):
+        """Add copies of the exporter families to a snapshot's registry"""
+        for family in (self.cycles, self.sections, self.queries, self.cycle_results, self.rows_scanned):
+            registry.register(copy.deepcopy(family))
+        for name, help, value in (
+                ('twitter_exporter_last_cycle_duration_seconds', 'Wall time of the last collection cycle',
+                 self.last_duration),
+                ('twitter_exporter_last_cycle_rows', 'Rows read from the source in the last cycle', self.last_rows),
+                ('twitter_exporter_last_success_timestamp_seconds',
+                 'Unix time of the last successful collection cycle', self.last_success),
+                ('twitter_exporter_consecutive_failures', 'Collection cycles failed in a row',
+                 self.consecutive_failures),
+                ('twitter_exporter_data_is_mock', '1 while the fallback mock data is being served',
+                 int(self.data_is_mock))):
+            registry.register(Gauge(name, help)).set(value)
+        if self.group_health:
+            for family in (self.group_durations, self.group_runs, self.group_overruns):
+                registry.register(copy.deepcopy(family))
+            now = time.time()
+            staleness = registry.register(Gauge('twitter_exporter_group_staleness_seconds',
+                                                'Age of the metric group at render time (since start if never '
+                                                'refreshed)', ('group',)))
+            last_success = registry.register(Gauge('twitter_exporter_group_last_success_timestamp_seconds',
+                                                   'Unix time of the last successful refresh of the metric group '
+                                                   '(exporter start if never refreshed)', ('group',)))
+            interval = registry.register(Gauge('twitter_exporter_group_interval_seconds',
+                                               'Current refresh interval of the metric group, after overrun backoff',
+                                               ('group',)))
+            for group, (succeeded, seconds) in self.group_health.items():
+                staleness.set(now - (succeeded or self.started), group)
+                last_success.set(succeeded or self.started, group)
+                interval.set(seconds, group)
+        if self.push_health is not None:
+            for family in (self.push_requests, self.push_samples, self.push_dropped):
+                registry.register(copy.deepcopy(family))
+            queued, last_success = self.push_health
+            registry.register(Gauge('twitter_exporter_push_queue_batches',
+                                    'Batches waiting to be pushed to the receiver')).set(queued)
+            registry.register(Gauge('twitter_exporter_push_last_success_timestamp_seconds',
+                                    'Unix time of the last push the receiver accepted')).set(last_success)
+        if self.event_health is not None:
+            registry.register(copy.deepcopy(self.events))
+            pending, last_applied = self.event_health
+            registry.register(Gauge('twitter_exporter_events_pending',
+                                    'Change events queued for the next apply')).set(pending)
+            registry.register(Gauge('twitter_exporter_event_last_applied_timestamp_seconds',
+                                    'Unix time change events were last folded into the metrics')).set(last_applied)
+        if self.target_health:
+            registry.register(copy.deepcopy(self.target_durations))
+            up = registry.register(Gauge('twitter_exporter_target_up', '1 if the last scan of the target succeeded',
+                                         ('cluster', 'keyspace')))
+            last_success = registry.register(Gauge('twitter_exporter_target_last_success_timestamp_seconds',
+                                                   'Unix time of the last successful scan of the target',
+                                                   ('cluster', 'keyspace')))
+            for labels, (success, timestamp) in self.target_health.items():
+                up.set(int(success), *labels)
+                last_success.set(timestamp, *labels)
+
+
+# ===== PROFILER =====
+
+class CycleProfiler(object):
+    """Samples the collector thread's stack during cycles someone asked for"""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._waiting = []  # [event, result] per pending capture()
+        self._active = None
+
+    def capture(self, timeout):
+        """Block until the next full cycle was profiled; collapsed stacks or None"""
+        request = [threading.Event(), None]
+        with self._lock:
+            self._waiting.append(request)
+        if not request[0].wait(timeout):
+            with self._lock:
+                if request in self._waiting:
+                    self._waiting.remove(request)
+            return None
+        return request[1]
+
+    def begin_cycle(self):
+        """Start sampling the calling (collector) thread if a capture is pending"""
+        with self._lock:
+            waiting, self._waiting = self._waiting, []
+        if not waiting:
+            return
+        stacks = StackCounts()
+        done = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(threading.get_ident(), stacks, done), daemon=True)
+        sampler.start()
+        self._active = (waiting, stacks, done, sampler)
+
+    def end_cycle(self):
+        """Stop sampling and hand the collapsed stacks to every waiting capture()"""
+        if self._active is None:
+            return
+        waiting, stacks, done, sampler = self._active
+        self._active = None
+        done.set()
+        sampler.join()
+        result = collapsed(stacks)
+        for request in waiting:
+            request[1] = result
+            request[0].set()
+
+    def _sample(self, thread_id, stacks, done):
+        while not done.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stacks[';'.join(reversed(names))] += 1
+
+
+def collapsed(stacks):
+    """'frame;frame;frame count' lines, heaviest first (flamegraph.pl / speedscope input)"""
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
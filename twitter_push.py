@@ -0,0 +1,318 @@
+# twitter_push.py
+"""Push mode: send every finished snapshot to a Pushgateway or remote-write receiver.
+
+Scraped every 15s, a snapshot refreshed every 15s can be up to 30s old by the
+time Prometheus stores it. In push mode the collector hands each snapshot to
+a Pusher as soon as it is published:
+
+    pushgateway    PUT <url>/metrics/job/<job>/instance/<instance> with the
+                   snapshot's pre-rendered text exposition (the Pushgateway
+                   refuses sample timestamps and records push_time_seconds)
+    remote_write   POST <url> of snappy-compressed WriteRequest protobufs,
+                   every sample stamped with the collection time and the
+                   series split into batches of `batch_size`
+
+Encoded batches wait in a bounded queue that one sender thread drains over
+keep-alive connections (HTTPPool). While the receiver is down or answers
+5xx/429 the head batch is retried with exponential backoff; when the queue
+is full the oldest batch is dropped (reason "overflow"). A Pushgateway only
+needs the newest snapshot, so its queue holds one and a newer snapshot
+replaces an undelivered one (reason "superseded").
+"""
+import base64
+import http.client
+import queue
+import threading
+from collections import deque
+from urllib.parse import quote, urlsplit
+
+from twitter_registry import _field_bytes, _field_double, _field_varint, _varint
+
+PUSHGATEWAY = 'pushgateway'
+REMOTE_WRITE = 'remote_write'
+
+BATCH_SIZE = 500       # series per remote-write request
+MAX_QUEUE = 256        # batches buffered while the receiver is down
+POOL_SIZE = 2          # idle keep-alive connections kept per receiver
+REQUEST_TIMEOUT = 10   # seconds
+MIN_BACKOFF = 0.5      # seconds before the first retry, doubled per failure
+MAX_BACKOFF = 30
+
+REMOTE_WRITE_HEADERS = {
+    'Content-Type': 'application/x-protobuf',
+    'Content-Encoding': 'snappy',
+    'X-Prometheus-Remote-Write-Version': '0.1.0',
+}
+PUSHGATEWAY_HEADERS = {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+# ===== REMOTE WRITE ENCODING =====
+# prometheus/prompb: WriteRequest{timeseries=1}, TimeSeries{labels=1, samples=2},
+# Label{name=1, value=2}, Sample{value=1 double, timestamp=2 int64 ms}
+
+def registry_series(registry, extra_labels=()):
+    """[(labels sorted by name, including __name__, value)] for every sample of a registry"""
+    series = []
+    for name, labelnames, labelvalues, value in registry.samples():
+        labels = [('__name__', name)] + list(extra_labels) + list(zip(labelnames, labelvalues))
+        series.append((sorted(labels), value))
+    return series
+
+
+def write_request(series, timestamp_ms):
+    """Encode series that share one timestamp as a WriteRequest message"""
+    out = bytearray()
+    for labels, value in series:
+        message = b''.join(_field_bytes(1, _field_bytes(1, name.encode('utf-8')) +
+                                        _field_bytes(2, str(label_value).encode('utf-8')))
+                           for name, label_value in labels)
+        message += _field_bytes(2, _field_double(1, value) + _field_varint(2, timestamp_ms))
+        out += _field_bytes(1, message)
+    return bytes(out)
+
+
+# ===== SNAPPY =====
+# Raw (unframed) snappy block format, which remote-write requires. A greedy
+# compressor over 4-byte matches: slower and a little larger than the C
+# library, but WriteRequests of repeated label names compress well with it.
+
+SNAPPY_BLOCK = 1 << 16
+
+
+def snappy_compress(data):
+    out = bytearray(_varint(len(data)))
+    for start in range(0, len(data), SNAPPY_BLOCK):
+        _compress_block(data[start:start + SNAPPY_BLOCK], out)
+    return bytes(out)
+
+
+def _compress_block(block, out):
+    table = {}  # 4-byte sequence -> last position in the block
+    n = len(block)
+    i = literal_start = 0
+    while i + 4 <= n:
+        key = block[i:i + 4]
+        candidate = table.get(key)
+        table[key] = i
+        if candidate is None:
+            i += 1
+            continue
+        length = 4
+        while i + length < n and block[candidate + length] == block[i + length]:
+            length += 1
+        _emit_literal(block[literal_start:i], out)
+        _emit_copy(i - candidate, length, out)
+        i += length
+        literal_start = i
+    _emit_literal(block[literal_start:], out)
+
+
+def _emit_literal(chunk, out):
+    if not chunk:
+        return
+    n = len(chunk) - 1
+    if n < 60:
+        out.append(n << 2)
+    elif n < 256:
+        out += bytes((60 << 2, n))
+    else:
+        out += bytes((61 << 2,)) + n.to_bytes(2, 'little')
+    out += chunk
+
+
+def _emit_copy(offset, length, out):
+    while length >= 68:
+        out += bytes((63 << 2 | 2,)) + offset.to_bytes(2, 'little')
+        length -= 64
+    if length > 64:
+        out += bytes((59 << 2 | 2,)) + offset.to_bytes(2, 'little')
+        length -= 60
+    if length < 12 and offset < 2048:
+        out += bytes(((offset >> 8) << 5 | (length - 4) << 2 | 1, offset & 0xFF))
+    else:
+        out += bytes(((length - 1) << 2 | 2,)) + offset.to_bytes(2, 'little')
+
+
+# ===== HTTP =====
+
+class HTTPPool(object):
+    """Keep-alive HTTP(S) connections to one receiver, reused across requests"""
+
+    def __init__(self, url, size=POOL_SIZE, timeout=REQUEST_TIMEOUT):
+        parts = urlsplit(url)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.secure else 80)
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(size)
+
+    def _connect(self):
+        connection_type = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        return connection_type(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body, headers):
+        """(status, response body); a stale reused connection is retried once on a fresh one"""
+        while True:
+            try:
+                connection, reused = self._idle.get_nowait(), True
+            except queue.Empty:
+                connection, reused = self._connect(), False
+            try:
+                connection.request(method, self.base_path + path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                try:
+                    self._idle.put_nowait(connection)
+                except queue.Full:
+                    connection.close()
+            return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# ===== PUSHER =====
+
+class Batch(object):
+    __slots__ = ('body', 'samples')
+
+    def __init__(self, body, samples):
+        self.body = body
+        self.samples = samples
+
+
+class Pusher(object):
+    """Queues snapshots as encoded batches and sends them from a background thread"""
+
+    def __init__(self, url, protocol=PUSHGATEWAY, job='twitter-exporter', instance='', batch_size=BATCH_SIZE,
+                 max_queue=MAX_QUEUE, timeout=REQUEST_TIMEOUT, stats=None):
+        if protocol not in (PUSHGATEWAY, REMOTE_WRITE):
+            raise ValueError(f"Unknown push protocol {protocol!r}, expected {PUSHGATEWAY} or {REMOTE_WRITE}")
+        self.protocol = protocol
+        self.job = job
+        self.instance = instance
+        self.batch_size = batch_size
+        self.max_queue = 1 if protocol == PUSHGATEWAY else max_queue
+        self.drop_reason = 'superseded' if protocol == PUSHGATEWAY else 'overflow'
+        self.stats = stats
+        self.pool = HTTPPool(url, timeout=timeout)
+        if protocol == PUSHGATEWAY:
+            self.method, self.path, self.headers = 'PUT', self._group_path(), PUSHGATEWAY_HEADERS
+        else:
+            self.method, self.path, self.headers = 'POST', '', REMOTE_WRITE_HEADERS
+        if stats is not None:
+            stats.register_push()
+
+        self.failures = 0  # consecutive failed requests
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._sending = None  # batch in flight
+        self._closed = False
+        self._thread = None
+
+    def _group_path(self):
+        path = '/metrics/job/' + quote(self.job, safe='')
+        if self.instance:
+            if '/' in self.instance:
+                path += '/instance@base64/' + base64.urlsafe_b64encode(self.instance.encode('utf-8')).decode('ascii')
+            else:
+                path += '/instance/' + quote(self.instance, safe='')
+        return path
+
+    # ----- collector side -----
+
+    def push(self, snapshot):
+        """Encode a freshly published snapshot and queue it for sending"""
+        if self.protocol == PUSHGATEWAY:
+            samples = sum(1 for _ in snapshot.registry.samples())
+            batches = [Batch(snapshot.body('metrics').content, samples)]
+        else:
+            extra = [('job', self.job)] + ([('instance', self.instance)] if self.instance else [])
+            series = registry_series(snapshot.registry, extra)
+            timestamp_ms = int(snapshot.created * 1000)
+            batches = []
+            for start in range(0, len(series), self.batch_size):
+                chunk = series[start:start + self.batch_size]
+                batches.append(Batch(snappy_compress(write_request(chunk, timestamp_ms)), len(chunk)))
+        with self._cond:
+            for batch in batches:
+                if len(self._queue) >= self.max_queue:
+                    # A batch in flight is counted by the sender, and only if it fails
+                    if self._queue.popleft() is not self._sending and self.stats is not None:
+                        self.stats.observe_push_drop(self.drop_reason, len(self._queue))
+                self._queue.append(batch)
+            self._cond.notify()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='pusher', daemon=True)
+            self._thread.start()
+
+    def flush(self, timeout=None):
+        """Wait until the queue is empty (or timeout seconds); True when it is"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and self._sending is None, timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(REQUEST_TIMEOUT)
+        self.pool.close()
+
+    # ----- sender thread -----
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closed)
+                if self._closed:
+                    return
+                batch = self._sending = self._queue[0]
+            success, retry = self._send(batch)
+            with self._cond:
+                self._sending = None
+                queued = bool(self._queue) and self._queue[0] is batch
+                if (success or not retry) and queued:
+                    self._queue.popleft()
+                if self.stats is not None:
+                    self.stats.observe_push(success, batch.samples, len(self._queue))
+                    if not success and not retry:
+                        self.stats.observe_push_drop('rejected', len(self._queue))
+                    elif not success and not queued:
+                        self.stats.observe_push_drop(self.drop_reason, len(self._queue))
+                self._cond.notify_all()
+                if success or not retry:
+                    self.failures = 0
+                    continue
+                self.failures += 1
+                # Back off, but let a newer Pushgateway snapshot replace this one meanwhile
+                self._cond.wait(min(MAX_BACKOFF, MIN_BACKOFF * 2 ** (self.failures - 1)))
+
+    def _send(self, batch):
+        """(delivered, worth retrying)"""
+        try:
+            status, body = self.pool.request(self.method, self.path, batch.body, self.headers)
+        except (OSError, http.client.HTTPException) as e:
+            if self.failures == 0:
+                print(f"Push to {self.pool.host}:{self.pool.port} failed ({type(e).__name__}): {str(e)[:200]}")
+            return False, True
+        if 200 <= status < 300:
+            return True, False
+        retry = status >= 500 or status == 429
+        if self.failures == 0 or not retry:
+            print(f"Push to {self.pool.host}:{self.pool.port} answered {status}: "
+                  f"{body[:200].decode('utf-8', 'replace')}")
+        return False, retry
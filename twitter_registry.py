@@ -0,0 +1,490 @@
+# twitter_registry.py
+"""Typed metric registry: histogram families and labelled gauges.
+
+Bucket counts are exposed as real Prometheus histograms
+(twitter_retweets_bucket{le="50"}, _sum, _count) and per-hour / per-rank /
+per-window values as one gauge family with a label, instead of one flat
+gauge name per bucket. The registry keeps the structured data, so the JSON
+endpoints read buckets from it directly.
+
+The exporter's own instrumentation (twitter_instrumentation.py) adds
+counters and labelled histograms that accumulate observations.
+
+Expositions: Prometheus text 0.0.4, OpenMetrics 1.0 text, and the
+length-delimited protobuf format (io.prometheus.client.MetricFamily).
+"""
+import bisect
+import itertools
+import math
+import struct
+from collections import OrderedDict
+
+from twitter_aggregator import (
+    ENGAGEMENT_BUCKETS, LIKE_BUCKETS, PERCENTILES, RETWEET_BUCKETS, TEXT_LENGTH_BUCKETS,
+    TIME_WINDOWS, USER_ACTIVITY_BUCKETS,
+)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROTOBUF_CONTENT_TYPE = ('application/vnd.google.protobuf; '
+                         'proto=io.prometheus.client.MetricFamily; encoding=delimited')
+
+GAUGE = 'gauge'
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+
+# ===== FAMILIES =====
+
+class MetricFamily(object):
+    def __init__(self, name, help, type, labelnames=()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+
+
+class Gauge(MetricFamily):
+    """Gauge family; one sample per label combination"""
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, GAUGE, labelnames)
+        self.samples = OrderedDict()  # label values tuple -> value
+
+    def set(self, value, *labelvalues):
+        self.samples[tuple(str(v) for v in labelvalues)] = value
+
+    def get(self, *labelvalues, default=0):
+        return self.samples.get(tuple(str(v) for v in labelvalues), default)
+
+
+class Counter(Gauge):
+    """Counter family; `name` is given without the _total suffix"""
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.type = COUNTER
+
+    def inc(self, amount=1, *labelvalues):
+        key = tuple(str(v) for v in labelvalues)
+        self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Histogram(MetricFamily):
+    """Histogram family built from per-bucket (non-cumulative) counts.
+
+    `keys` are short names for each bucket (e.g. '11_50') used by the JSON
+    endpoints; `upper_bounds` are the matching `le` values, the last one +Inf.
+    """
+
+    def __init__(self, name, help, upper_bounds, keys):
+        super().__init__(name, help, HISTOGRAM)
+        self.upper_bounds = list(upper_bounds)
+        self.keys = list(keys)
+        self.counts = [0] * len(self.keys)
+        self.sum = 0
+
+    def set_buckets(self, counts, total):
+        self.counts = list(counts)
+        self.sum = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        running = 0
+        for bound, count in zip(self.upper_bounds, self.counts):
+            running += count
+            yield bound, running
+
+    def distribution(self):
+        """{bucket key: count} in bucket order"""
+        return OrderedDict(zip(self.keys, self.counts))
+
+    def series(self):
+        """(label values, cumulative buckets, sum, count) per child"""
+        yield (), list(self.cumulative()), self.sum, self.count
+
+
+class LabelledHistogram(MetricFamily):
+    """Histogram family fed by observe(), one child per label combination"""
+
+    def __init__(self, name, help, upper_bounds, labelnames=()):
+        super().__init__(name, help, HISTOGRAM, labelnames)
+        self.upper_bounds = list(upper_bounds) + [math.inf]
+        self.children = OrderedDict()  # label values tuple -> [bucket counts, sum]
+
+    def observe(self, value, *labelvalues):
+        key = tuple(str(v) for v in labelvalues)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = [[0] * len(self.upper_bounds), 0.0]
+        child[0][bisect.bisect_left(self.upper_bounds, value)] += 1
+        child[1] += value
+
+    def series(self):
+        for key, (counts, total) in self.children.items():
+            cumulative = list(zip(self.upper_bounds, itertools.accumulate(counts)))
+            yield key, cumulative, total, cumulative[-1][1]
+
+
+class TargetFamily(MetricFamily):
+    """One family gathered from several registries, each series prefixed with its registry's labels"""
+
+    def __init__(self, family, labelnames):
+        super().__init__(family.name, family.help, family.type, tuple(labelnames) + family.labelnames)
+        self.samples = OrderedDict()  # gauges / counters
+        self.children = []            # histograms: (label values, family)
+
+    def add(self, labelvalues, family):
+        labelvalues = tuple(str(v) for v in labelvalues)
+        if self.type == HISTOGRAM:
+            self.children.append((labelvalues, family))
+        else:
+            for values, value in family.samples.items():
+                self.samples[labelvalues + values] = value
+
+    def series(self):
+        for labelvalues, family in self.children:
+            for values, buckets, total, count in family.series():
+                yield labelvalues + values, buckets, total, count
+
+
+class Registry(object):
+    """Ordered collection of metric families"""
+
+    def __init__(self):
+        self.families = OrderedDict()
+
+    def register(self, family):
+        self.families[family.name] = family
+        return family
+
+    def get(self, name):
+        return self.families.get(name)
+
+    def render_text(self):
+        """Prometheus text exposition format 0.0.4"""
+        lines = []
+        for family in self.families.values():
+            name = family.name + '_total' if family.type == COUNTER else family.name
+            lines.append(f"# HELP {name} {_escape_help(family.help)}")
+            lines.append(f"# TYPE {name} {family.type}")
+            lines.extend(_sample_lines(family))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def render_openmetrics(self):
+        """OpenMetrics 1.0 text exposition"""
+        lines = []
+        for family in self.families.values():
+            lines.append(f"# TYPE {family.name} {family.type}")
+            lines.append(f"# HELP {family.name} {_escape_help(family.help)}")
+            lines.extend(_sample_lines(family))
+        lines.append('# EOF')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def samples(self):
+        """Every exposed sample as (name, label names, label values, value)"""
+        for family in self.families.values():
+            yield from family_samples(family)
+
+    def render_protobuf(self):
+        """Length-delimited io.prometheus.client.MetricFamily messages"""
+        out = bytearray()
+        for family in self.families.values():
+            message = _encode_family(family)
+            out += _varint(len(message)) + message
+        return bytes(out)
+
+
+# ===== TEXT ENCODING =====
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+    return str(value)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)) + '}'
+
+
+def family_samples(family):
+    """(sample name, label names, label values, value) of every sample the family exposes"""
+    if family.type == HISTOGRAM:
+        bucket_labels = family.labelnames + ('le',)
+        for labelvalues, buckets, total, count in family.series():
+            for bound, cumulative in buckets:
+                yield family.name + '_bucket', bucket_labels, labelvalues + (_format_value(float(bound)),), cumulative
+            yield family.name + '_sum', family.labelnames, labelvalues, total
+            yield family.name + '_count', family.labelnames, labelvalues, count
+    else:
+        name = family.name + '_total' if family.type == COUNTER else family.name
+        for labelvalues, value in family.samples.items():
+            yield name, family.labelnames, labelvalues, value
+
+
+def _sample_lines(family):
+    for name, labelnames, labelvalues, value in family_samples(family):
+        yield f"{name}{_labels(labelnames, labelvalues)} {_format_value(value)}"
+
+
+# ===== PROTOBUF ENCODING =====
+# Only the handful of fields the exporter needs from metrics.proto.
+
+_PROTO_TYPES = {COUNTER: 0, GAUGE: 1, HISTOGRAM: 4}
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _field_bytes(number, payload):
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _field_varint(number, value):
+    return _varint(number << 3) + _varint(value)
+
+
+def _field_double(number, value):
+    return _varint(number << 3 | 1) + struct.pack('<d', float(value))
+
+
+def _encode_labels(names, values):
+    out = b''
+    for name, value in zip(names, values):
+        out += _field_bytes(1, _field_bytes(1, name.encode('utf-8')) + _field_bytes(2, value.encode('utf-8')))
+    return out
+
+
+def _encode_family(family):
+    name = family.name + '_total' if family.type == COUNTER else family.name
+    message = _field_bytes(1, name.encode('utf-8'))
+    message += _field_bytes(2, family.help.encode('utf-8'))
+    message += _field_varint(3, _PROTO_TYPES[family.type])
+    if family.type == HISTOGRAM:
+        for labelvalues, buckets, total, count in family.series():
+            histogram = _field_varint(1, count) + _field_double(2, total)
+            for bound, cumulative in buckets:
+                bucket = _field_varint(1, cumulative) + _field_double(2, bound)
+                histogram += _field_bytes(3, bucket)
+            metric = _encode_labels(family.labelnames, labelvalues) + _field_bytes(7, histogram)
+            message += _field_bytes(4, metric)
+    else:
+        # Gauge is field 2 of Metric, Counter field 3; both wrap a double value
+        value_field = 3 if family.type == COUNTER else 2
+        for labelvalues, value in family.samples.items():
+            metric = _encode_labels(family.labelnames, labelvalues)
+            metric += _field_bytes(value_field, _field_double(1, value))
+            message += _field_bytes(4, metric)
+    return message
+
+
+# ===== EXPORTER METRICS =====
+
+METRIC_HELP = {
+    'twitter_tweets_total': 'Total number of tweets stored',
+    'twitter_total_retweets': 'Sum of retweets over all tweets',
+    'twitter_total_likes': 'Sum of likes over all tweets',
+    'twitter_avg_retweets': 'Average retweets per tweet',
+    'twitter_avg_likes': 'Average likes per tweet',
+    'twitter_max_retweets': 'Most retweets on a single tweet',
+    'twitter_max_likes': 'Most likes on a single tweet',
+    'twitter_min_retweets': 'Fewest retweets on a single tweet',
+    'twitter_min_likes': 'Fewest likes on a single tweet',
+    'twitter_median_retweets': 'Median retweets per tweet',
+    'twitter_median_likes': 'Median likes per tweet',
+    'twitter_stddev_retweets': 'Sample standard deviation of retweets per tweet',
+    'twitter_stddev_likes': 'Sample standard deviation of likes per tweet',
+    'twitter_total_users': 'Number of distinct users',
+    'twitter_tweets_per_hour': 'Tweets posted in the last hour',
+    'twitter_engagement_ratio': '(retweets + likes) per tweet',
+    'twitter_retweet_ratio': 'Retweets per tweet',
+    'twitter_like_ratio': 'Likes per tweet',
+    'twitter_virality_score': 'Max retweets divided by average retweets',
+    'twitter_avg_text_length': 'Average tweet length in characters',
+    'twitter_max_text_length': 'Longest tweet in characters',
+    'twitter_min_text_length': 'Shortest tweet in characters',
+    'twitter_high_engagement_tweets': 'Tweets with more than 100 retweets or 500 likes',
+    'twitter_viral_tweets': 'Tweets with more than 1000 retweets',
+    'twitter_tweets_per_user': 'Average tweets per user',
+    'twitter_retweets_per_user': 'Average retweets per user',
+    'twitter_likes_per_user': 'Average likes per user',
+}
+
+# (family, help, bucket definition, flat-name prefix, JSON key, sum metric(s))
+HISTOGRAMS = [
+    ('twitter_retweets', 'Tweets by retweet count', RETWEET_BUCKETS, 'twitter_retweets_',
+     'retweet_distribution', ('twitter_total_retweets',)),
+    ('twitter_likes', 'Tweets by like count', LIKE_BUCKETS, 'twitter_likes_',
+     'like_distribution', ('twitter_total_likes',)),
+    ('twitter_text_length', 'Tweets by text length in characters', TEXT_LENGTH_BUCKETS, 'twitter_text_length_',
+     'text_length_distribution', ()),
+    ('twitter_user_tweets', 'Users by number of tweets posted', USER_ACTIVITY_BUCKETS, 'twitter_users_',
+     'user_activity_distribution', ('twitter_tweets_total',)),
+    ('twitter_engagement', 'Tweets by engagement (retweets + likes)', ENGAGEMENT_BUCKETS, 'twitter_engagement_',
+     'engagement_distribution', ('twitter_total_retweets', 'twitter_total_likes')),
+]
+
+TOP_USER_FIELDS = [
+    ('tweets', 'twitter_top_user_tweets', 'Tweets posted by the N-th most active user'),
+    ('avg_retweets', 'twitter_top_user_avg_retweets', 'Average retweets of the N-th most active user'),
+    ('avg_likes', 'twitter_top_user_avg_likes', 'Average likes of the N-th most active user'),
+]
+
+
+def upper_bounds(buckets):
+    """`le` bounds for integer buckets given by inclusive lower bounds"""
+    return [low - 1 for _, low in buckets[1:]] + [math.inf]
+
+
+def build_registry(metrics):
+    """Build the typed registry from a collected metrics dict.
+
+    Known bucket, hour, window, percentile and top-user entries are grouped
+    into histogram / labelled families; anything else becomes a plain gauge.
+    """
+    registry = Registry()
+    consumed = set()
+
+    def scalar(name):
+        if name in metrics:
+            registry.register(Gauge(name, METRIC_HELP.get(name, name.replace('_', ' ')))).set(metrics[name])
+            consumed.add(name)
+
+    scalar('twitter_tweets_total')
+    for name in ('total_retweets', 'total_likes', 'avg_retweets', 'avg_likes', 'max_retweets', 'max_likes',
+                 'min_retweets', 'min_likes', 'median_retweets', 'median_likes', 'stddev_retweets', 'stddev_likes'):
+        scalar('twitter_' + name)
+
+    for family, help, buckets, prefix, _, sum_names in HISTOGRAMS:
+        names = [name for name, _ in buckets]
+        if not any(name in metrics for name in names):
+            continue
+        keys = [name[len(prefix):] for name in names]
+        histogram = registry.register(Histogram(family, help, upper_bounds(buckets), keys))
+        total = sum(metrics.get(name, 0) for name in sum_names)
+        if family == 'twitter_text_length':
+            total = metrics.get('twitter_avg_text_length', 0) * metrics.get('twitter_tweets_total', 0)
+        histogram.set_buckets([metrics.get(name, 0) for name in names], total)
+        consumed.update(names)
+
+    hours = [f'twitter_hour_{hour:02d}_tweets' for hour in range(24)]
+    if any(name in metrics for name in hours):
+        gauge = registry.register(Gauge('twitter_hour_tweets', 'Tweets in the last 7 days by UTC hour of day',
+                                        ('hour',)))
+        for hour, name in enumerate(hours):
+            gauge.set(metrics.get(name, 0), f'{hour:02d}')
+        consumed.update(hours)
+
+    scalar('twitter_total_users')
+    for family, help, prefix in (
+            ('twitter_active_users', 'Distinct users that tweeted within the window', 'twitter_active_users_'),
+            ('twitter_tweets_last', 'Tweets posted within the window', 'twitter_tweets_last_')):
+        names = [(label, prefix + label) for label, _ in TIME_WINDOWS if prefix + label in metrics]
+        if names:
+            gauge = registry.register(Gauge(family, help, ('window',)))
+            for label, name in names:
+                gauge.set(metrics[name], label)
+                consumed.add(name)
+    scalar('twitter_tweets_per_hour')
+
+    for name in ('engagement_ratio', 'retweet_ratio', 'like_ratio', 'virality_score'):
+        scalar('twitter_' + name)
+
+    for field, family, help in TOP_USER_FIELDS:
+        rank = 1
+        gauge = None
+        while f'twitter_top_user_{rank}_{field}' in metrics:
+            if gauge is None:
+                gauge = registry.register(Gauge(family, help, ('rank',)))
+            name = f'twitter_top_user_{rank}_{field}'
+            gauge.set(metrics[name], rank)
+            consumed.update([name, f'twitter_top_user_{rank}_name_tweets'])
+            rank += 1
+
+    for column in ('retweets', 'likes'):
+        names = [(p, f'twitter_{column}_p{p}') for p in PERCENTILES if f'twitter_{column}_p{p}' in metrics]
+        if names:
+            gauge = registry.register(Gauge(f'twitter_{column}_percentile',
+                                            f'{column.capitalize()} percentiles over tweets with {column} > 0',
+                                            ('quantile',)))
+            for p, name in names:
+                gauge.set(metrics[name], p / 100)
+                consumed.add(name)
+
+    for name in ('avg_text_length', 'max_text_length', 'min_text_length', 'high_engagement_tweets',
+                 'viral_tweets', 'tweets_per_user', 'retweets_per_user', 'likes_per_user'):
+        scalar('twitter_' + name)
+
+    for name in metrics:
+        if name not in consumed:
+            scalar(name)
+    return registry
+
+
+def label_registries(registries, labelnames):
+    """Merge (label values, registry) pairs into one registry with `labelnames` on every series"""
+    merged = Registry()
+    for labelvalues, registry in registries:
+        for family in registry.families.values():
+            target = merged.get(family.name)
+            if target is None:
+                target = merged.register(TargetFamily(family, labelnames))
+            target.add(labelvalues, family)
+    return merged
+
+
+def total_registry(registries):
+    """Bucket histograms and the hour-of-day gauge summed over registries (JSON endpoints)"""
+    total = Registry()
+    for registry in registries:
+        for family, _, _, _, _, _ in HISTOGRAMS:
+            histogram = registry.get(family)
+            if histogram is None:
+                continue
+            summed = total.get(family)
+            if summed is None:
+                summed = total.register(Histogram(family, histogram.help, histogram.upper_bounds, histogram.keys))
+            summed.set_buckets([a + b for a, b in zip(summed.counts, histogram.counts)], summed.sum + histogram.sum)
+        hours = registry.get('twitter_hour_tweets')
+        if hours is not None:
+            summed = total.get(hours.name) or total.register(Gauge(hours.name, hours.help, hours.labelnames))
+            for labelvalues, value in hours.samples.items():
+                summed.set(summed.get(*labelvalues) + value, *labelvalues)
+    return total
+
+
+def histogram_payload(registry):
+    """/histogram_data body: bucket distributions straight from the registry"""
+    histograms = OrderedDict()
+    for family, _, _, _, key, _ in HISTOGRAMS:
+        histogram = registry.get(family)
+        histograms[key] = histogram.distribution() if histogram is not None else {}
+    hours = registry.get('twitter_hour_tweets')
+    histograms['hourly_distribution'] = OrderedDict(
+        (labels[0], value) for labels, value in hours.samples.items()) if hours is not None else {}
+    return histograms
@@ -0,0 +1,238 @@
+# twitter_rollups.py
+"""Time-bucketed rollups of the tweets table for window and hour-of-day metrics.
+
+The exporter folds every tweet it reads into per-minute buckets (last 24
+hours) and per-hour buckets (last 7 days) holding the tweet count, retweet
+and like sums and the set of users who tweeted. Changed buckets are upserted
+into rollup tables partitioned by time (minutes by hour, hours by UTC day),
+so window_metrics() answers the twitter_tweets_last_*,
+twitter_active_users_* and twitter_hour_NN_tweets metrics by reading
+~25 + 8 small partitions instead of filtering the whole tweets table on
+date. The exporter does that on the rollups interval, which lets the
+tweets scan (still needed for totals, percentiles and top users) run less
+often; dashboards and other services can read the tables the same way.
+
+Window edges are rounded to the bucket: a minute inside the last day, an
+hour for the 7-day window and the hour-of-day distribution.
+
+Schema: cassandra-config/migrations/001_tweet_rollups.cql.
+Backfill: python twitter_exporter.py backfill-rollups
+"""
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+
+MINUTE_MS = 60 * 1000
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+
+MINUTE_RETENTION_MS = DAY_MS + HOUR_MS        # minute buckets serve 1h/6h/24h
+HOUR_RETENTION_MS = 7 * DAY_MS + HOUR_MS      # hour buckets serve 7d and hour-of-day
+
+# (table, bucket width, partition width, retention)
+MINUTE_TABLE = ('tweet_rollup_minute', MINUTE_MS, HOUR_MS, MINUTE_RETENTION_MS)
+HOUR_TABLE = ('tweet_rollup_hour', HOUR_MS, DAY_MS, HOUR_RETENTION_MS)
+
+ROLLUP_COLUMNS = ('tweets', 'retweets', 'likes', 'users')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_datetime(ms):
+    """Epoch ms -> naive UTC datetime (what the Cassandra driver round-trips)"""
+    return EPOCH + timedelta(milliseconds=int(ms))
+
+
+def to_ms(date):
+    return int((date - EPOCH) // timedelta(milliseconds=1))
+
+
+class Bucket(object):
+    __slots__ = ('tweets', 'retweets', 'likes', 'users')
+
+    def __init__(self, tweets=0, retweets=0, likes=0, users=()):
+        self.tweets = tweets
+        self.retweets = retweets
+        self.likes = likes
+        self.users = set(users)
+
+    def key(self):
+        """Cheap change detector for skipping unchanged upserts"""
+        return self.tweets, self.retweets, self.likes, len(self.users)
+
+
+class RollupBuckets(object):
+    """In-memory minute and hour buckets, fed page by page with the aggregator"""
+
+    def __init__(self):
+        self.tiers = {MINUTE_TABLE[0]: {}, HOUR_TABLE[0]: {}}  # table -> {bucket start ms: Bucket}
+
+    def add(self, users, retweets, likes, dates_ms, now_ms):
+        """Fold one page; users is a sequence, the rest numpy columns"""
+        for table, width, _, retention in (MINUTE_TABLE, HOUR_TABLE):
+            rows = np.flatnonzero(dates_ms > now_ms - retention)
+            if len(rows) == 0:
+                continue
+            starts, inverse = np.unique(dates_ms[rows] // width * width, return_inverse=True)
+            tweets = np.bincount(inverse, minlength=len(starts))
+            retweet_sums = np.bincount(inverse, weights=retweets[rows], minlength=len(starts))
+            like_sums = np.bincount(inverse, weights=likes[rows], minlength=len(starts))
+            order = np.argsort(inverse, kind='stable')
+            bounds = np.concatenate([[0], np.cumsum(tweets)])
+            buckets = self.tiers[table]
+            for i, start in enumerate(starts.tolist()):
+                bucket = buckets.get(start)
+                if bucket is None:
+                    bucket = buckets[start] = Bucket()
+                bucket.tweets += int(tweets[i])
+                bucket.retweets += int(retweet_sums[i])
+                bucket.likes += int(like_sums[i])
+                bucket.users.update(users[row] for row in rows[order[bounds[i]:bounds[i + 1]]])
+                bucket.users.discard(None)
+
+    def merge(self, other):
+        for table, buckets in other.tiers.items():
+            for start, theirs in buckets.items():
+                bucket = self.tiers[table].get(start)
+                if bucket is None:
+                    bucket = self.tiers[table][start] = Bucket()
+                bucket.tweets += theirs.tweets
+                bucket.retweets += theirs.retweets
+                bucket.likes += theirs.likes
+                bucket.users |= theirs.users
+
+    def prune(self, now_ms):
+        for table, _, _, retention in (MINUTE_TABLE, HOUR_TABLE):
+            buckets = self.tiers[table]
+            for start in [start for start in buckets if start <= now_ms - retention - HOUR_MS]:
+                del buckets[start]
+
+
+class RollupWriter(object):
+    """Upserts buckets that changed since the last flush"""
+
+    def __init__(self, store):
+        self.store = store
+        self.written = {}  # (table, start) -> Bucket.key() last written
+
+    def flush(self, rollups, now_ms):
+        """Write new or changed buckets of a RollupBuckets; returns rows written"""
+        rollups.prune(now_ms)
+        written = 0
+        for table, _, partition, _ in (MINUTE_TABLE, HOUR_TABLE):
+            changed = {start: bucket.key() for start, bucket in rollups.tiers[table].items()
+                       if self.written.get((table, start)) != bucket.key()}
+            self.store.write(table, [(start // partition * partition, start, rollups.tiers[table][start])
+                                     for start in changed])
+            self.written.update(((table, start), key) for start, key in changed.items())
+            written += len(changed)
+        horizon = now_ms - HOUR_RETENTION_MS - HOUR_MS
+        self.written = {key: value for key, value in self.written.items() if key[1] > horizon}
+        return written
+
+
+def window_metrics(store, now_ms, windows, hour_window_ms=7 * DAY_MS):
+    """Window and hour-of-day metrics read back from the rollup partitions"""
+    out = {}
+    minutes = store.read(MINUTE_TABLE[0], _partitions(now_ms, DAY_MS, HOUR_MS), now_ms - DAY_MS - MINUTE_MS)
+    hours = store.read(HOUR_TABLE[0], _partitions(now_ms, hour_window_ms, DAY_MS), now_ms - hour_window_ms - HOUR_MS)
+
+    def select(cutoff):
+        if cutoff >= now_ms - DAY_MS:
+            return [bucket for start, bucket in minutes if start + MINUTE_MS > cutoff]
+        return [bucket for start, bucket in hours if start + HOUR_MS > cutoff]
+
+    hour_of_day = [0] * 24
+    for start, bucket in hours:
+        if start + HOUR_MS > now_ms - hour_window_ms:
+            hour_of_day[(start % DAY_MS) // HOUR_MS] += bucket.tweets
+    for hour in range(24):
+        out[f'twitter_hour_{hour:02d}_tweets'] = hour_of_day[hour]
+
+    for label, hours_back in windows:
+        users = set()
+        for bucket in select(now_ms - hours_back * HOUR_MS):
+            users |= bucket.users
+        out[f'twitter_active_users_{label}'] = len(users)
+    for label, hours_back in windows:
+        out[f'twitter_tweets_last_{label}'] = sum(bucket.tweets for bucket in select(now_ms - hours_back * HOUR_MS))
+    out['twitter_tweets_per_hour'] = out.get('twitter_tweets_last_1h', 0)
+    return out
+
+
+def window_metric_names(windows):
+    """Names window_metrics() fills, for the same windows"""
+    return ([f'twitter_hour_{hour:02d}_tweets' for hour in range(24)]
+            + [f'twitter_active_users_{label}' for label, _ in windows]
+            + [f'twitter_tweets_last_{label}' for label, _ in windows]
+            + ['twitter_tweets_per_hour'])
+
+
+def _partitions(now_ms, span_ms, partition_ms):
+    first = (now_ms - span_ms - partition_ms) // partition_ms * partition_ms
+    return list(range(first, now_ms + 1, partition_ms))
+
+
+# ===== STORES =====
+
+class CassandraRollupStore(object):
+    """Rollup tables in the exporter's keyspace, through the shared CassandraSource"""
+
+    def __init__(self, source):
+        self.source = source
+
+    def write(self, table, rows):
+        if not rows:
+            return
+        statement = self.source.prepare(
+            f"INSERT INTO {table} (bucket, start, {', '.join(ROLLUP_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)")
+        params = [(to_datetime(partition), to_datetime(start), b.tweets, b.retweets, b.likes, b.users)
+                  for partition, start, b in rows]
+        for _ in self.source.fan_out(statement, params, 'rollup_write'):
+            pass
+
+    def read(self, table, partitions, since_ms):
+        """[(bucket start ms, Bucket)] from the given partitions, newer than since_ms"""
+        statement = self.source.prepare(
+            f"SELECT start, {', '.join(ROLLUP_COLUMNS)} FROM {table} WHERE bucket = ? AND start > ?")
+        params = [(to_datetime(partition), to_datetime(since_ms)) for partition in partitions]
+        return [(to_ms(row.start), Bucket(row.tweets or 0, row.retweets or 0, row.likes or 0, row.users or ()))
+                for row in self.source.fan_out(statement, params, 'rollup_read')]
+
+
+class SQLiteRollupStore(object):
+    """Same tables in the SQLite stand-in (users as a JSON array)"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS {table} (
+            bucket INTEGER,
+            start INTEGER,
+            tweets INTEGER,
+            retweets INTEGER,
+            likes INTEGER,
+            users TEXT,
+            PRIMARY KEY (bucket, start)
+        )
+    """
+
+    def __init__(self, source):
+        self.conn = source.conn
+        for table in (MINUTE_TABLE[0], HOUR_TABLE[0]):
+            self.conn.execute(self.SCHEMA.format(table=table))
+
+    def write(self, table, rows):
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {table} (bucket, start, {', '.join(ROLLUP_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+            ((partition, start, b.tweets, b.retweets, b.likes, json.dumps(sorted(b.users, key=str)))
+             for partition, start, b in rows))
+        self.conn.commit()
+
+    def read(self, table, partitions, since_ms):
+        if not partitions:
+            return []
+        cursor = self.conn.execute(
+            f"SELECT start, {', '.join(ROLLUP_COLUMNS)} FROM {table} "
+            f"WHERE bucket IN ({', '.join('?' * len(partitions))}) AND start > ?", list(partitions) + [since_ms])
+        return [(start, Bucket(tweets, retweets, likes, json.loads(users)))
+                for start, tweets, retweets, likes, users in cursor]
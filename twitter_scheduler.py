@@ -0,0 +1,96 @@
+# twitter_scheduler.py
+"""Collection scheduler: per-group refresh intervals, cost budgets and jitter.
+
+Every metric group is refreshed by one Job - the tweets scan (or the
+incremental catch-up), the incremental reconciliation, the rollup windows -
+with its own interval. Instead of a fixed sleep the collector wakes up when
+the next job is due and runs every due job, cheapest priority first, so a
+slow job never makes the others queue behind a growing backlog.
+
+A job has a cost budget (its interval by default). When a run takes longer
+than that, its following runs are pushed out by 2, 4, ... up to
+`max_defer` intervals until a run fits the budget again, which bounds the
+load an expensive query can put on the database. Each run is scheduled with
+up to `jitter` of its interval added, so exporters started together drift
+apart.
+"""
+import random
+import time
+
+DEFAULT_JITTER = 0.1  # fraction of the interval
+DEFAULT_MAX_DEFER = 8  # overrunning jobs wait at most this many intervals
+
+
+class Job(object):
+    """One metric group: how to refresh it and how often"""
+
+    def __init__(self, name, run, interval, budget=None, priority=0, delay=0.0):
+        self.name = name
+        self.run = run
+        self.interval = interval
+        self.budget = interval if budget is None else budget
+        self.priority = priority  # lower runs first within a wake-up
+        self.delay = delay        # seconds before the first run
+
+        self.next_run = None
+        self.defer = 1            # current interval multiplier after overruns
+        self.last_duration = 0.0
+        self.last_success = None  # wall-clock time of the last successful run
+
+
+class Scheduler(object):
+    """Runs due jobs; reports every run to CollectorStats when given"""
+
+    def __init__(self, jobs, jitter=DEFAULT_JITTER, max_defer=DEFAULT_MAX_DEFER, stats=None,
+                 clock=time.monotonic, rng=random.random):
+        self.jobs = sorted(jobs, key=lambda job: job.priority)
+        self.jitter = jitter
+        self.max_defer = max_defer
+        self.stats = stats
+        self.clock = clock
+        self.rng = rng
+        started = clock()
+        for job in self.jobs:
+            job.next_run = started + job.delay
+            if stats is not None:
+                stats.register_job(job.name, job.interval)
+
+    def due(self):
+        now = self.clock()
+        return [job for job in self.jobs if job.next_run <= now]
+
+    def wait_time(self):
+        """Seconds until the next job is due"""
+        return max(0.0, min(job.next_run for job in self.jobs) - self.clock())
+
+    def run_due(self):
+        """Run every due job once; returns [(job, exception or None)]"""
+        results = []
+        for job in self.due():
+            started = self.clock()
+            error = None
+            try:
+                job.run()
+            except Exception as e:
+                error = e
+            finished = self.clock()
+            job.last_duration = finished - started
+            overran = job.last_duration > job.budget
+            if error is None:
+                job.last_success = time.time()
+            self._reschedule(job, finished, overran)
+            if self.stats is not None:
+                self.stats.observe_job(job.name, job.last_duration, error is None, overran,
+                                       job.interval * job.defer)
+            results.append((job, error))
+        return results
+
+    def _reschedule(self, job, finished, overran):
+        if overran:
+            job.defer = min(job.defer * 2, self.max_defer)
+            print(f"{job.name} took {job.last_duration:.1f}s (budget {job.budget:.0f}s), "
+                  f"next run in {job.interval * job.defer:.0f}s")
+        else:
+            job.defer = 1
+        interval = job.interval * job.defer
+        job.next_run = finished + interval + self.rng() * self.jitter * job.interval
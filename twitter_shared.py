@@ -0,0 +1,130 @@
+# twitter_shared.py
+"""Share finished snapshots between one collector and many server workers.
+
+The collector process pickles each Snapshot into one of two slots of a
+memory-mapped file (on /dev/shm where available) and then flips the header
+to point at it. Workers map the same file read-only, compare the header
+version with the one they cached and only unpickle when a new cycle has
+been published - a scrape normally costs one 32-byte header read.
+
+The writer always fills the slot the header does *not* point at, but a
+reader that is slow to copy can still be overtaken: once the next publish
+has flipped the header, the one after it rewrites the slot the reader is
+copying. Each slot is therefore guarded by its own sequence number (a
+seqlock) - odd while the writer fills it, bumped again once it is done. A
+reader copies the slot between two reads of that number and retries unless
+both are the same even value.
+"""
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+
+MAGIC = b'TWSNAP02'
+HEADER = struct.Struct('<8sQQQ')  # magic, version, slot, length
+SEQUENCE = struct.Struct('<Q')    # per-slot seqlock, odd while the slot is written
+SLOT_HEADER = struct.Struct('<QQ')  # version, length of the snapshot in the slot
+SLOT_SIZE = 16 * 1024 * 1024
+
+
+def default_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'twitter_exporter.snapshot')
+
+
+class SharedSnapshot(object):
+    """Double-buffered snapshot file; publish() in the collector, read() in workers"""
+
+    def __init__(self, path, slot_size=SLOT_SIZE):
+        self.path = path
+        self.slot_size = slot_size
+        self._map = None
+        self._writable = False
+        self._cached = None
+        self._cached_version = 0
+
+    # ----- writer -----
+
+    def publish(self, snapshot):
+        """Write a snapshot to the idle slot and flip the header to it"""
+        data = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size:
+            print(f"Snapshot of {len(data)} bytes does not fit the {self.slot_size} byte shared slot")
+            return False
+        m = self._open(writable=True)
+        magic, version, slot, _ = HEADER.unpack(m[0:HEADER.size])
+        if magic != MAGIC:
+            version, slot = 0, 1
+        slot = 1 - slot
+        offset = self._offset(slot)
+        sequence = (SEQUENCE.unpack(m[offset:offset + SEQUENCE.size])[0] + 1) | 1  # odd, also after an interrupted write
+        start = offset + SEQUENCE.size + SLOT_HEADER.size
+        m[offset:offset + SEQUENCE.size] = SEQUENCE.pack(sequence)
+        m[offset + SEQUENCE.size:start] = SLOT_HEADER.pack(version + 1, len(data))
+        m[start:start + len(data)] = data
+        m[offset:offset + SEQUENCE.size] = SEQUENCE.pack(sequence + 1)
+        m[0:HEADER.size] = HEADER.pack(MAGIC, version + 1, slot, len(data))
+        return True
+
+    # ----- reader -----
+
+    def read(self):
+        """Latest published snapshot, or None if nothing was published yet"""
+        m = self._open(writable=False)
+        if m is None:
+            return None
+        for _ in range(5):
+            header = m[0:HEADER.size]
+            if m[0:HEADER.size] != header:
+                continue  # header being rewritten right now
+            magic, version, slot, length = HEADER.unpack(header)
+            if magic != MAGIC or version == 0:
+                return None
+            if version == self._cached_version:
+                return self._cached
+            offset = self._offset(slot)
+            start = offset + SEQUENCE.size + SLOT_HEADER.size
+            sequence = SEQUENCE.unpack(m[offset:offset + SEQUENCE.size])[0]
+            if sequence & 1:
+                continue  # the writer is filling this slot
+            version, length = SLOT_HEADER.unpack(m[offset + SEQUENCE.size:start])
+            data = m[start:start + length]
+            if SEQUENCE.unpack(m[offset:offset + SEQUENCE.size])[0] != sequence:
+                continue  # the slot was rewritten while copying
+            try:
+                snapshot = pickle.loads(data)
+            except Exception:
+                continue
+            self._cached, self._cached_version = snapshot, version
+            return snapshot
+        return self._cached
+
+    def _offset(self, slot):
+        return HEADER.size + slot * (SEQUENCE.size + SLOT_HEADER.size + self.slot_size)
+
+    def _open(self, writable):
+        if self._map is not None and (self._writable or not writable):
+            return self._map
+        size = self._offset(2)
+        if writable:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+            finally:
+                os.close(fd)
+            self._writable = True
+        else:
+            try:
+                fd = os.open(self.path, os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+            try:
+                if os.fstat(fd).st_size < size:
+                    return None
+                self._map = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+        return self._map
@@ -0,0 +1,330 @@
+# twitter_sketches.py
+"""Streaming sketches for approximate percentiles and distinct user counts.
+
+TDigest keeps a bounded set of centroids per engagement column and answers
+PERCENTILE_CONT-style queries; its size is O(compression) no matter how many
+rows were added. HyperLogLog keeps 2**precision one-byte registers and
+estimates distinct counts with a relative standard error of about
+1.04 / sqrt(2**precision) (1.6% at the default precision of 12).
+
+SketchSet bundles what the exporter needs: one digest for retweets > 0, one
+for likes > 0 (plus how many were 0, for the medians), and a tweet count and
+an HLL per time bucket so any window up to 7 days and the hour-of-day
+distribution can be answered from the buckets it covers. With sketches on,
+the aggregator keeps these instead of its exact per-value histograms and
+per-tweet / per-user timestamps, so its memory no longer grows with the rows
+in the window. All of them pickle compactly, so they are written to disk
+with the incremental state between cycles.
+"""
+import hashlib
+import math
+from collections import namedtuple
+
+import numpy as np
+
+DEFAULT_COMPRESSION = 200
+DEFAULT_HLL_PRECISION = 12
+DEFAULT_BUCKET_MS = 5 * 60 * 1000
+COARSE_BUCKET_MS = 3600 * 1000
+FINE_WINDOW_MS = 24 * 3600 * 1000
+RETENTION_MS = 168 * 3600 * 1000
+
+SketchConfig = namedtuple('SketchConfig', 'compression hll_precision bucket_ms')
+SketchConfig.__new__.__defaults__ = (DEFAULT_COMPRESSION, DEFAULT_HLL_PRECISION, DEFAULT_BUCKET_MS)
+
+
+def hash64(value):
+    """Stable 64-bit hash of a user name (identical across processes)"""
+    digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class TDigest(object):
+    """Merging t-digest (k1 scale function) over weighted values.
+
+    Centroids built from a single distinct value are flagged as pure; ranks
+    that land inside a pure centroid resolve to that value exactly, which
+    keeps integer columns with many ties (0, 1, 2 retweets) exact.
+    """
+
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = np.zeros(0, dtype=np.float64)
+        self.weights = np.zeros(0, dtype=np.float64)
+        self.pure = np.zeros(0, dtype=bool)
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+        self._buffered = 0
+
+    @property
+    def count(self):
+        self._flush()
+        return float(self.weights.sum())
+
+    def add(self, values, weights=None):
+        """Add values (optionally pre-aggregated with integer weights)"""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self._add(values, weights, np.ones(len(values), dtype=bool))
+
+    def merge(self, other):
+        """Fold another digest into this one"""
+        other._flush()
+        if len(other.means):
+            self._add(other.means, other.weights, other.pure)
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+
+    def _add(self, values, weights, pure):
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._buffer.append((values, weights, pure))
+        self._buffered += len(values)
+        if self._buffered >= 10 * self.compression:
+            self._flush()
+
+    def quantile(self, fraction):
+        """Estimate PERCENTILE_CONT(fraction); 0 when empty"""
+        self._flush()
+        total = self.weights.sum()
+        if total == 0:
+            return 0.0
+        rank = fraction * (total - 1)
+        lo, hi = math.floor(rank), math.ceil(rank)
+        v_lo = self._value_at(lo)
+        v_hi = self._value_at(hi) if hi != lo else v_lo
+        return float(v_lo + (rank - lo) * (v_hi - v_lo))
+
+    def _value_at(self, rank):
+        """Estimated value of the rank-th (0-based) smallest element"""
+        ends = np.cumsum(self.weights)
+        i = int(np.searchsorted(ends, rank, side='right'))
+        i = min(i, len(self.means) - 1)
+        if self.pure[i] or self.weights[i] == 1:
+            return self.means[i]
+        # Interpolate between centroid centres; element k sits at k + 0.5
+        centres = ends - self.weights / 2
+        target = rank + 0.5
+        if target <= centres[0]:
+            return self.min + (self.means[0] - self.min) * _ratio(rank, centres[0] - 0.5)
+        if target >= centres[-1]:
+            return self.means[-1] + (self.max - self.means[-1]) * _ratio(target - centres[-1], ends[-1] - 0.5 - centres[-1])
+        j = int(np.searchsorted(centres, target, side='right')) - 1
+        return self.means[j] + (self.means[j + 1] - self.means[j]) * (target - centres[j]) / (centres[j + 1] - centres[j])
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        values = np.concatenate([self.means] + [v for v, _, _ in self._buffer])
+        weights = np.concatenate([self.weights] + [w for _, w, _ in self._buffer])
+        pure = np.concatenate([self.pure] + [p for _, _, p in self._buffer])
+        self._buffer = []
+        self._buffered = 0
+        order = np.argsort(values, kind='stable')
+        values, weights, pure = values[order], weights[order], pure[order]
+        total = weights.sum()
+
+        means, sums, flags = [], [], []
+        cur_mean, cur_weight, cur_pure = values[0], weights[0], pure[0]
+        cumulative = 0.0
+        limit = self._q_limit(0.0) * total
+        for value, weight, is_pure in zip(values[1:], weights[1:], pure[1:]):
+            same = cur_pure and is_pure and value == cur_mean
+            if same or cumulative + cur_weight + weight <= limit:
+                cur_weight += weight
+                cur_mean += (value - cur_mean) * weight / cur_weight
+                cur_pure = same
+            else:
+                means.append(cur_mean)
+                sums.append(cur_weight)
+                flags.append(cur_pure)
+                cumulative += cur_weight
+                limit = self._q_limit(cumulative / total) * total
+                cur_mean, cur_weight, cur_pure = value, weight, is_pure
+        means.append(cur_mean)
+        sums.append(cur_weight)
+        flags.append(cur_pure)
+        self.means = np.array(means, dtype=np.float64)
+        self.weights = np.array(sums, dtype=np.float64)
+        self.pure = np.array(flags, dtype=bool)
+
+    def _q_limit(self, q):
+        """Largest quantile a centroid starting at q may extend to (k1 scale)"""
+        k = self.compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__
+
+
+def _ratio(part, whole):
+    return min(max(part / whole, 0.0), 1.0) if whole > 0 else 0.0
+
+
+class HyperLogLog(object):
+    """HyperLogLog distinct counter over 64-bit hashes"""
+
+    def __init__(self, precision=DEFAULT_HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+
+    def add_hashes(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return
+        self.add_ranks(*_register_ranks(hashes, self.precision))
+
+    def add_ranks(self, index, ranks):
+        """add_hashes() for hashes already split by _register_ranks()"""
+        np.maximum.at(self.registers, index, ranks)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        m = len(self.registers)
+        estimate = _alpha(m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting for small sets
+        return int(round(estimate))
+
+
+def _alpha(m):
+    if m >= 128:
+        return 0.7213 / (1 + 1.079 / m)
+    return {16: 0.673, 32: 0.697, 64: 0.709}[m]
+
+
+def _register_ranks(hashes, precision):
+    """Register index and rank (leading zeros + 1 of the remaining bits) of each hash"""
+    p = np.uint64(precision)
+    index = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = (hashes << p) | (np.uint64(1) << (p - np.uint64(1)))
+    return index, _leading_zeros(rest) + 1
+
+
+def _leading_zeros(words):
+    """Leading zero bits of non-zero uint64 words"""
+    words = words.copy()
+    zeros = np.zeros(len(words), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        mask = words < (np.uint64(1) << np.uint64(64 - shift))
+        zeros[mask] += shift
+        words[mask] <<= np.uint64(shift)
+    return zeros
+
+
+class SketchSet(object):
+    """Percentile digests and per-bucket tweet counts and HLLs, in place of the exact state.
+
+    Tweets of the last 24 hours go into fine buckets (bucket_ms, 5 minutes
+    by default) so the 1h/6h/24h windows are precise; older tweets go into
+    hourly buckets, which is all the 7-day window and the hour-of-day
+    distribution need. That keeps the number of buckets around 288 + 144
+    regardless of traffic.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or SketchConfig()
+        self.retweets = TDigest(self.config.compression)
+        self.likes = TDigest(self.config.compression)
+        self.zeros = {'retweets': 0, 'likes': 0}  # values <= 0, left out of the digests
+        self.active = {}  # (bucket start epoch ms, width ms) -> HyperLogLog
+        self.tweets = {}  # (bucket start epoch ms, width ms) -> tweet count
+
+    def add(self, user_hashes, retweets, likes, dates_ms, now_ms):
+        """Fold one page (numpy columns) into the sketches"""
+        for name, values in (('retweets', retweets), ('likes', likes)):
+            positive = values[values > 0]
+            self.zeros[name] += len(values) - len(positive)
+            if len(positive):
+                unique, counts = np.unique(positive, return_counts=True)
+                getattr(self, name).add(unique, counts)
+
+        # Hash bits are split once per page, then handed out per bucket in sorted runs
+        keep = dates_ms > now_ms - RETENTION_MS
+        dates_ms = dates_ms[keep]
+        index, ranks = _register_ranks(user_hashes[keep], self.config.hll_precision)
+        fine = dates_ms > now_ms - FINE_WINDOW_MS
+        for width, mask in ((self.config.bucket_ms, fine), (COARSE_BUCKET_MS, ~fine)):
+            starts = dates_ms[mask] // width * width
+            order = np.argsort(starts, kind='stable')
+            starts, bucket_index, bucket_ranks = starts[order], index[mask][order], ranks[mask][order]
+            unique, first, counts = np.unique(starts, return_index=True, return_counts=True)
+            for start, i, count in zip(unique.tolist(), first.tolist(), counts.tolist()):
+                self._hll(start, width).add_ranks(bucket_index[i:i + count], bucket_ranks[i:i + count])
+                self.tweets[(start, width)] = self.tweets.get((start, width), 0) + count
+
+    def merge(self, other):
+        """Fold in the sketches of another SketchSet with the same config"""
+        self.retweets.merge(other.retweets)
+        self.likes.merge(other.likes)
+        for name, zeros in other.zeros.items():
+            self.zeros[name] += zeros
+        for (start, width), hll in other.active.items():
+            self._hll(start, width).merge(hll)
+        for key, count in other.tweets.items():
+            self.tweets[key] = self.tweets.get(key, 0) + count
+
+    def _hll(self, start, width):
+        hll = self.active.get((start, width))
+        if hll is None:
+            hll = self.active[(start, width)] = HyperLogLog(self.config.hll_precision)
+        return hll
+
+    def prune(self, now_ms):
+        """Roll fine buckets older than 24h into hourly ones, drop expired buckets"""
+        fine_horizon = now_ms - FINE_WINDOW_MS
+        horizon = now_ms - RETENTION_MS - COARSE_BUCKET_MS
+        for start, width in list(self.active):
+            if start + width <= horizon:
+                del self.active[(start, width)]
+                del self.tweets[(start, width)]
+            elif width != COARSE_BUCKET_MS and start + width <= fine_horizon:
+                hll = self.active.pop((start, width))
+                coarse = start // COARSE_BUCKET_MS * COARSE_BUCKET_MS
+                self._hll(coarse, COARSE_BUCKET_MS).merge(hll)
+                key = (coarse, COARSE_BUCKET_MS)
+                self.tweets[key] = self.tweets.get(key, 0) + self.tweets.pop((start, width))
+
+    def active_users(self, cutoff_ms):
+        """Approximate distinct users with a tweet after cutoff_ms.
+
+        Whole buckets are merged, so the window edge is rounded down to the
+        bucket width (5 minutes inside the last day, one hour before that).
+        """
+        merged = HyperLogLog(self.config.hll_precision)
+        for (start, width), hll in self.active.items():
+            if start + width > cutoff_ms:
+                merged.merge(hll)
+        return merged.count()
+
+    def tweets_after(self, cutoff_ms):
+        """Tweets after cutoff_ms, with the edge rounded like active_users()"""
+        return sum(count for (start, width), count in self.tweets.items() if start + width > cutoff_ms)
+
+    def hour_counts(self, cutoff_ms):
+        """Tweets after cutoff_ms per UTC hour of the day (edge rounded to the hour)"""
+        hours = np.zeros(24, dtype=np.int64)
+        for (start, width), count in self.tweets.items():
+            if start + width > cutoff_ms:
+                hours[(start % (24 * COARSE_BUCKET_MS)) // COARSE_BUCKET_MS] += count
+        return hours
+
+    def median(self, name):
+        """PERCENTILE_CONT(0.5) of a column including its zeros ('retweets' or 'likes')"""
+        digest, zeros = getattr(self, name), self.zeros[name]
+        total = zeros + digest.count
+        if total == 0:
+            return 0.0
+        rank = 0.5 * (total - 1)
+        lo, hi = math.floor(rank), math.ceil(rank)
+        v_lo, v_hi = (0.0 if k < zeros else digest._value_at(k - zeros) for k in (lo, hi))
+        return float(v_lo + (rank - lo) * (v_hi - v_lo))
@@ -0,0 +1,132 @@
+# twitter_snapshot.py
+"""Immutable, pre-rendered response bodies built once per collection cycle.
+
+The collector turns the metrics dict into a Snapshot right after each cycle:
+the typed registry is built once and every endpoint body (Prometheus text,
+OpenMetrics, protobuf, JSON, histogram and pie chart data) is encoded once,
+gzip-compressed once and given an ETag.
+Request handlers only pick bytes out of the current snapshot.
+
+With several collection targets every series carries the target's
+cluster/keyspace labels, /metrics_json is keyed by "cluster/keyspace" and
+the histogram and pie chart data are summed over the targets.
+"""
+import gzip
+import hashlib
+import json
+import time
+from types import MappingProxyType
+
+from twitter_registry import (
+    OPENMETRICS_CONTENT_TYPE, PROMETHEUS_CONTENT_TYPE, PROTOBUF_CONTENT_TYPE, Registry, build_registry,
+    histogram_payload, label_registries, total_registry,
+)
+
+JSON_CONTENT_TYPE = 'application/json'
+
+TARGET_LABELS = ('cluster', 'keyspace')
+
+PIE_CHART_COLORS = ['#FF6384', '#36A2EB', '#FFCE56', '#4BC0C0', '#9966FF', '#FF9F40', '#FF6384']
+
+# chart type -> (histogram family, slice labels)
+PIE_CHARTS = {
+    'retweets': ('twitter_retweets',
+                 ['0 RT', '1-10 RT', '11-50 RT', '51-100 RT', '101-500 RT', '501-1000 RT', '1000+ RT']),
+    'likes': ('twitter_likes',
+              ['0 Likes', '1-20', '21-100', '101-500', '501-2000', '2001-10000', '10000+']),
+    'text_length': ('twitter_text_length',
+                    ['0-50 chars', '51-100', '101-150', '151-200', '201-280', '280+']),
+}
+
+
+def piechart_payload(registry, chart_type):
+    chart_data = {'labels': [], 'values': [], 'colors': PIE_CHART_COLORS}
+    if chart_type in PIE_CHARTS:
+        family, labels = PIE_CHARTS[chart_type]
+        histogram = registry.get(family)
+        chart_data['labels'] = labels
+        chart_data['values'] = list(histogram.counts) if histogram is not None else [0] * len(labels)
+    return chart_data
+
+
+# ===== SNAPSHOT =====
+
+class Body(object):
+    """One encoded response body with its gzip variant and ETag"""
+
+    __slots__ = ('content', 'gzipped', 'etag', 'content_type')
+
+    def __init__(self, content, content_type):
+        self.content = content
+        self.gzipped = gzip.compress(content, compresslevel=6, mtime=0)
+        self.etag = '"' + hashlib.sha1(content).hexdigest()[:20] + '"'
+        self.content_type = content_type
+
+    def response(self, accept_encoding='', if_none_match=''):
+        """(body, status, headers) honouring gzip and If-None-Match"""
+        headers = {'Content-Type': self.content_type, 'ETag': self.etag, 'Vary': 'Accept, Accept-Encoding'}
+        if if_none_match and (if_none_match.strip() == '*' or self.etag in if_none_match):
+            return b'', 304, headers
+        if 'gzip' in accept_encoding:
+            headers['Content-Encoding'] = 'gzip'
+            return self.gzipped, 200, headers
+        return self.content, 200, headers
+
+
+class Snapshot(object):
+    """Everything the HTTP endpoints serve for one collection cycle"""
+
+    def __init__(self, metrics, version, created=None, stats=None, targets=None):
+        """`targets` ({(cluster, keyspace): metrics}) replaces `metrics` when given"""
+        self.version = version
+        self.created = time.time() if created is None else created
+        if targets:
+            self.metrics = MappingProxyType({'/'.join(labels): dict(values) for labels, values in targets.items()})
+            registries = [(labels, build_registry(values)) for labels, values in targets.items()]
+            self.registry = label_registries(registries, TARGET_LABELS)
+            totals = total_registry(registry for _, registry in registries)
+        else:
+            self.metrics = MappingProxyType(dict(metrics))
+            self.registry = totals = build_registry(self.metrics)
+        if stats is not None:
+            stats.register(self.registry)  # twitter_exporter_* self-instrumentation
+        self.bodies = {
+            'metrics': Body(self.registry.render_text(), PROMETHEUS_CONTENT_TYPE),
+            'metrics_openmetrics': Body(self.registry.render_openmetrics(), OPENMETRICS_CONTENT_TYPE),
+            'metrics_protobuf': Body(self.registry.render_protobuf(), PROTOBUF_CONTENT_TYPE),
+            'metrics_json': Body(json.dumps(dict(self.metrics), indent=2).encode('utf-8'), JSON_CONTENT_TYPE),
+            'histogram_data': Body(json.dumps(histogram_payload(totals), indent=2).encode('utf-8'),
+                                   JSON_CONTENT_TYPE),
+        }
+        for chart_type in PIE_CHARTS:
+            self.bodies[f'piechart/{chart_type}'] = Body(
+                json.dumps(piechart_payload(totals, chart_type)).encode('utf-8'), JSON_CONTENT_TYPE)
+        # Unknown chart types get the empty chart, still pre-rendered
+        self.bodies['piechart/'] = Body(json.dumps(piechart_payload(Registry(), None)).encode('utf-8'),
+                                        JSON_CONTENT_TYPE)
+
+    def __getstate__(self):
+        # Shared with server workers: they only need the encoded bodies
+        return {'version': self.version, 'created': self.created,
+                'metrics': dict(self.metrics), 'bodies': self.bodies}
+
+    def __setstate__(self, state):
+        self.version = state['version']
+        self.created = state['created']
+        self.metrics = MappingProxyType(state['metrics'])
+        self.registry = None
+        self.bodies = state['bodies']
+
+    def body(self, name):
+        return self.bodies[name]
+
+    def exposition(self, accept):
+        """/metrics body negotiated from the Accept header"""
+        if 'application/vnd.google.protobuf' in accept:
+            return self.bodies['metrics_protobuf']
+        if 'application/openmetrics-text' in accept:
+            return self.bodies['metrics_openmetrics']
+        return self.bodies['metrics']
+
+    def piechart(self, chart_type):
+        return self.bodies.get(f'piechart/{chart_type}', self.bodies['piechart/'])
@@ -0,0 +1,265 @@
+# twitter_source.py
+"""Where tweets are read from.
+
+CassandraSource keeps one long-lived session for the whole exporter process,
+prepares every statement once and fans table scans out over token ranges with
+execute_async, keeping at most `max_in_flight` requests outstanding.
+SQLiteSource serves the same scans from a local SQLite file so collection can
+be exercised without a running Cassandra.
+
+Both expose the same small interface:
+    scan(columns, where='', params=(), ranges=None)
+                                        -> iterable of rows (attribute access)
+    shards(count)                       -> `count` lists of ranges that together
+                                           cover the table, for parallel scans
+    queries                             -> statements executed so far
+    stats                               -> optional CollectorStats fed with query latencies
+    close()
+"""
+import sqlite3
+import time
+from collections import deque, namedtuple
+from datetime import datetime, timedelta, timezone
+from itertools import chain, islice
+
+from cassandra.cluster import Cluster, NoHostAvailable
+from cassandra.policies import ExponentialReconnectionPolicy
+
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+TOKEN_RANGES = 64
+MAX_IN_FLIGHT = 8
+FETCH_SIZE = 5000
+MAX_BACKOFF = 60
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def token_ranges(splits, start=MIN_TOKEN, end=MAX_TOKEN):
+    """Split (start, end] of the Murmur3 ring into `splits` contiguous ranges"""
+    step = (end - start) // splits
+    bounds = [start + i * step for i in range(splits)] + [end]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class CassandraSource(object):
+    """Persistent Cassandra session with prepared statements and async fan-out"""
+
+    def __init__(self, hosts, keyspace, port=9042, table='tweets', partition_key='tweet_id',
+                 splits=TOKEN_RANGES, max_in_flight=MAX_IN_FLIGHT, fetch_size=FETCH_SIZE):
+        self.hosts = hosts
+        self.keyspace = keyspace
+        self.port = port
+        self.table = table
+        self.partition_key = partition_key
+        self.splits = splits
+        self.max_in_flight = max_in_flight
+        self.fetch_size = fetch_size
+        self.queries = 0
+        self.stats = None
+
+        self._cluster = None
+        self._session = None
+        self._prepared = {}
+        self._backoff = 0
+        self._retry_at = 0.0
+
+    @property
+    def session(self):
+        """The shared session, connecting (with backoff after failures) on demand"""
+        if self._session is not None:
+            return self._session
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise ConnectionError(f"Cassandra unavailable, next reconnect in {self._retry_at - now:.0f}s")
+        cluster = Cluster(self.hosts, port=self.port,
+                          reconnection_policy=ExponentialReconnectionPolicy(1.0, MAX_BACKOFF))
+        try:
+            session = cluster.connect(self.keyspace)
+        except Exception:
+            cluster.shutdown()
+            self._backoff = min(max(self._backoff * 2, 1), MAX_BACKOFF)
+            self._retry_at = now + self._backoff
+            raise
+        session.default_fetch_size = self.fetch_size
+        self._cluster, self._session = cluster, session
+        self._backoff = 0
+        return session
+
+    def prepare(self, query):
+        """Prepare a statement once per session"""
+        statement = self._prepared.get(query)
+        if statement is None:
+            statement = self._prepared[query] = self.session.prepare(query)
+        return statement
+
+    def execute(self, query, params=()):
+        """Execute a single prepared statement"""
+        statement = self.prepare(query)
+        self.queries += 1
+        started = time.perf_counter()
+        try:
+            return self.session.execute(statement, params)
+        except NoHostAvailable:
+            self.close()
+            raise
+        finally:
+            self._observe('execute', started)
+
+    def scan(self, columns, where='', params=(), ranges=None):
+        """Read `columns` from the table, one concurrent query per token range.
+
+        `ranges` restricts the scan to some (low, high] token ranges, e.g. one
+        entry of shards(); by default the whole ring is read.
+        """
+        query = (f"SELECT {', '.join(columns)} FROM {self.table} "
+                 f"WHERE token({self.partition_key}) > ? AND token({self.partition_key}) <= ?")
+        if where:
+            query += f" AND {where} ALLOW FILTERING"
+        statement = self.prepare(query)
+        if ranges is None:
+            ranges = token_ranges(self.splits)
+        param_sets = [(low, high) + tuple(params) for low, high in ranges]
+        return self.fan_out(statement, param_sets, 'scan_filtered' if where else 'scan')
+
+    def shards(self, count):
+        """The ring's token ranges dealt into `count` contiguous groups"""
+        ranges = token_ranges(max(self.splits, count))
+        return [ranges[i * len(ranges) // count:(i + 1) * len(ranges) // count] for i in range(count)]
+
+    def fan_out(self, statement, param_sets, name='fan_out'):
+        """Run a statement once per parameter set with bounded concurrency.
+
+        Rows are yielded range by range; the next requests are already in
+        flight while the current result is being consumed. Latency (submit
+        to first page) is reported per request under `name`.
+        """
+        session = self.session
+        pending = iter(param_sets)
+        futures = deque()
+        try:
+            for params in islice(pending, self.max_in_flight):
+                futures.append((session.execute_async(statement, params), time.perf_counter()))
+                self.queries += 1
+            while futures:
+                future, started = futures.popleft()
+                result = future.result()
+                self._observe(name, started)
+                for params in islice(pending, 1):
+                    futures.append((session.execute_async(statement, params), time.perf_counter()))
+                    self.queries += 1
+                yield from result
+        except NoHostAvailable:
+            self.close()
+            raise
+        finally:
+            for future, _ in futures:
+                future.cancel()
+
+    def _observe(self, name, started):
+        if self.stats is not None:
+            self.stats.observe_query(name, time.perf_counter() - started)
+
+    def close(self):
+        """Drop the session; the next call reconnects"""
+        if self._cluster is not None:
+            self._cluster.shutdown()
+        self._cluster = None
+        self._session = None
+        self._prepared = {}
+
+
+class SQLiteSource(object):
+    """Local stand-in for Cassandra backed by a SQLite tweets table"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tweets (
+            tweet_id TEXT PRIMARY KEY,
+            user TEXT,
+            text TEXT,
+            retweets INTEGER,
+            likes INTEGER,
+            date INTEGER
+        )
+    """
+    COLUMNS = ('tweet_id', 'user', 'text', 'retweets', 'likes', 'date')
+
+    def __init__(self, path=':memory:', table='tweets', fetch_size=FETCH_SIZE):
+        self.path = path
+        self.table = table
+        self.fetch_size = fetch_size
+        self.queries = 0
+        self.stats = None
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(self.SCHEMA)
+
+    def insert(self, rows):
+        """Insert (tweet_id, user, text, retweets, likes, date) tuples"""
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {self.table} ({', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+            ((tweet_id, user, text, retweets, likes, _to_ms(date))
+             for tweet_id, user, text, retweets, likes, date in rows))
+        self.conn.commit()
+
+    def scan(self, columns, where='', params=(), ranges=None):
+        """Read `columns`; `ranges` are (low, high] rowid ranges from shards()"""
+        params = [_to_ms(p) if isinstance(p, datetime) else p for p in params]
+        row_type = namedtuple('Row', columns)
+        name = 'scan_filtered' if where else 'scan'
+        query = f"SELECT {', '.join(columns)} FROM {self.table}"
+        if ranges is None:
+            if where:
+                query += f" WHERE {where}"
+            return self._query(query, params, row_type, name)
+        query += " WHERE rowid > ? AND rowid <= ?"
+        if where:
+            query += f" AND {where}"
+        return chain.from_iterable(self._query(query, [low, high] + params, row_type, name)
+                                   for low, high in ranges)
+
+    def shards(self, count):
+        """Rowid ranges splitting the table into `count` similar parts"""
+        low, high = self.conn.execute(f"SELECT min(rowid), max(rowid) FROM {self.table}").fetchone()
+        if low is None:
+            low = high = 1
+        return [[bounds] for bounds in token_ranges(count, low - 1, high)]
+
+    def _query(self, query, params, row_type, name):
+        self.queries += 1
+        started = time.perf_counter()
+        cursor = self.conn.execute(query, params)
+        return self._rows(cursor, row_type, name, time.perf_counter() - started)
+
+    def _rows(self, cursor, row_type, name, seconds):
+        """Yield rows page by page; the query's time excludes the consumer's"""
+        date_index = row_type._fields.index('date') if 'date' in row_type._fields else None
+        while True:
+            started = time.perf_counter()
+            page = cursor.fetchmany(self.fetch_size)
+            seconds += time.perf_counter() - started
+            if not page:
+                if self.stats is not None:
+                    self.stats.observe_query(name, seconds)
+                return
+            for values in page:
+                if date_index is not None and values[date_index] is not None:
+                    values = list(values)
+                    values[date_index] = _from_ms(values[date_index])
+                yield row_type(*values)
+
+    def close(self):
+        self.conn.close()
+
+
+def _to_ms(date):
+    """Naive-UTC (as returned by the Cassandra driver) datetime -> epoch ms"""
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(round(date.timestamp() * 1000))
+
+
+def _from_ms(ms):
+    return EPOCH + timedelta(milliseconds=ms)
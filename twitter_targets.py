@@ -0,0 +1,190 @@
+# twitter_targets.py
+"""Sharded collection over several clusters / keyspaces with a worker pool.
+
+Every target (cluster, keyspace, table) is split into `shards` groups of
+token ranges (rowid ranges on SQLite). Each shard is scanned and folded
+into its own TweetAggregator by a pool worker - separate processes by
+default, so row decoding and aggregation use every core - and the partial
+aggregators of a target are merged once all its shards are back.
+
+Targets are independent: a cycle waits at most `timeout` seconds, and a
+target whose shards are still running keeps serving its previous metrics
+while the others are refreshed. It is not resubmitted until it finishes.
+
+TWITTER_EXPORTER_TARGETS lists the targets, separated by ';':
+    [cluster=]host1,host2[:port]/keyspace[.table]
+With the sqlite backend the "host" is the database path.
+"""
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from twitter_aggregator import SCAN_COLUMNS, TOP_USERS, TweetAggregator
+from twitter_instrumentation import section
+from twitter_rollups import RollupBuckets
+from twitter_source import CassandraSource, SQLiteSource
+
+Target = namedtuple('Target', 'cluster hosts port keyspace table')
+
+TARGET_LABELS = ('cluster', 'keyspace')
+TARGET_TIMEOUT = 60  # seconds a cycle waits for slow targets
+
+# What a shard sends back to the collector
+ShardResult = namedtuple('ShardResult', 'aggregator queries seconds')
+
+
+def parse_targets(spec, default_port=9042):
+    """Targets from '[cluster=]host1,host2[:port]/keyspace[.table];...'"""
+    targets = []
+    for entry in filter(None, (part.strip() for part in spec.split(';'))):
+        cluster, _, location = entry.rpartition('=')
+        hosts, _, path = location.rpartition('/')
+        if not hosts or not path:
+            raise ValueError(f"Target {entry!r} is not [cluster=]hosts[:port]/keyspace[.table]")
+        port = default_port
+        head, _, tail = hosts.rpartition(':')
+        if head and tail.isdigit():
+            hosts, port = head, int(tail)
+        keyspace, _, table = path.partition('.')
+        hosts = [host.strip() for host in hosts.split(',')]
+        targets.append(Target(cluster or hosts[0], tuple(hosts), port, keyspace, table or 'tweets'))
+    return targets
+
+
+def open_source(target, backend):
+    """A new source for a target (the sqlite backend opens target.hosts[0])"""
+    if backend == 'sqlite':
+        return SQLiteSource(target.hosts[0], table=target.table)
+    return CassandraSource(list(target.hosts), target.keyspace, port=target.port, table=target.table)
+
+
+# ===== WORKERS =====
+
+# One long-lived source per target in every worker thread / process
+_local = threading.local()
+
+
+def _source(target, backend):
+    sources = getattr(_local, 'sources', None)
+    if sources is None:
+        sources = _local.sources = {}
+    source = sources.get(target)
+    if source is None:
+        source = sources[target] = open_source(target, backend)
+    return source
+
+
+def scan_shard(target, backend, ranges, now, top_users, sketch_config, rollups):
+    """Scan one shard of a target into a fresh aggregator (runs in a pool worker)"""
+    started = time.perf_counter()
+    source = _source(target, backend)
+    queries = source.queries
+    aggregator = TweetAggregator(now=now, top_users=top_users, sketch_config=sketch_config,
+                                 rollups=RollupBuckets() if rollups else None)
+    aggregator.add_rows(source.scan(SCAN_COLUMNS, ranges=ranges))
+    return ShardResult(aggregator, source.queries - queries, time.perf_counter() - started)
+
+
+# ===== COLLECTOR =====
+
+class ShardedCollector(object):
+    """Collects every target on a shared pool; per-target results survive slow cycles"""
+
+    def __init__(self, targets, backend='cassandra', workers=None, pool='process', shards=None,
+                 top_users=TOP_USERS, sketch_config=None, rollups=False, timeout=TARGET_TIMEOUT):
+        self.targets = list(targets)
+        self.backend = backend
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = pool
+        self.shards = shards or self.workers
+        self.top_users = top_users
+        self.sketch_config = sketch_config
+        self.rollups = rollups
+        self.timeout = timeout
+
+        self.aggregators = OrderedDict()  # target -> merged aggregator of its last finished scan
+        self.results = OrderedDict()      # target -> metrics dict of its last finished scan
+        self.failures = {}                # target -> exception of its last scan, if it failed
+        self.queries = 0                  # statements the workers executed
+        self._pending = {}                # target -> (started, [futures])
+        self._executor = None
+
+    def executor(self):
+        if self._executor is None:
+            if self.pool == 'thread':
+                self._executor = ThreadPoolExecutor(self.workers)
+            else:
+                # spawn: the Cassandra driver's connections must not cross a fork
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def collect(self, now=None, stats=None):
+        """Scan every idle target, wait up to `timeout` and return {target: metrics}"""
+        now = time.time() if now is None else now
+        for target in self.targets:
+            if target not in self._pending:
+                self._submit(target, now, stats)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            for target, (started, futures) in list(self._pending.items()):
+                if all(future.done() for future in futures):
+                    del self._pending[target]
+                    self._finish(target, started, futures, stats)
+            remaining = deadline - time.monotonic()
+            if not self._pending or remaining <= 0:
+                break
+            running = [future for _, futures in self._pending.values() for future in futures if not future.done()]
+            if running:
+                wait(running, remaining, FIRST_COMPLETED)
+        for target, (started, _) in self._pending.items():
+            print(f"{target.cluster}/{target.keyspace} still scanning after {time.monotonic() - started:.0f}s, "
+                  f"serving its previous metrics")
+        return self.results
+
+    def _submit(self, target, now, stats):
+        started = time.monotonic()
+        try:
+            shards = _source(target, self.backend).shards(self.shards)
+            futures = [self.executor().submit(scan_shard, target, self.backend, ranges, now, self.top_users,
+                                              self.sketch_config, self.rollups)
+                       for ranges in shards]
+        except Exception as e:
+            self._failed(target, e, started, stats)
+            return
+        self._pending[target] = (started, futures)
+
+    def _finish(self, target, started, futures, stats):
+        try:
+            shards = [future.result() for future in futures]
+        except Exception as e:
+            self._failed(target, e, started, stats)
+            return
+        with section(stats, 'merge'):
+            aggregator = shards[0].aggregator
+            for shard in shards[1:]:
+                aggregator.merge(shard.aggregator)
+        with section(stats, 'finalize'):
+            self.results[target] = aggregator.metrics()
+        self.aggregators[target] = aggregator
+        self.failures.pop(target, None)
+        self.queries += sum(shard.queries for shard in shards)
+        if stats is not None:
+            stats.add_rows(aggregator.rows)
+            for shard in shards:
+                stats.observe_query('shard', shard.seconds)
+            stats.observe_target(target.cluster, target.keyspace, time.monotonic() - started, success=True)
+
+    def _failed(self, target, error, started, stats):
+        self.failures[target] = error
+        print(f"{target.cluster}/{target.keyspace} failed ({type(error).__name__}): {str(error)[:300]}")
+        if isinstance(error, BrokenExecutor):
+            self.close()  # a worker died; start a fresh pool next cycle
+        if stats is not None:
+            stats.observe_target(target.cluster, target.keyspace, time.monotonic() - started, success=False)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None